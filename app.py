@@ -2,21 +2,60 @@ import os
 import json
 import subprocess
 import hashlib
+import re
+import base64
+import shutil
+import shlex
 import uuid
+import sqlite3
+import threading
+import socket
+import time
+import random
+import pickle
+import queue
+import bisect
+import gzip
+import heapq
+import itertools
+import logging
+import urllib.parse
+import urllib.request
+import errno
+import tempfile
+import ipaddress
+import http.client
+import email.utils
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from datetime import datetime, timedelta
 from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
-from filelock import FileLock
+from werkzeug.utils import secure_filename
+from filelock import FileLock, Timeout
+from socketio import PubSubManager
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.job import Job
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
 import pytz
 import atexit
 import signal
 import sys
 
+try:
+    from eventlet import tpool
+except ImportError:
+    tpool = None
+
 app = Flask(__name__)
 app.secret_key = 'streamhib_v2_secret_key_2025'
-socketio = SocketIO(app, cors_allowed_origins="*")
 CORS(app)
 
 # Timezone
@@ -28,10 +67,133 @@ USERS_FILE = 'users.json'
 DOMAIN_CONFIG_FILE = 'domain_config.json'
 VIDEOS_DIR = 'videos'
 
+# Metrics
+# Counters and histograms exported in the Prometheus text format by /metrics.
+# Request latency and lock timings sit on the hot path, so they are only
+# collected once metrics are switched on by the first scrape; until then each
+# hook costs a single global check. Background work (subprocesses, recovery
+# and cleanup runs, scheduler lag) is always recorded. Every worker keeps its
+# own series and, once enabled, publishes them to the state store so a scrape
+# served by any worker reports the whole panel.
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_PUBLISH_SECONDS = 5
+METRICS_STALE_SECONDS = 60
+METRICS_LOCAL_ADDRS = ('127.0.0.1', '::1')
+
+_metrics_enabled = False
+_metrics_lock = threading.Lock()
+_metrics_histograms = {}  # (name, labels) -> bucket counts + [sum]
+_metrics_counters = {}  # (name, labels) -> value
+
+def observe_metric(name, labels, seconds):
+    """Add one observation in seconds to a histogram series"""
+    key = (name, labels)
+    with _metrics_lock:
+        series = _metrics_histograms.get(key)
+        if series is None:
+            series = _metrics_histograms[key] = [0] * (len(METRICS_LATENCY_BUCKETS) + 1) + [0.0]
+        series[bisect.bisect_left(METRICS_LATENCY_BUCKETS, seconds)] += 1
+        series[-1] += seconds
+
+def count_metric(name, labels, value=1):
+    """Increment a counter series"""
+    key = (name, labels)
+    with _metrics_lock:
+        _metrics_counters[key] = _metrics_counters.get(key, 0) + value
+
+class MeteredFileLock(FileLock):
+    """FileLock that reports acquire wait and hold time once metrics are on"""
+
+    def __init__(self, lock_file, *args, metric_name=None, **kwargs):
+        super().__init__(lock_file, *args, **kwargs)
+        self.metric_name = metric_name or os.path.basename(lock_file)
+        self._held_since = None
+
+    def acquire(self, *args, **kwargs):
+        if not _metrics_enabled:
+            return super().acquire(*args, **kwargs)
+        started = time.perf_counter()
+        proxy = super().acquire(*args, **kwargs)
+        acquired = time.perf_counter()
+        observe_metric('streamhib_lock_wait_seconds', (('lock', self.metric_name),), acquired - started)
+        if self.lock_counter == 1:
+            self._held_since = acquired
+        return proxy
+
+    def release(self, force=False):
+        super().release(force=force)
+        if self._held_since is not None and self.lock_counter == 0:
+            observe_metric('streamhib_lock_hold_seconds', (('lock', self.metric_name),),
+                           time.perf_counter() - self._held_since)
+            self._held_since = None
+
+# Logging
+# log() hands records to a bounded queue; a background listener writes them
+# to stdout (and so journald) as JSON lines. Callers never wait on log I/O:
+# when the queue is full the record is dropped and counted instead. The
+# usual "RECOVERY ERROR: ..." prefix becomes the component and level, and
+# keyword arguments such as session_id become fields of the record.
+LOG_QUEUE_SIZE = int(os.environ.get('STREAMHIB_LOG_QUEUE_SIZE', 10000))
+LOG_PREFIX_PATTERN = re.compile(r'^([A-Z][A-Z_ ]*?)(?: (ERROR|WARNING))?: ')
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, jakarta_tz).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'component': getattr(record, 'component', record.name),
+            'msg': record.getMessage(),
+            'pid': record.process
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            count_metric('streamhib_log_dropped_total', ())
+
+_log_queue = queue.Queue(LOG_QUEUE_SIZE)
+_log_output = logging.StreamHandler(sys.stdout)
+_log_output.setFormatter(JsonLogFormatter())
+_log_listener = QueueListener(_log_queue, _log_output)
+_log_listener.start()
+
+logger = logging.getLogger('streamhib')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(DroppingQueueHandler(_log_queue))
+
+def log(message, **fields):
+    """Queue a log line, taking component and level from its prefix"""
+    match = LOG_PREFIX_PATTERN.match(message)
+    if match:
+        component, severity = match.group(1).lower().replace(' ', '_'), match.group(2)
+        message = message[match.end():]
+    else:
+        component, severity = 'app', 'ERROR' if message.startswith('Error') else None
+    level = {'ERROR': logging.ERROR, 'WARNING': logging.WARNING}.get(severity, logging.INFO)
+    logger.log(level, message, extra={'component': component, 'fields': fields})
+
+def stop_logging():
+    """Write out everything still queued and stop the listener"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
 # File locks
-sessions_lock = FileLock(f"{SESSIONS_FILE}.lock")
-users_lock = FileLock(f"{USERS_FILE}.lock")
-domain_lock = FileLock(f"{DOMAIN_CONFIG_FILE}.lock")
+sessions_lock = MeteredFileLock(f"{SESSIONS_FILE}.lock", metric_name='sessions_lock')
+users_lock = MeteredFileLock(f"{USERS_FILE}.lock", metric_name='users_lock')
+domain_lock = MeteredFileLock(f"{DOMAIN_CONFIG_FILE}.lock", metric_name='domain_lock')
 
 # Admin credentials
 ADMIN_USERNAME = 'admin'
@@ -42,54 +204,431 @@ os.makedirs(VIDEOS_DIR, exist_ok=True)
 os.makedirs('static', exist_ok=True)
 os.makedirs('templates', exist_ok=True)
 
-def load_json_file(filepath, lock, default_data):
-    """Load JSON file with file locking"""
+# State store
+# All persistent state lives in a single SQLite database (WAL mode). Each
+# document (sessions, users, domain config) is stored as one row per entry so
+# a start/stop only rewrites the rows that changed, and every write is one
+# atomic transaction.
+STATE_DB_FILE = 'streamhib.db'
+
+_state_local = threading.local()
+
+def get_state_db():
+    """Get the state store connection for the current thread"""
+    conn = getattr(_state_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB_FILE, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        _state_local.conn = conn
+    return conn
+
+@contextmanager
+def state_transaction():
+    """Run a block of statements as one atomic write transaction"""
+    conn = get_state_db()
+    conn.execute('BEGIN IMMEDIATE')
     try:
-        with lock:
-            if os.path.exists(filepath):
-                with open(filepath, 'r') as f:
-                    return json.load(f)
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+def _flatten_document(data, nested):
+    """Split a document into (bucket, key, json) rows"""
+    rows = {}
+    if nested:
+        for bucket, entries in data.items():
+            for key, value in entries.items():
+                rows[(bucket, key)] = json.dumps(value)
+    else:
+        for key, value in data.items():
+            rows[('', key)] = json.dumps(value)
+    return rows
+
+def _bump_document_version(conn, doc):
+    """Increment the change counter of a document inside a write transaction"""
+    conn.execute(
+        'INSERT INTO state_versions (doc, version) VALUES (?, 1) '
+        'ON CONFLICT(doc) DO UPDATE SET version = version + 1',
+        (doc,)
+    )
+    return conn.execute('SELECT version FROM state_versions WHERE doc = ?', (doc,)).fetchone()[0]
+
+def _write_document_rows(conn, doc, rows):
+    """Replace the rows of a document, touching only entries that changed
+
+    Returns the new document version (None if nothing changed) and the list
+    of (bucket, key, new_json, old_json) changes, with None for a missing side.
+    """
+    existing = {
+        (bucket, key): data
+        for bucket, key, data in conn.execute(
+            'SELECT bucket, key, data FROM state_records WHERE doc = ?', (doc,)
+        )
+    }
+    upserts = [
+        (doc, bucket, key, data)
+        for (bucket, key), data in rows.items()
+        if existing.get((bucket, key)) != data
+    ]
+    deletes = [(doc, bucket, key) for (bucket, key) in existing if (bucket, key) not in rows]
+    if upserts:
+        conn.executemany(
+            'INSERT OR REPLACE INTO state_records (doc, bucket, key, data) VALUES (?, ?, ?, ?)',
+            upserts
+        )
+    if deletes:
+        conn.executemany(
+            'DELETE FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+            deletes
+        )
+    changes = [(bucket, key, data, existing.get((bucket, key))) for _, bucket, key, data in upserts]
+    changes += [(bucket, key, None, existing[(bucket, key)]) for _, bucket, key in deletes]
+    if changes:
+        return _bump_document_version(conn, doc), changes
+    return None, changes
+
+def _read_document(conn, doc, default_data, nested):
+    """Parse the rows of a document"""
+    rows = conn.execute(
+        'SELECT bucket, key, data FROM state_records WHERE doc = ?', (doc,)
+    ).fetchall()
+    if nested:
+        data = {bucket: {} for bucket in default_data}
+        for bucket, key, value in rows:
+            data.setdefault(bucket, {})[key] = json.loads(value)
+        return data
+    if not rows:
+        return dict(default_data)
+    return {key: json.loads(value) for _, key, value in rows}
+
+# State cache
+# Parsed documents are kept in memory and handed out either as read-only
+# views (readonly=True, zero copy) or as private mutable copies. An entry is
+# trusted while the database files keep the same inode/size/mtime; when they
+# change, the per-document version counter decides whether to re-read.
+STATE_SIGNATURE_MIN_AGE_NS = 1_000_000_000
+
+_state_cache = {}
+_state_cache_lock = threading.Lock()
+state_cache_stats = {}
+
+class _FrozenDict(dict):
+    """Read-only dict handed out by the state cache"""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Cached state is read-only, load it with readonly=False to modify it")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+def _freeze(value):
+    """Build a read-only deep copy of parsed JSON"""
+    if isinstance(value, dict):
+        return _FrozenDict((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+def _thaw(value):
+    """Build a mutable deep copy of cached JSON"""
+    if isinstance(value, dict):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_thaw(item) for item in value]
+    return value
+
+def _state_file_signature():
+    """Identity of the database files, or None while they are too fresh to trust"""
+    signature = []
+    now_ns = time.time_ns()
+    for path in (STATE_DB_FILE, f"{STATE_DB_FILE}-wal"):
+        try:
+            st = os.stat(path)
+        except OSError:
+            signature.append(None)
+            continue
+        # Writes landing in the same mtime tick would keep the signature
+        # unchanged, so recently modified files always go to the version check.
+        if now_ns - st.st_mtime_ns < STATE_SIGNATURE_MIN_AGE_NS:
+            return None
+        signature.append((st.st_ino, st.st_size, st.st_mtime_ns))
+    return tuple(signature)
+
+def _count_cache(doc, outcome):
+    """Increment a cache counter, caller holds _state_cache_lock"""
+    counters = state_cache_stats.setdefault(doc, {'hits': 0, 'revalidations': 0, 'misses': 0})
+    counters[outcome] += 1
+
+def _store_cached_document(doc, version, data):
+    """Replace the cached copy of a document after an in-process write"""
+    with _state_cache_lock:
+        _state_cache[doc] = {'version': version, 'signature': None, 'data': _freeze(data)}
+
+def _patch_cached_document(doc, version, changes):
+    """Apply (bucket, key, value) changes to a cached nested document
+
+    A value of None removes the key. Only the touched buckets are copied; if
+    the cache missed an intermediate version the entry is dropped instead.
+    """
+    with _state_cache_lock:
+        entry = _state_cache.get(doc)
+        if entry is None:
+            return
+        if entry['version'] != version - 1:
+            del _state_cache[doc]
+            return
+        data = dict(entry['data'])
+        index = entry.get('index')
+        for bucket, key, value in changes:
+            bucket_data = dict(data.get(bucket, {}))
+            if index is not None:
+                if key in bucket_data:
+                    _index_remove_session(index, bucket, key, bucket_data[key])
+                if value is not None:
+                    _index_add_session(index, bucket, key, value)
+            if value is None:
+                bucket_data.pop(key, None)
             else:
-                with open(filepath, 'w') as f:
-                    json.dump(default_data, f, indent=2)
-                return default_data
+                bucket_data[key] = _freeze(value)
+            data[bucket] = _FrozenDict(bucket_data)
+        _state_cache[doc] = {'version': version, 'signature': None, 'data': _FrozenDict(data)}
+        if index is not None:
+            _state_cache[doc]['index'] = index
+
+def get_state_cache_stats():
+    """Get state cache hit/miss counters per document"""
+    with _state_cache_lock:
+        return {doc: dict(counters) for doc, counters in state_cache_stats.items()}
+
+def load_state_document(doc, default_data, nested=False, readonly=False):
+    """Load a document from the state store through the state cache"""
+    try:
+        signature = _state_file_signature()
+        with _state_cache_lock:
+            entry = _state_cache.get(doc)
+            if entry is not None and signature is not None and entry['signature'] == signature:
+                _count_cache(doc, 'hits')
+                return entry['data'] if readonly else _thaw(entry['data'])
+
+        conn = get_state_db()
+        conn.execute('BEGIN')
+        try:
+            row = conn.execute('SELECT version FROM state_versions WHERE doc = ?', (doc,)).fetchone()
+            version = row[0] if row else 0
+            fresh = None
+            if entry is None or entry['version'] != version:
+                fresh = _read_document(conn, doc, default_data, nested)
+        finally:
+            conn.execute('COMMIT')
+
+        with _state_cache_lock:
+            if fresh is None:
+                if _state_cache.get(doc) is entry:
+                    entry['signature'] = signature
+                _count_cache(doc, 'revalidations')
+                return entry['data'] if readonly else _thaw(entry['data'])
+            entry = {'version': version, 'signature': signature, 'data': _freeze(fresh)}
+            _state_cache[doc] = entry
+            _count_cache(doc, 'misses')
+        return entry['data'] if readonly else fresh
     except Exception as e:
-        print(f"Error loading {filepath}: {e}")
+        log(f"Error loading {doc}: {e}")
         return default_data
 
-def save_json_file(filepath, lock, data):
-    """Save JSON file with file locking"""
+def save_state_document(doc, lock, data, nested=False):
+    """Save a document to the state store with file locking"""
     try:
         with lock:
-            with open(filepath, 'w') as f:
-                json.dump(data, f, indent=2)
+            with state_transaction() as conn:
+                version, changes = _write_document_rows(conn, doc, _flatten_document(data, nested))
+        if version is not None:
+            _store_cached_document(doc, version, data)
+            if doc == 'sessions':
+                publish_session_changes([
+                    (bucket, key, json.loads(new) if new else None, json.loads(old) if old else None)
+                    for bucket, key, new, old in changes
+                ])
+        return True
+    except Exception as e:
+        log(f"Error saving {doc}: {e}")
+        return False
+
+def load_state_record(doc, key, bucket=''):
+    """Load a single entry of a document straight from the state store"""
+    try:
+        row = get_state_db().execute(
+            'SELECT data FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+            (doc, bucket, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    except Exception as e:
+        log(f"Error loading {doc}/{key}: {e}")
+        return None
+
+def save_state_record(doc, key, value, bucket=''):
+    """Insert or update a single entry of a document"""
+    try:
+        with state_transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO state_records (doc, bucket, key, data) VALUES (?, ?, ?, ?)',
+                (doc, bucket, key, json.dumps(value))
+            )
+            _bump_document_version(conn, doc)
+        with _state_cache_lock:
+            _state_cache.pop(doc, None)
+        return True
+    except Exception as e:
+        log(f"Error saving {doc}/{key}: {e}")
+        return False
+
+def delete_state_record(doc, key, bucket=''):
+    """Delete a single entry of a document"""
+    try:
+        with state_transaction() as conn:
+            conn.execute(
+                'DELETE FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+                (doc, bucket, key)
+            )
+            _bump_document_version(conn, doc)
+        with _state_cache_lock:
+            _state_cache.pop(doc, None)
+        return True
+    except Exception as e:
+        log(f"Error deleting {doc}/{key}: {e}")
+        return False
+
+def init_state_store():
+    """Create the state store schema and import any legacy JSON files"""
+    get_state_db().execute(
+        'CREATE TABLE IF NOT EXISTS state_records ('
+        'doc TEXT NOT NULL, bucket TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, '
+        'PRIMARY KEY (doc, bucket, key)) WITHOUT ROWID'
+    )
+    get_state_db().execute(
+        'CREATE TABLE IF NOT EXISTS state_versions (doc TEXT PRIMARY KEY, version INTEGER NOT NULL)'
+    )
+    get_state_db().execute(
+        'CREATE TABLE IF NOT EXISTS socketio_messages ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, created REAL NOT NULL, data TEXT NOT NULL)'
+    )
+
+    # A JSON file next to the app (older install, or copied over from another
+    # server during migration) replaces the stored document and is renamed so
+    # it is only imported once.
+    legacy_files = [
+        ('sessions', SESSIONS_FILE, sessions_lock, True),
+        ('users', USERS_FILE, users_lock, False),
+        ('domain_config', DOMAIN_CONFIG_FILE, domain_lock, False),
+    ]
+    for doc, filepath, lock, nested in legacy_files:
+        try:
+            with lock:
+                if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+                    continue
+                with open(filepath, 'r') as f:
+                    data = json.load(f)
+                with state_transaction() as conn:
+                    _write_document_rows(conn, doc, _flatten_document(data, nested))
+                with _state_cache_lock:
+                    _state_cache.pop(doc, None)
+                os.replace(filepath, f"{filepath}.migrated")
+                log(f"STATE: Migrated {filepath} into {STATE_DB_FILE}")
+        except Exception as e:
+            log(f"STATE ERROR: Failed to migrate {filepath}: {e}")
+
+def upsert_session(bucket, session_id, session_info):
+    """Insert or update a single session"""
+    try:
+        with sessions_lock:
+            with state_transaction() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO state_records (doc, bucket, key, data) VALUES (?, ?, ?, ?)',
+                    ('sessions', bucket, session_id, json.dumps(session_info))
+                )
+                version = _bump_document_version(conn, 'sessions')
+        _patch_cached_document('sessions', version, [(bucket, session_id, session_info)])
+        publish_session_changes([(bucket, session_id, session_info, None)])
+        return True
+    except Exception as e:
+        log(f"Error saving session {session_id[:8]}: {e}", session_id=session_id)
+        return False
+
+def delete_session(bucket, session_id):
+    """Delete a single session"""
+    try:
+        with sessions_lock:
+            with state_transaction() as conn:
+                previous = conn.execute(
+                    'SELECT data FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+                    ('sessions', bucket, session_id)
+                ).fetchone()
+                conn.execute(
+                    'DELETE FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+                    ('sessions', bucket, session_id)
+                )
+                version = _bump_document_version(conn, 'sessions')
+        _patch_cached_document('sessions', version, [(bucket, session_id, None)])
+        if previous:
+            publish_session_changes([(bucket, session_id, None, json.loads(previous[0]))])
+        return True
+    except Exception as e:
+        log(f"Error deleting session {session_id[:8]}: {e}", session_id=session_id)
+        return False
+
+def move_session(session_id, from_bucket, to_bucket, session_info):
+    """Move a session between buckets in one transaction"""
+    try:
+        with sessions_lock:
+            with state_transaction() as conn:
+                conn.execute(
+                    'DELETE FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+                    ('sessions', from_bucket, session_id)
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO state_records (doc, bucket, key, data) VALUES (?, ?, ?, ?)',
+                    ('sessions', to_bucket, session_id, json.dumps(session_info))
+                )
+                version = _bump_document_version(conn, 'sessions')
+        _patch_cached_document('sessions', version, [
+            (from_bucket, session_id, None),
+            (to_bucket, session_id, session_info),
+        ])
+        publish_session_changes([
+            (from_bucket, session_id, None, session_info),
+            (to_bucket, session_id, session_info, None),
+        ])
         return True
     except Exception as e:
-        print(f"Error saving {filepath}: {e}")
+        log(f"Error moving session {session_id[:8]}: {e}", session_id=session_id)
         return False
 
-def load_sessions():
+def load_sessions(readonly=False):
     """Load sessions data"""
     default_sessions = {
         "active_sessions": {},
         "inactive_sessions": {},
         "scheduled_sessions": {}
     }
-    return load_json_file(SESSIONS_FILE, sessions_lock, default_sessions)
+    return load_state_document('sessions', default_sessions, nested=True, readonly=readonly)
 
 def save_sessions(sessions_data):
     """Save sessions data"""
-    return save_json_file(SESSIONS_FILE, sessions_lock, sessions_data)
+    return save_state_document('sessions', sessions_lock, sessions_data, nested=True)
 
-def load_users():
+def load_users(readonly=False):
     """Load users data"""
-    return load_json_file(USERS_FILE, users_lock, {})
+    return load_state_document('users', {}, readonly=readonly)
 
 def save_users(users_data):
     """Save users data"""
-    return save_json_file(USERS_FILE, users_lock, users_data)
+    return save_state_document('users', users_lock, users_data)
 
-def load_domain_config():
+def load_domain_config(readonly=False):
     """Load domain configuration"""
     default_config = {
         "domain_name": "",
@@ -98,11 +637,296 @@ def load_domain_config():
         "configured_at": "",
         "nginx_configured": False
     }
-    return load_json_file(DOMAIN_CONFIG_FILE, domain_lock, default_config)
+    return load_state_document('domain_config', default_config, readonly=readonly)
 
 def save_domain_config(config_data):
     """Save domain configuration"""
-    return save_json_file(DOMAIN_CONFIG_FILE, domain_lock, config_data)
+    return save_state_document('domain_config', domain_lock, config_data)
+
+# Cluster
+# The panel can run as several gunicorn workers (STREAMHIB_WORKERS). Shared
+# state lives in the state store or behind file locks, never only in process
+# memory, and Socket.IO emits go through a message queue so an event raised
+# in one worker reaches clients connected to any other. STREAMHIB_MESSAGE_QUEUE
+# takes a redis:// (or other kombu) URL, or `state` for a small built-in queue
+# on the state database, which is the default with more than one worker.
+# gunicorn has no sticky sessions, so HTTP long-polling would hit a worker
+# that does not know the Socket.IO session: clients connect over websocket
+# only, and with several workers the server refuses polling outright. The
+# websocket stays on the worker that accepted it. bench/check_message_queue.py
+# checks that an emit in one process reaches the other.
+# Singleton work - the scheduler and its interval jobs, the telemetry
+# collector, calibration, resuming downloads - runs only in the worker that
+# holds LEADER_LOCK_FILE. The others retry the lock every
+# LEADER_RETRY_SECONDS and take over when the leader dies, since the kernel
+# drops the lock with its process.
+WEB_WORKERS = int(os.environ.get('STREAMHIB_WORKERS', 1))
+MESSAGE_QUEUE = os.environ.get('STREAMHIB_MESSAGE_QUEUE') or ('state' if WEB_WORKERS > 1 else None)
+MESSAGE_QUEUE_POLL_SECONDS = 0.1
+MESSAGE_QUEUE_RETENTION_SECONDS = 60
+LEADER_LOCK_FILE = 'streamhib.leader.lock'
+LEADER_RETRY_SECONDS = 5
+
+_leader_lock = FileLock(LEADER_LOCK_FILE, thread_local=False)
+_is_leader = False
+
+class StateQueueManager(PubSubManager):
+    """Socket.IO pub/sub backend on the state database, for single-host deployments"""
+    name = 'state'
+
+    def _publish(self, data):
+        with state_transaction() as conn:
+            conn.execute(
+                'INSERT INTO socketio_messages (channel, created, data) VALUES (?, ?, ?)',
+                (self.channel, time.time(), json.dumps(data))
+            )
+
+    def _listen(self):
+        conn = get_state_db()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM socketio_messages').fetchone()[0]
+        pruned_at = time.time()
+        while True:
+            rows = conn.execute(
+                'SELECT id, data FROM socketio_messages WHERE id > ? AND channel = ? ORDER BY id',
+                (last_id, self.channel)
+            ).fetchall()
+            for message_id, data in rows:
+                last_id = message_id
+                yield json.loads(data)
+            if time.time() - pruned_at > MESSAGE_QUEUE_RETENTION_SECONDS:
+                pruned_at = time.time()
+                with state_transaction() as write_conn:
+                    write_conn.execute('DELETE FROM socketio_messages WHERE created < ?',
+                                       (pruned_at - MESSAGE_QUEUE_RETENTION_SECONDS,))
+            self.server.sleep(MESSAGE_QUEUE_POLL_SECONDS)
+
+def get_socketio_options():
+    """SocketIO keyword arguments for the configured message queue"""
+    options = {'transports': ['websocket']} if WEB_WORKERS > 1 else {}
+    if not MESSAGE_QUEUE:
+        return options
+    if MESSAGE_QUEUE == 'state':
+        return {**options, 'client_manager': StateQueueManager(channel='flask-socketio')}
+    return {**options, 'message_queue': MESSAGE_QUEUE}
+
+socketio = SocketIO(app, cors_allowed_origins="*", **get_socketio_options())
+
+def run_command(args, **kwargs):
+    """subprocess.run in a native thread when serving under eventlet, so the hub keeps running"""
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        if tpool is not None and socketio.async_mode == 'eventlet':
+            result = tpool.execute(subprocess.run, args, **kwargs)
+        else:
+            result = subprocess.run(args, **kwargs)
+        status = 'ok' if result.returncode == 0 else 'failed'
+        return result
+    finally:
+        record_subprocess(args, started, status)
+
+def record_subprocess(args, started, status):
+    """Count a finished subprocess by command and outcome"""
+    command = os.path.basename(str(args[0]))
+    if command == 'nice' and len(args) > 3:
+        command = os.path.basename(str(args[3]))
+    observe_metric('streamhib_subprocess_duration_seconds', (('command', command),), time.perf_counter() - started)
+    count_metric('streamhib_subprocess_calls_total', (('command', command), ('status', status)))
+
+def is_leader():
+    """Whether this worker runs the singleton background work"""
+    return _is_leader
+
+def try_become_leader():
+    """Take the leader lock without waiting"""
+    global _is_leader
+    if not _is_leader:
+        try:
+            _leader_lock.acquire(timeout=0)
+        except Timeout:
+            return False
+        _is_leader = True
+    return True
+
+def load_leader_snapshot(name, default=None):
+    """Read diagnostics the leader mirrors into the state store"""
+    snapshot = load_state_record('runtime', 'leader') or {}
+    return snapshot.get(name, default)
+
+# Event bus
+# Changes from the session store, video catalog, recovery and telemetry are
+# queued here and flushed to Socket.IO every EVENT_COALESCE_SECONDS. Keyed
+# changes to the same item within one window collapse into a single entry,
+# so a burst of 50 stream starts becomes one delta message per room.
+# Customers join their own `user:<name>` room, admins join `admin`.
+EVENT_COALESCE_SECONDS = 0.25
+ADMIN_ROOM = 'admin'
+ALL_CLIENTS_ROOM = 'clients'
+
+_pending_events = {}
+_event_lock = threading.Lock()
+_event_bus_started = False
+
+def get_user_room(username):
+    """Get the Socket.IO room of a customer"""
+    return f"user:{username}"
+
+def publish_delta(event, rooms, key, value, scope=None):
+    """Queue a keyed change; a value of None marks the key as removed"""
+    with _event_lock:
+        for room in rooms:
+            _pending_events.setdefault((room, event, scope), {})[key] = value
+
+def publish_snapshot(event, room, payload):
+    """Queue a whole payload, replacing any pending payload for the same event"""
+    with _event_lock:
+        _pending_events[(room, event, None)] = {None: payload}
+
+def publish_session_changes(changes):
+    """Queue (bucket, session_id, new_info, old_info) changes for the owners and admins"""
+    for bucket, session_id, new_info, old_info in changes:
+        owner = (new_info or old_info or {}).get('username')
+        rooms = [ADMIN_ROOM] + ([get_user_room(owner)] if owner else [])
+        publish_delta('sessions_delta', rooms, session_id, new_info, scope=bucket)
+
+def flush_events():
+    """Emit everything queued since the last flush"""
+    with _event_lock:
+        pending = dict(_pending_events)
+        _pending_events.clear()
+    
+    for (room, event, scope), changes in pending.items():
+        if None in changes:
+            payload = changes[None]
+        else:
+            payload = {
+                'upserted': {key: value for key, value in changes.items() if value is not None},
+                'removed': [key for key, value in changes.items() if value is None]
+            }
+            if scope is not None:
+                payload['bucket'] = scope
+        socketio.emit(event, payload, to=room)
+
+def _event_flush_loop():
+    """Flush queued events once per coalescing window"""
+    while True:
+        socketio.sleep(EVENT_COALESCE_SECONDS)
+        try:
+            flush_events()
+        except Exception as e:
+            log(f"EVENTS ERROR: Flush failed: {e}")
+
+def start_event_bus():
+    """Start the background flusher"""
+    global _event_bus_started
+    if not _event_bus_started:
+        _event_bus_started = True
+        socketio.start_background_task(_event_flush_loop)
+
+@socketio.on('connect')
+def handle_socket_connect():
+    """Put the connection into the rooms its login allows"""
+    if is_admin_logged_in() or is_customer_logged_in():
+        join_room(ALL_CLIENTS_ROOM)
+    if is_admin_logged_in():
+        join_room(ADMIN_ROOM)
+    if is_customer_logged_in():
+        join_room(get_user_room(session.get('username')))
+
+# Session index
+# Secondary indexes over the cached sessions document: by username, by state
+# bucket and by systemd service name. The index is built once per cached
+# version and patched in place by the per-session write helpers, so lookups
+# no longer scan every session. Only active sessions own a running service,
+# so the service index covers the active bucket.
+def get_service_name(session_id):
+    """Get the systemd service name for a session"""
+    return f"stream@{session_id[:8]}"
+
+def _index_add_session(index, bucket, session_id, session_info):
+    """Add a session to the index, caller holds _state_cache_lock"""
+    index['by_state'].setdefault(bucket, set()).add(session_id)
+    username = session_info.get('username')
+    index['by_user'].setdefault(username, {}).setdefault(bucket, set()).add(session_id)
+    if bucket == 'active_sessions':
+        index['by_service'].setdefault(get_service_name(session_id), set()).add(session_id)
+        if session_info.get('telemetry_port') is not None:
+            index['by_port'][session_info['telemetry_port']] = session_id
+
+def _index_remove_session(index, bucket, session_id, session_info):
+    """Remove a session from the index, caller holds _state_cache_lock"""
+    index['by_state'].get(bucket, set()).discard(session_id)
+    user_buckets = index['by_user'].get(session_info.get('username'), {})
+    user_buckets.get(bucket, set()).discard(session_id)
+    if bucket == 'active_sessions':
+        service_name = get_service_name(session_id)
+        owners = index['by_service'].get(service_name)
+        if owners is not None:
+            owners.discard(session_id)
+            if not owners:
+                del index['by_service'][service_name]
+        if index['by_port'].get(session_info.get('telemetry_port')) == session_id:
+            del index['by_port'][session_info['telemetry_port']]
+
+def _build_session_index(sessions_data):
+    """Build the secondary indexes for a sessions document"""
+    index = {'by_user': {}, 'by_state': {}, 'by_service': {}, 'by_port': {}}
+    for bucket, entries in sessions_data.items():
+        index['by_state'].setdefault(bucket, set())
+        for session_id, session_info in entries.items():
+            _index_add_session(index, bucket, session_id, session_info)
+    return index
+
+def _session_index_for(sessions_data):
+    """Get the index matching a sessions document, caller holds _state_cache_lock"""
+    entry = _state_cache.get('sessions')
+    if entry is None or entry['data'] is not sessions_data:
+        return _build_session_index(sessions_data)
+    if 'index' not in entry:
+        entry['index'] = _build_session_index(sessions_data)
+    return entry['index']
+
+def get_user_sessions(username, bucket='active_sessions'):
+    """Get a user's sessions in one bucket as read-only views"""
+    sessions_data = load_sessions(readonly=True)
+    with _state_cache_lock:
+        index = _session_index_for(sessions_data)
+        session_ids = list(index['by_user'].get(username, {}).get(bucket, ()))
+    bucket_data = sessions_data.get(bucket, {})
+    return {session_id: bucket_data[session_id] for session_id in session_ids if session_id in bucket_data}
+
+def get_sessions_for_service(service_name):
+    """Get the active session ids running under a systemd service name"""
+    sessions_data = load_sessions(readonly=True)
+    with _state_cache_lock:
+        index = _session_index_for(sessions_data)
+        return sorted(index['by_service'].get(service_name, ()))
+
+def get_active_service_names():
+    """Get the set of systemd service names owned by active sessions"""
+    sessions_data = load_sessions(readonly=True)
+    with _state_cache_lock:
+        return set(_session_index_for(sessions_data)['by_service'])
+
+def count_sessions(bucket):
+    """Count the sessions in one bucket"""
+    sessions_data = load_sessions(readonly=True)
+    with _state_cache_lock:
+        index = _session_index_for(sessions_data)
+        return len(index['by_state'].get(bucket, ()))
+
+def get_service_collisions():
+    """Get service names shared by more than one active session"""
+    sessions_data = load_sessions(readonly=True)
+    with _state_cache_lock:
+        index = _session_index_for(sessions_data)
+        return {
+            service_name: sorted(session_ids)
+            for service_name, session_ids in index['by_service'].items()
+            if len(session_ids) > 1
+        }
+
+init_state_store()
 
 def create_nginx_config(domain_name, ssl_enabled=False, port=5000):
     """Create nginx configuration for domain"""
@@ -195,19 +1019,19 @@ def create_nginx_config(domain_name, ssl_enabled=False, port=5000):
         os.symlink(config_path, enabled_path)
         
         # Test nginx config
-        result = subprocess.run(['nginx', '-t'], capture_output=True, text=True)
+        result = run_command(['nginx', '-t'], capture_output=True, text=True)
         if result.returncode != 0:
-            print(f"DOMAIN ERROR: Nginx config test failed: {result.stderr}")
+            log(f"DOMAIN ERROR: Nginx config test failed: {result.stderr}")
             return False
         
         # Reload nginx
-        subprocess.run(['systemctl', 'reload', 'nginx'], check=True)
+        run_systemctl('reload', 'nginx', check=True)
         
-        print(f"DOMAIN SUCCESS: Nginx configured for {domain_name} (SSL: {ssl_enabled})")
+        log(f"DOMAIN SUCCESS: Nginx configured for {domain_name} (SSL: {ssl_enabled})")
         return True
         
     except Exception as e:
-        print(f"DOMAIN ERROR: Failed to create nginx config: {e}")
+        log(f"DOMAIN ERROR: Failed to create nginx config: {e}")
         return False
 
 def remove_nginx_config(domain_name):
@@ -224,31 +1048,182 @@ def remove_nginx_config(domain_name):
             os.remove(config_path)
         
         # Reload nginx
-        subprocess.run(['systemctl', 'reload', 'nginx'], check=True)
+        run_systemctl('reload', 'nginx', check=True)
         
-        print(f"DOMAIN SUCCESS: Nginx config removed for {domain_name}")
+        log(f"DOMAIN SUCCESS: Nginx config removed for {domain_name}")
         return True
         
     except Exception as e:
-        print(f"DOMAIN ERROR: Failed to remove nginx config: {e}")
+        log(f"DOMAIN ERROR: Failed to remove nginx config: {e}")
         return False
 
+# Video catalog
+# VIDEOS_DIR is mirrored in memory. A refresh costs one stat of the directory
+# when nothing was added, renamed or removed; a full os.scandir pass runs when
+# the directory mtime changes and periodically to catch files rewritten in
+# place. Codec metadata is filled in by a background ffprobe pool, and
+# connected clients get `videos_update` when the set of files changes.
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm')
+CATALOG_RESCAN_SECONDS = 30
+CATALOG_SORT_FIELDS = ('name', 'size', 'mtime', 'duration', 'bit_rate', 'height')
+
+_video_catalog = {'dir_mtime_ns': None, 'scanned_at': 0.0, 'entries': {}}
+_catalog_lock = threading.Lock()
+_catalog_probe_pool = ThreadPoolExecutor(max_workers=2)
+
+def _catalog_entry(name, st):
+    """Build a catalog entry from a file's stat result"""
+    return {
+        'name': name,
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'inode': st.st_ino,
+        'probe_key': f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}",
+        'probed': False
+    }
+
+def _probe_catalog_entry(name, probe_key):
+    """Fill in codec metadata for a catalog entry"""
+    probe = probe_video(os.path.join(VIDEOS_DIR, name)) or {}
+    with _catalog_lock:
+        entry = _video_catalog['entries'].get(name)
+        if entry is not None and entry['probe_key'] == probe_key:
+            entry.update({
+                'duration': probe.get('duration', 0),
+                'video_codec': probe.get('video_codec'),
+                'audio_codec': probe.get('audio_codec'),
+                'width': probe.get('width', 0),
+                'height': probe.get('height', 0),
+                'fps': probe.get('fps', 0),
+                'bit_rate': probe.get('bit_rate', 0),
+                'probed': True
+            })
+
+def refresh_video_catalog(force=False):
+    """Bring the video catalog up to date, returns True if the file set changed"""
+    try:
+        dir_mtime_ns = os.stat(VIDEOS_DIR).st_mtime_ns
+    except OSError:
+        dir_mtime_ns = None
+    
+    with _catalog_lock:
+        if (not force and dir_mtime_ns == _video_catalog['dir_mtime_ns']
+                and time.time() - _video_catalog['scanned_at'] < CATALOG_RESCAN_SECONDS):
+            return False
+        old_entries = _video_catalog['entries']
+    
+    entries = {}
+    if dir_mtime_ns is not None:
+        with os.scandir(VIDEOS_DIR) as it:
+            for dir_entry in it:
+                if dir_entry.name.lower().endswith(VIDEO_EXTENSIONS) and dir_entry.is_file():
+                    entry = _catalog_entry(dir_entry.name, dir_entry.stat())
+                    previous = old_entries.get(dir_entry.name)
+                    if previous is not None and previous['probe_key'] == entry['probe_key']:
+                        entry = previous
+                    entries[dir_entry.name] = entry
+    
+    with _catalog_lock:
+        _video_catalog.update({'dir_mtime_ns': dir_mtime_ns, 'scanned_at': time.time(), 'entries': entries})
+    
+    for name, entry in entries.items():
+        if not entry['probed'] and old_entries.get(name) is not entry:
+            _catalog_probe_pool.submit(_probe_catalog_entry, name, entry['probe_key'])
+    
+    added = set(entries) - set(old_entries)
+    removed = set(old_entries) - set(entries)
+    # A rename keeps the inode and so the probe key, only drop keys no file has
+    stale_keys = {old_entries[name]['probe_key'] for name in removed} - {entry['probe_key'] for entry in entries.values()}
+    for probe_key in stale_keys:
+        delete_state_record('video_probes', probe_key)
+        with _probe_cache_lock:
+            _probe_cache.pop(probe_key, None)
+    for name in added:
+        publish_delta('videos_delta', [ALL_CLIENTS_ROOM], name, entries[name])
+    for name in removed:
+        publish_delta('videos_delta', [ALL_CLIENTS_ROOM], name, None)
+    if added or removed:
+        publish_disk_usage()
+    return bool(added or removed)
+
+def register_video_file(video_file):
+    """Add or update a single file in the catalog without a directory rescan
+
+    If the file's arrival is the newest change to VIDEOS_DIR and nothing else
+    touched the directory meanwhile, the catalog's directory mtime moves to
+    it, so the next refresh does not rescan just for this file. Changes that
+    came before it are still picked up by the periodic rescan.
+    """
+    try:
+        with _catalog_lock:
+            dir_before = os.stat(VIDEOS_DIR).st_mtime_ns
+            st = os.stat(os.path.join(VIDEOS_DIR, video_file))
+            entry = _catalog_entry(video_file, st)
+            entries = dict(_video_catalog['entries'])
+            entries[video_file] = entry
+            _video_catalog['entries'] = entries
+            dir_after = os.stat(VIDEOS_DIR).st_mtime_ns
+            if dir_before == dir_after == st.st_ctime_ns:
+                _video_catalog['dir_mtime_ns'] = dir_after
+        _catalog_probe_pool.submit(_probe_catalog_entry, video_file, entry['probe_key'])
+        publish_delta('videos_delta', [ALL_CLIENTS_ROOM], video_file, entry)
+        publish_disk_usage()
+    except Exception as e:
+        log(f"Error registering video {video_file}: {e}")
+
+def get_disk_usage():
+    """Get disk usage of the videos volume"""
+    usage = shutil.disk_usage(VIDEOS_DIR)
+    percent_used = round(usage.used * 100 / usage.total, 1) if usage.total else 0
+    return {
+        'status': 'Full' if percent_used >= 95 else 'Almost Full' if percent_used >= 80 else 'Normal',
+        'total': usage.total,
+        'used': usage.used,
+        'free': usage.free,
+        'percent_used': percent_used
+    }
+
+def publish_disk_usage():
+    """Queue the current disk usage for every client"""
+    try:
+        publish_snapshot('disk_usage_update', ALL_CLIENTS_ROOM, {'disk_usage': get_disk_usage()})
+    except OSError as e:
+        log(f"Error getting disk usage: {e}")
+
 def get_video_files():
     """Get list of video files"""
     try:
-        video_extensions = ['.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm']
-        video_files = []
-        
-        if os.path.exists(VIDEOS_DIR):
-            for file in os.listdir(VIDEOS_DIR):
-                if any(file.lower().endswith(ext) for ext in video_extensions):
-                    video_files.append(file)
-        
-        return sorted(video_files)
+        refresh_video_catalog()
+        with _catalog_lock:
+            return sorted(_video_catalog['entries'])
     except Exception as e:
-        print(f"Error getting video files: {e}")
+        log(f"Error getting video files: {e}")
         return []
 
+def query_video_catalog(sort='name', order='asc', search=None, extension=None, page=None, per_page=50):
+    """Sort, filter and optionally paginate the video catalog"""
+    refresh_video_catalog()
+    with _catalog_lock:
+        items = [dict(entry) for entry in _video_catalog['entries'].values()]
+    
+    if search:
+        items = [item for item in items if search.lower() in item['name'].lower()]
+    if extension:
+        suffix = extension.lower() if extension.startswith('.') else f".{extension.lower()}"
+        items = [item for item in items if item['name'].lower().endswith(suffix)]
+    
+    sort_field = sort if sort in CATALOG_SORT_FIELDS else 'name'
+    if sort_field == 'name':
+        items.sort(key=lambda item: item['name'].lower(), reverse=(order == 'desc'))
+    else:
+        items.sort(key=lambda item: (item.get(sort_field) or 0, item['name']), reverse=(order == 'desc'))
+    
+    total = len(items)
+    if page is not None:
+        per_page = max(1, min(per_page, 500))
+        items = items[(page - 1) * per_page:page * per_page]
+    return items, total
+
 def hash_password(password):
     """Hash password using SHA256"""
     return hashlib.sha256(password.encode()).hexdigest()
@@ -264,182 +1239,3270 @@ def is_customer_logged_in():
 def get_stats():
     """Get system statistics"""
     try:
-        sessions_data = load_sessions()
-        users_data = load_users()
+        users_data = load_users(readonly=True)
         video_files = get_video_files()
         
         stats = {
             'total_users': len(users_data),
-            'active_sessions': len(sessions_data.get('active_sessions', {})),
-            'inactive_sessions': len(sessions_data.get('inactive_sessions', {})),
-            'scheduled_sessions': len(sessions_data.get('scheduled_sessions', {})),
-            'total_videos': len(video_files)
+            'active_sessions': count_sessions('active_sessions'),
+            'inactive_sessions': count_sessions('inactive_sessions') + count_archived_sessions(),
+            'scheduled_sessions': count_sessions('scheduled_sessions'),
+            'total_videos': len(video_files),
+            'service_collisions': len(get_service_collisions())
         }
         
         return stats
     except Exception as e:
-        print(f"Error getting stats: {e}")
+        log(f"Error getting stats: {e}")
         return {
             'total_users': 0,
             'active_sessions': 0,
             'inactive_sessions': 0,
             'scheduled_sessions': 0,
-            'total_videos': 0
+            'total_videos': 0,
+            'service_collisions': 0
         }
 
-def recovery_orphaned_sessions():
-    """Recovery function for orphaned sessions"""
+# Session archive
+# Inactive sessions that ended more than INACTIVE_RETENTION_DAYS ago move out
+# of the sessions document into gzip-compressed JSONL segments in ARCHIVE_DIR,
+# at most ARCHIVE_SEGMENT_RECORDS per file, oldest first. A segment is fully
+# written and renamed into place before one transaction deletes its sessions
+# and adds its entry (record count, ended_at range, users, end reasons) to the
+# `archive_index` document; a crash in between leaves an unindexed file that
+# the next run removes. History is paged newest first by (ended_at, session
+# id) and only reads segments the index says can hold matches, line by line.
+ARCHIVE_DIR = os.environ.get('STREAMHIB_ARCHIVE_DIR', 'archive')
+INACTIVE_RETENTION_DAYS = float(os.environ.get('STREAMHIB_INACTIVE_RETENTION_DAYS', 7))
+ARCHIVE_SEGMENT_RECORDS = 5000
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 500
+
+archive_lock = FileLock('streamhib.archive.lock', thread_local=False)  # one compaction across all workers
+
+def load_archive_index():
+    """Get the archive segment index, keyed by file name"""
+    return load_state_document('archive_index', {}, readonly=True)
+
+def count_archived_sessions():
+    """Count the sessions stored in archive segments"""
+    return sum(entry['records'] for entry in load_archive_index().values())
+
+def _history_key(session_id, session_info):
+    """Sort key of a finished session: (ended_at, session id)"""
+    return (session_info.get('ended_at') or '', session_id)
+
+def _write_archive_segment(batch):
+    """Write (session_id, session_info) pairs to a new segment and drop them from the state store"""
+    name = f"inactive-{datetime.now(jakarta_tz).strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.jsonl.gz"
+    path = os.path.join(ARCHIVE_DIR, name)
+    with open(f"{path}.tmp", 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            for session_id, session_info in batch:
+                f.write((json.dumps(dict(_thaw(session_info), id=session_id)) + '\n').encode('utf-8'))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(f"{path}.tmp", path)
+
+    entry = {
+        'records': len(batch),
+        'first_ended_at': _history_key(*batch[0])[0],
+        'last_ended_at': _history_key(*batch[-1])[0],
+        'users': sorted({info.get('username', '') for _, info in batch}),
+        'end_reasons': sorted({info.get('end_reason', '') for _, info in batch}),
+        'bytes': os.path.getsize(path),
+        'created_at': datetime.now(jakarta_tz).isoformat()
+    }
+    with sessions_lock:
+        with state_transaction() as conn:
+            conn.executemany(
+                'DELETE FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+                [('sessions', 'inactive_sessions', session_id) for session_id, _ in batch]
+            )
+            version = _bump_document_version(conn, 'sessions')
+            conn.execute(
+                'INSERT OR REPLACE INTO state_records (doc, bucket, key, data) VALUES (?, ?, ?, ?)',
+                ('archive_index', '', name, json.dumps(entry))
+            )
+            _bump_document_version(conn, 'archive_index')
+    _patch_cached_document('sessions', version, [('inactive_sessions', session_id, None) for session_id, _ in batch])
+    with _state_cache_lock:
+        _state_cache.pop('archive_index', None)
+    return name
+
+def compact_inactive_sessions():
+    """Move inactive sessions past the retention window into archive segments"""
+    try:
+        archive_lock.acquire(timeout=0)
+    except Timeout:
+        log("ARCHIVE: Another compaction is in progress, skipping")
+        return 0
+    try:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        index = load_archive_index()
+        for name in os.listdir(ARCHIVE_DIR):
+            if name.startswith('inactive-') and name not in index:
+                os.remove(os.path.join(ARCHIVE_DIR, name))
+                log(f"ARCHIVE: Removed uncommitted segment {name}")
+
+        cutoff = (datetime.now(jakarta_tz) - timedelta(days=INACTIVE_RETENTION_DAYS)).isoformat()
+        inactive_sessions = load_sessions(readonly=True).get('inactive_sessions', {})
+        expired = sorted(
+            (item for item in inactive_sessions.items() if _history_key(*item)[0] < cutoff),
+            key=lambda item: _history_key(*item)
+        )
+        segments = [
+            _write_archive_segment(expired[start:start + ARCHIVE_SEGMENT_RECORDS])
+            for start in range(0, len(expired), ARCHIVE_SEGMENT_RECORDS)
+        ]
+        if segments:
+            log(f"ARCHIVE: Moved {len(expired)} inactive sessions into {', '.join(segments)}")
+        return len(expired)
+    except Exception as e:
+        log(f"ARCHIVE ERROR: Compaction failed: {e}")
+        return 0
+    finally:
+        archive_lock.release()
+
+def encode_history_cursor(key):
+    """Opaque cursor pointing after a (ended_at, session id) key"""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+def decode_history_cursor(cursor):
+    """Key of a cursor made by encode_history_cursor, ValueError if malformed"""
+    try:
+        ended_at, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return (str(ended_at), str(session_id))
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def query_session_history(username=None, end_reason=None, since=None, until=None, cursor=None, limit=HISTORY_PAGE_SIZE):
+    """One page of finished sessions, newest first, from the state store and the archive
+
+    `since` and `until` are ISO dates or timestamps compared against ended_at,
+    both inclusive. Returns (items, next_cursor); next_cursor is None on the
+    last page.
+    """
+    after = decode_history_cursor(cursor) if cursor else None
+    page = []  # min-heap of the best limit + 1 (key, seq, session_info) so far
+    seq = itertools.count()
+
+    def offer(session_id, session_info):
+        key = _history_key(session_id, session_info)
+        if after is not None and key >= after:
+            return
+        if username is not None and session_info.get('username') != username:
+            return
+        if end_reason is not None and session_info.get('end_reason') != end_reason:
+            return
+        if (since and key[0] < since) or (until and key[0][:len(until)] > until):
+            return
+        if len(page) <= limit:
+            heapq.heappush(page, (key, next(seq), session_info))
+        elif key > page[0][0]:
+            heapq.heapreplace(page, (key, next(seq), session_info))
+
+    for session_id, session_info in load_sessions(readonly=True).get('inactive_sessions', {}).items():
+        offer(session_id, session_info)
+
+    segments = sorted(load_archive_index().items(), key=lambda item: item[1]['last_ended_at'], reverse=True)
+    for name, entry in segments:
+        if len(page) > limit and entry['last_ended_at'] < page[0][0][0]:
+            break  # every later segment ends even earlier
+        if ((after is not None and entry['first_ended_at'] > after[0])
+                or (since and entry['last_ended_at'] < since)
+                or (until and entry['first_ended_at'][:len(until)] > until)
+                or (username is not None and username not in entry['users'])
+                or (end_reason is not None and end_reason not in entry['end_reasons'])):
+            continue
+        with gzip.open(os.path.join(ARCHIVE_DIR, name), 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                offer(record.pop('id'), record)
+
+    ordered = sorted(page, key=lambda item: item[0], reverse=True)
+    items = [dict(_thaw(session_info), id=key[1]) for key, _, session_info in ordered[:limit]]
+    next_cursor = encode_history_cursor(ordered[limit - 1][0]) if len(ordered) > limit else None
+    return items, next_cursor
+
+# Downloads
+# Videos are fetched by a small pool of download workers fed from a bounded
+# queue. When the server honours Range requests a file is split into chunks
+# fetched over several connections and written in place with pwrite; a JSON
+# sidecar next to the temp file records the finished chunks so an
+# interrupted download (or a restart) resumes instead of starting over.
+# Finished files are checksummed and renamed atomically into VIDEOS_DIR.
+# Google Drive links and bare file ids go through GDRIVE_DOWNLOAD_URL, which
+# can be pointed at a local stand-in server. Jobs run in the worker that
+# queued them but are listed in the `downloads` document, so any worker can
+# show, cancel or retry them; a lock file per job keeps two workers from
+# running the same download.
+# Downloads only go to public addresses: the host is resolved and checked
+# when a job is queued, and every connection (redirects and chunk requests
+# included) checks the address it actually reached, so DNS rebinding cannot
+# point a job at loopback services such as /metrics or the LAN.
+# STREAMHIB_DOWNLOAD_ALLOW_PRIVATE=1 lifts this for local stand-in servers.
+DOWNLOAD_DIR = os.path.join(VIDEOS_DIR, '.downloads')
+DOWNLOAD_WORKERS = int(os.environ.get('STREAMHIB_DOWNLOAD_WORKERS', 2))
+DOWNLOAD_QUEUE_LIMIT = int(os.environ.get('STREAMHIB_DOWNLOAD_QUEUE_LIMIT', 20))
+DOWNLOAD_CONNECTIONS = int(os.environ.get('STREAMHIB_DOWNLOAD_CONNECTIONS', 4))
+DOWNLOAD_CHUNK_BYTES = 16 * 1024 * 1024
+DOWNLOAD_READ_BYTES = 256 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_CANCEL_POLL_SECONDS = 1
+DOWNLOAD_HISTORY_DAYS = 7
+GDRIVE_DOWNLOAD_URL = os.environ.get(
+    'STREAMHIB_GDRIVE_URL', 'https://drive.usercontent.google.com/download?id={file_id}&export=download&confirm=t'
+)
+
+DOWNLOAD_ALLOW_PRIVATE = os.environ.get('STREAMHIB_DOWNLOAD_ALLOW_PRIVATE') == '1'
+
+_download_queue = queue.Queue(maxsize=DOWNLOAD_QUEUE_LIMIT)
+_download_jobs = {}
+_download_lock = threading.Lock()
+_download_workers_started = False
+_cancel_checked_at = {}
+
+def check_public_address(address, host):
+    """Raise ValueError unless an IP address is publicly routable"""
+    if DOWNLOAD_ALLOW_PRIVATE:
+        return
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if getattr(ip, 'ipv4_mapped', None):
+        ip = ip.ipv4_mapped
+    if not ip.is_global or ip.is_multicast:
+        raise ValueError(f"Refusing to download from {host}: {ip} is not a public address")
+
+def check_public_host(host):
+    """Resolve a host name and check every address it resolves to"""
+    if not host:
+        raise ValueError('Download URL has no host')
+    try:
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise ValueError(f"Cannot resolve {host}: {e}")
+    for info in infos:
+        check_public_address(info[4][0], host)
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    def connect(self):
+        super().connect()
+        check_public_address(self.sock.getpeername()[0], self.host)
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    def connect(self):
+        super().connect()
+        check_public_address(self.sock.getpeername()[0], self.host)
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req, context=self._context)
+
+# No proxies: the address checked must be the one the download comes from
+_download_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}), _PublicHTTPHandler, _PublicHTTPSHandler)
+
+def resolve_download_url(source):
+    """Turn a Google Drive link, a Drive file id or an HTTP URL into a download URL"""
+    source = source.strip()
+    parsed = urllib.parse.urlparse(source)
+    if parsed.scheme in ('http', 'https') and not parsed.netloc.endswith(('drive.google.com', 'docs.google.com')):
+        check_public_host(parsed.hostname)
+        return source
+    
+    if parsed.scheme:
+        file_id = urllib.parse.parse_qs(parsed.query).get('id', [None])[0]
+        if file_id is None and '/d/' in parsed.path:
+            file_id = parsed.path.split('/d/', 1)[1].split('/')[0]
+    else:
+        file_id = source
+    if not file_id or not all(c.isalnum() or c in '-_' for c in file_id):
+        raise ValueError(f"Unrecognized Google Drive link: {source}")
+    return GDRIVE_DOWNLOAD_URL.format(file_id=urllib.parse.quote(file_id))
+
+def _download_filename(response, url):
+    """Pick a safe file name from Content-Disposition or the URL"""
+    name = None
+    disposition = response.headers.get('Content-Disposition', '')
+    for part in disposition.split(';'):
+        key, _, value = part.strip().partition('=')
+        if key.lower() == "filename*" and "''" in value:
+            name = urllib.parse.unquote(value.split("''", 1)[1])
+        elif key.lower() == 'filename' and name is None:
+            name = value.strip('"')
+    if not name:
+        name = urllib.parse.unquote(os.path.basename(urllib.parse.urlparse(url).path))
+    return secure_filename(name)
+
+def _unique_video_name(filename):
+    """Avoid overwriting an existing video"""
+    stem, ext = os.path.splitext(filename)
+    candidate, n = filename, 1
+    while os.path.exists(os.path.join(VIDEOS_DIR, candidate)):
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    return candidate
+
+def _open_url(url, byte_range=None):
+    """Open a URL, optionally for a byte range"""
+    headers = {'User-Agent': 'StreamHib'}
+    if byte_range is not None:
+        headers['Range'] = f"bytes={byte_range[0]}-{byte_range[1]}"
+    return _download_opener.open(urllib.request.Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT)
+
+def probe_download(url):
+    """Find the name, size, validator and range support of a remote file"""
+    with _open_url(url, (0, 0)) as response:
+        if response.headers.get_content_type() == 'text/html':
+            raise RuntimeError('Server returned a web page instead of a file (is the file shared publicly?)')
+        
+        info = {
+            'filename': _download_filename(response, response.geturl()),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'ranged': False,
+            'size': None
+        }
+        content_range = response.headers.get('Content-Range', '')
+        if response.status == 206 and '/' in content_range and not content_range.endswith('/*'):
+            info['ranged'] = True
+            info['size'] = int(content_range.rsplit('/', 1)[1])
+        elif response.headers.get('Content-Length'):
+            info['size'] = int(response.headers['Content-Length'])
+        return info
+
+def _sidecar_path(job_id):
+    return os.path.join(DOWNLOAD_DIR, f"{job_id}.json")
+
+def _part_path(job_id):
+    return os.path.join(DOWNLOAD_DIR, f"{job_id}.part")
+
+def _save_sidecar(job):
+    """Persist the resumable state of a download"""
+    temp_path = f"{_sidecar_path(job['id'])}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(temp_path, _sidecar_path(job['id']))
+
+def _job_lock_path(job_id):
+    return os.path.join(DOWNLOAD_DIR, f"{job_id}.lock")
+
+def _job_lock(job_id):
+    return FileLock(_job_lock_path(job_id))
+
+def _load_sidecar(job_id):
+    try:
+        with open(_sidecar_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _remove_download_files(job_id):
+    for path in (_sidecar_path(job_id), _part_path(job_id)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _publish_download(job):
+    """Queue a progress update for the job owner and admins"""
+    with _download_lock:
+        snapshot = {key: value for key, value in job.items() if key != 'chunks_done'}
+    size = snapshot.get('size')
+    snapshot['progress'] = round(snapshot['downloaded'] * 100 / size, 1) if size else None
+    rooms = [ADMIN_ROOM] + ([get_user_room(job['username'])] if job.get('username') else [])
+    publish_delta('download_progress', rooms, job['id'], snapshot)
+
+def _save_download_record(job):
+    """Store the job's status where every worker can see it"""
+    with _download_lock:
+        record = {key: value for key, value in job.items() if key not in ('chunks_done', 'cancelled')}
+    save_state_record('downloads', job['id'], record)
+
+def _check_cancelled(job):
+    """Raise if the job was cancelled, here or (checked every second) in another worker"""
+    if not job.get('cancelled'):
+        now = time.monotonic()
+        with _download_lock:
+            due = now - _cancel_checked_at.get(job['id'], 0) >= DOWNLOAD_CANCEL_POLL_SECONDS
+            if due:
+                _cancel_checked_at[job['id']] = now
+        if due and load_state_record('download_cancels', job['id']):
+            job['cancelled'] = True
+    if job.get('cancelled'):
+        raise RuntimeError('Download cancelled')
+
+def _add_download_progress(job, nbytes, reset=False):
+    """Count received bytes, starting again from zero when reset"""
+    with _download_lock:
+        job['downloaded'] = (0 if reset else job['downloaded']) + nbytes
+
+def _fetch_chunk(job, fd, index):
+    """Fetch one chunk with Range requests, resuming within the chunk on errors"""
+    start = index * DOWNLOAD_CHUNK_BYTES
+    end = min(start + DOWNLOAD_CHUNK_BYTES, job['size']) - 1
+    offset = start
+    for attempt in range(DOWNLOAD_RETRIES):
+        _check_cancelled(job)
+        try:
+            with _open_url(job['url'], (offset, end)) as response:
+                if response.status != 206:
+                    raise RuntimeError(f"Server ignored the byte range (HTTP {response.status})")
+                while offset <= end:
+                    _check_cancelled(job)
+                    block = response.read(min(DOWNLOAD_READ_BYTES, end + 1 - offset))
+                    if not block:
+                        break
+                    os.pwrite(fd, block, offset)
+                    offset += len(block)
+                    _add_download_progress(job, len(block))
+                    _publish_download(job)
+            if offset > end:
+                return
+            raise RuntimeError(f"Connection closed at byte {offset} of chunk {index}")
+        except (OSError, RuntimeError) as e:
+            if job.get('cancelled') or attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            log(f"DOWNLOAD: Retrying chunk {index} of {job['id'][:8]} after error: {e}", job_id=job['id'])
+            time.sleep(2 ** attempt)
+
+def _download_ranged(job):
+    """Download the missing chunks of a job over parallel connections"""
+    chunk_count = (job['size'] + DOWNLOAD_CHUNK_BYTES - 1) // DOWNLOAD_CHUNK_BYTES
+    done = set(job['chunks_done'])
+    pending = [i for i in range(chunk_count) if i not in done]
+    
+    fd = os.open(_part_path(job['id']), os.O_RDWR | os.O_CREAT, 0o644)
     try:
-        print("RECOVERY: Starting orphaned session recovery...")
+        os.ftruncate(fd, job['size'])
         
-        sessions_data = load_sessions()
-        active_sessions = sessions_data.get('active_sessions', {})
+        def fetch(index):
+            _fetch_chunk(job, fd, index)
+            with _download_lock:
+                job['chunks_done'].append(index)
+                _save_sidecar(job)
+            _save_download_record(job)
+        
+        with ThreadPoolExecutor(max_workers=max(1, DOWNLOAD_CONNECTIONS)) as pool:
+            try:
+                for future in [pool.submit(fetch, index) for index in pending]:
+                    future.result()
+            except BaseException:
+                # Drop the queued chunks, the running ones finish before fd is closed
+                pool.shutdown(wait=True, cancel_futures=True)
+                raise
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _download_stream(job):
+    """Download a job over one connection when ranges are not supported"""
+    for attempt in range(DOWNLOAD_RETRIES):
+        _add_download_progress(job, 0, reset=True)
+        try:
+            with _open_url(job['url']) as response, open(_part_path(job['id']), 'wb') as f:
+                while True:
+                    _check_cancelled(job)
+                    block = response.read(DOWNLOAD_READ_BYTES)
+                    if not block:
+                        break
+                    f.write(block)
+                    _add_download_progress(job, len(block))
+                    _publish_download(job)
+                f.flush()
+                os.fsync(f.fileno())
+            if job['size'] is not None and job['downloaded'] != job['size']:
+                raise RuntimeError(f"Received {job['downloaded']} of {job['size']} bytes")
+            return
+        except (OSError, RuntimeError) as e:
+            if job.get('cancelled') or attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            log(f"DOWNLOAD: Restarting {job['id'][:8]} after error: {e}", job_id=job['id'])
+            time.sleep(2 ** attempt)
+
+def file_sha256(path):
+    """SHA-256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def run_download(job):
+    """Fetch, verify and publish one download job"""
+    job_lock = _job_lock(job['id'])
+    try:
+        job_lock.acquire(timeout=0)
+    except Timeout:
+        log(f"DOWNLOAD: {job['id'][:8]} is already running in another worker", job_id=job['id'])
+        return
+    try:
+        _check_cancelled(job)
+        job['status'] = 'running'
+        remote = probe_download(job['url'])
+        if job.get('size') is not None and (remote['size'], remote['etag']) != (job['size'], job.get('etag')):
+            log(f"DOWNLOAD: Remote file of {job['id'][:8]} changed, restarting from zero", job_id=job['id'])
+            job['chunks_done'] = []
+        job.update({'size': remote['size'], 'etag': remote['etag'], 'ranged': remote['ranged']})
+        if job['ranged'] and job['size']:
+            # Bytes of unfinished chunks are fetched again
+            job['downloaded'] = sum(min(DOWNLOAD_CHUNK_BYTES, job['size'] - i * DOWNLOAD_CHUNK_BYTES)
+                                    for i in job['chunks_done'])
+        job.setdefault('filename', remote['filename'])
+        if not job['filename'].lower().endswith(VIDEO_EXTENSIONS):
+            raise RuntimeError(f"Not a supported video file: {job['filename'] or 'unknown name'}")
+        _save_sidecar(job)
+        _save_download_record(job)
+        _publish_download(job)
         
-        recovered_count = 0
-        moved_to_inactive = 0
+        if job['ranged'] and job['size']:
+            _download_ranged(job)
+        else:
+            _download_stream(job)
         
-        for session_id, session_info in list(active_sessions.items()):
+        job['status'] = 'verifying'
+        _save_download_record(job)
+        _publish_download(job)
+        checksum = file_sha256(_part_path(job['id']))
+        if job.get('expected_sha256') and checksum != job['expected_sha256'].lower():
+            job['chunks_done'] = []
+            raise RuntimeError(f"Checksum mismatch: expected {job['expected_sha256']}, got {checksum}")
+        
+        final_name = _unique_video_name(job['filename'])
+        os.replace(_part_path(job['id']), os.path.join(VIDEOS_DIR, final_name))
+        register_video_file(final_name)
+        _remove_download_files(job['id'])
+        job.update({'status': 'done', 'filename': final_name, 'sha256': checksum,
+                    'finished_at': datetime.now(jakarta_tz).isoformat()})
+        log(f"DOWNLOAD: Saved {final_name} ({job['downloaded']} bytes)")
+        
+    except Exception as e:
+        job.update({'status': 'cancelled' if job.get('cancelled') else 'failed', 'error': str(e)})
+        log(f"DOWNLOAD ERROR: {job['id'][:8]} failed: {e}", job_id=job['id'])
+        if job.get('cancelled') or not job.get('ranged'):
+            _remove_download_files(job['id'])
+            job['chunks_done'] = []
+        elif os.path.exists(_sidecar_path(job['id'])):
+            _save_sidecar(job)
+    finally:
+        job_lock.release()
+        if job['status'] in ('done', 'cancelled') and os.path.exists(_job_lock_path(job['id'])):
+            os.remove(_job_lock_path(job['id']))
+        with _download_lock:
+            _cancel_checked_at.pop(job['id'], None)
+        _save_download_record(job)
+        _publish_download(job)
+
+def _download_worker_loop():
+    while True:
+        job = _download_queue.get()
+        try:
+            if not job.get('cancelled'):
+                run_download(job)
+        finally:
+            _download_queue.task_done()
+
+def start_download_workers():
+    """Start the download worker threads once"""
+    global _download_workers_started
+    with _download_lock:
+        if _download_workers_started:
+            return
+        _download_workers_started = True
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    for _ in range(max(1, DOWNLOAD_WORKERS)):
+        threading.Thread(target=_download_worker_loop, daemon=True).start()
+
+def enqueue_download(source, username=None, expected_sha256=None, job=None):
+    """Queue a download, raises queue.Full when the queue is at its limit"""
+    if job is None:
+        job = {
+            'id': str(uuid.uuid4()),
+            'username': username,
+            'source': source,
+            'url': resolve_download_url(source),
+            'expected_sha256': expected_sha256,
+            'status': 'queued',
+            'downloaded': 0,
+            'size': None,
+            'chunks_done': [],
+            'created_at': datetime.now(jakarta_tz).isoformat()
+        }
+    job['status'] = 'queued'
+    job.pop('error', None)
+    start_download_workers()
+    _download_queue.put_nowait(job)
+    with _download_lock:
+        _download_jobs[job['id']] = job
+    _save_download_record(job)
+    _publish_download(job)
+    return job
+
+def prune_download_history():
+    """Forget finished jobs older than DOWNLOAD_HISTORY_DAYS"""
+    cutoff = datetime.now(jakarta_tz) - timedelta(days=DOWNLOAD_HISTORY_DAYS)
+    for job_id, job in list(load_state_document('downloads', {}, readonly=True).items()):
+        if job.get('status') in ('done', 'failed', 'cancelled') and datetime.fromisoformat(job['created_at']) < cutoff:
+            delete_state_record('downloads', job_id)
+            delete_state_record('download_cancels', job_id)
+
+def resume_pending_downloads():
+    """Re-queue downloads interrupted by a restart"""
+    prune_download_history()
+    if not os.path.isdir(DOWNLOAD_DIR):
+        return 0
+    resumed = 0
+    for name in sorted(os.listdir(DOWNLOAD_DIR)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(DOWNLOAD_DIR, name)) as f:
+                job = json.load(f)
+            if job.get('status') in ('done', 'cancelled'):
+                continue
+            job_lock = _job_lock(job['id'])
             try:
-                service_name = f"stream-{session_id[:8]}"
-                
-                # Check if systemd service exists and is active
-                result = subprocess.run(
-                    ['systemctl', 'is-active', service_name],
-                    capture_output=True,
-                    text=True
-                )
-                
-                if result.returncode != 0:  # Service not active
-                    print(f"RECOVERY: Found orphaned session {session_id[:8]}...")
-                    
-                    # Check if video file exists
-                    video_path = os.path.join(VIDEOS_DIR, session_info.get('video_file', ''))
-                    
-                    if os.path.exists(video_path):
-                        # Try to recover the session
-                        username = session_info.get('username', 'unknown')
-                        video_file = session_info.get('video_file', '')
-                        
-                        # Create systemd service
-                        service_content = f"""[Unit]
-Description=StreamHib Session {session_id[:8]}
-After=network.target
+                job_lock.acquire(timeout=0)
+            except Timeout:
+                continue  # still running in another worker
+            job_lock.release()
+            enqueue_download(job['source'], job=job)
+            resumed += 1
+        except queue.Full:
+            break
+        except Exception as e:
+            log(f"DOWNLOAD ERROR: Cannot resume {name}: {e}")
+    if resumed:
+        log(f"DOWNLOAD: Resumed {resumed} interrupted downloads")
+    return resumed
 
-[Service]
-Type=simple
-ExecStart=/usr/bin/ffmpeg -re -i "{video_path}" -c:v libx264 -preset veryfast -maxrate 3000k -bufsize 6000k -pix_fmt yuv420p -g 50 -c:a aac -b:a 160k -ac 2 -ar 44100 -f flv rtmp://a.rtmp.youtube.com/live2/{session_info.get('stream_key', '')}
-Restart=always
-User=root
+def get_download_jobs(username=None):
+    """Get download jobs, optionally only those of one user"""
+    jobs = [_thaw(job) for job in load_state_document('downloads', {}, readonly=True).values()
+            if username is None or job.get('username') == username]
+    return sorted(jobs, key=lambda job: job['created_at'], reverse=True)
+
+# Uploads
+# A tus-style upload protocol: POST creates an upload for a declared length,
+# PATCH appends the request body at Upload-Offset, HEAD reports the offset to
+# resume from after a dropped connection. Bodies are copied from the WSGI
+# stream to disk in UPLOAD_CHUNK_BYTES pieces and never held in memory. The
+# offset is simply the size of the partial file, so uploads resume across
+# restarts too. An upload expires UPLOAD_EXPIRE_SECONDS after its last
+# write (Upload-Expires); a periodic sweep deletes expired uploads so their
+# remaining length stops counting against the free space check.
+UPLOAD_DIR = os.path.join(VIDEOS_DIR, '.uploads')
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_MAX_CONCURRENT = int(os.environ.get('STREAMHIB_UPLOAD_MAX_CONCURRENT', 3))
+UPLOAD_MIN_FREE_BYTES = 1024 * 1024 * 1024  # keep this much free after all pending uploads
+UPLOAD_EXPIRE_SECONDS = int(os.environ.get('STREAMHIB_UPLOAD_EXPIRE', 24 * 3600))
+TUS_HEADERS = {'Tus-Resumable': '1.0.0'}
+
+# File locks so the limits hold across workers
+_upload_lock = FileLock(f"{UPLOAD_DIR}.lock")
+
+def _upload_meta_path(upload_id):
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.json")
+
+def _upload_part_path(upload_id):
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.part")
+
+def _upload_lock_path(upload_id):
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.lock")
+
+def lock_upload(upload_id):
+    """Take an upload's lock without waiting, None if another request holds it"""
+    lock = FileLock(_upload_lock_path(upload_id))
+    try:
+        lock.acquire(timeout=0)
+    except Timeout:
+        return None
+    return lock
+
+def unlock_upload(upload_id, lock):
+    """Release an upload's lock, removing the lock file once the upload is gone"""
+    lock.release()
+    if not os.path.exists(_upload_meta_path(upload_id)) and os.path.exists(_upload_lock_path(upload_id)):
+        os.remove(_upload_lock_path(upload_id))
+
+def acquire_upload_slot():
+    """Take one of the UPLOAD_MAX_CONCURRENT slots, None if all are busy"""
+    for index in range(max(1, UPLOAD_MAX_CONCURRENT)):
+        slot = FileLock(os.path.join(UPLOAD_DIR, f"slot-{index}.lock"))
+        try:
+            slot.acquire(timeout=0)
+            return slot
+        except Timeout:
+            continue
+    return None
+
+def load_upload(upload_id):
+    """Load an upload's metadata with its current offset, None if unknown"""
+    if not all(c.isalnum() or c == '-' for c in upload_id):
+        return None
+    try:
+        with open(_upload_meta_path(upload_id)) as f:
+            upload = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        st = os.stat(_upload_part_path(upload_id))
+        upload['offset'], last_write = st.st_size, st.st_mtime
+    except OSError:
+        upload['offset'], last_write = 0, os.path.getmtime(_upload_meta_path(upload_id))
+    upload['expires_at'] = last_write + UPLOAD_EXPIRE_SECONDS
+    return upload
+
+def upload_expires_header(upload):
+    """Upload-Expires header of an upload, an RFC 7231 date"""
+    return {'Upload-Expires': email.utils.formatdate(upload['expires_at'], usegmt=True)}
+
+def pending_upload_bytes():
+    """Bytes still expected by unfinished uploads"""
+    if not os.path.isdir(UPLOAD_DIR):
+        return 0
+    pending = 0
+    for name in os.listdir(UPLOAD_DIR):
+        if name.endswith('.json'):
+            upload = load_upload(name[:-len('.json')])
+            if upload and upload['expires_at'] > time.time():
+                pending += max(0, upload['length'] - upload['offset'])
+    return pending
+
+def sweep_expired_uploads():
+    """Delete uploads past their Upload-Expires deadline and leftover partial files"""
+    if not os.path.isdir(UPLOAD_DIR):
+        return 0
+    now = time.time()
+    removed = 0
+    for name in os.listdir(UPLOAD_DIR):
+        upload_id, ext = os.path.splitext(name)
+        if ext == '.json':
+            upload = load_upload(upload_id)
+            expired = upload is None or upload['expires_at'] <= now
+        elif ext == '.part' and not os.path.exists(_upload_meta_path(upload_id)):
+            try:
+                expired = os.path.getmtime(os.path.join(UPLOAD_DIR, name)) + UPLOAD_EXPIRE_SECONDS <= now
+            except OSError:
+                continue
+        else:
+            continue
+        if not expired:
+            continue
+        upload_lock = lock_upload(upload_id)
+        if upload_lock is None:
+            continue  # a PATCH is writing to it right now
+        try:
+            remove_upload(upload_id)
+            removed += 1
+        finally:
+            unlock_upload(upload_id, upload_lock)
+    if removed:
+        log(f"UPLOAD: Removed {removed} expired uploads")
+    return removed
+
+def create_upload(filename, length, username):
+    """Register a new upload after checking the name and free disk space"""
+    filename = secure_filename(filename or '')
+    if not filename.lower().endswith(VIDEO_EXTENSIONS):
+        raise ValueError(f"Not a supported video file: {filename or 'missing name'}")
+    if length <= 0:
+        raise ValueError('Upload-Length must be positive')
+    
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    with _upload_lock:
+        free = shutil.disk_usage(VIDEOS_DIR).free
+        if length + pending_upload_bytes() + UPLOAD_MIN_FREE_BYTES > free:
+            raise OSError(errno.ENOSPC, f"Not enough disk space for {length} bytes ({free} free)")
+        
+        upload = {
+            'id': str(uuid.uuid4()),
+            'filename': filename,
+            'length': length,
+            'username': username,
+            'created_at': datetime.now(jakarta_tz).isoformat()
+        }
+        with open(_upload_meta_path(upload['id']), 'w') as f:
+            json.dump(upload, f)
+        open(_upload_part_path(upload['id']), 'wb').close()
+    upload['expires_at'] = time.time() + UPLOAD_EXPIRE_SECONDS
+    return upload
+
+def append_upload(upload, stream, offset, content_length):
+    """Copy a request body to the end of an upload, returns the new offset"""
+    if offset + content_length > upload['length']:
+        raise ValueError('Upload would exceed its declared length')
+    
+    written = 0
+    with open(_upload_part_path(upload['id']), 'r+b') as f:
+        f.seek(offset)
+        try:
+            while written < content_length:
+                block = stream.read(min(UPLOAD_CHUNK_BYTES, content_length - written))
+                if not block:
+                    break
+                f.write(block)
+                written += len(block)
+        finally:
+            # Keep what arrived so the client can resume from here
+            f.truncate(offset + written)
+            f.flush()
+            os.fsync(f.fileno())
+    return offset + written
+
+def finish_upload(upload):
+    """Move a complete upload into VIDEOS_DIR and list it"""
+    final_name = _unique_video_name(upload['filename'])
+    os.replace(_upload_part_path(upload['id']), os.path.join(VIDEOS_DIR, final_name))
+    os.remove(_upload_meta_path(upload['id']))
+    register_video_file(final_name)
+    log(f"UPLOAD: Saved {final_name} ({upload['length']} bytes)")
+    return final_name
+
+def remove_upload(upload_id):
+    """Discard an unfinished upload"""
+    for path in (_upload_meta_path(upload_id), _upload_part_path(upload_id)):
+        if os.path.exists(path):
+            os.remove(path)
+
+# Systemd
+# Every systemctl call goes through run_systemctl so the binary can be
+# swapped for a fake one (STREAMHIB_SYSTEMCTL) in tests and benchmarks.
+SYSTEMCTL_BIN = os.environ.get('STREAMHIB_SYSTEMCTL', 'systemctl')
+JOURNALCTL_BIN = os.environ.get('STREAMHIB_JOURNALCTL', 'journalctl')
+SYSTEMD_UNIT_DIR = os.environ.get('STREAMHIB_UNIT_DIR', '/etc/systemd/system')
+# Streams run as instances of one template unit, stream@<id[:8]>. The
+# per-session ffmpeg command lives in STREAM_SCRIPT_DIR/<instance>.sh, so
+# starting, changing or removing a stream never needs a daemon-reload.
+# stream-* units are the per-session units of older versions.
+STREAM_SCRIPT_DIR = os.environ.get('STREAMHIB_STREAM_DIR', '/etc/streamhib/streams')
+STREAM_UNIT_PATTERNS = ('stream@*', 'stream-*')
+STREAM_NICE = int(os.environ.get('STREAMHIB_STREAM_NICE', 5))  # keeps the panel and sshd ahead of encoders
+STREAM_TEMPLATE_CONTENT = f"""[Unit]
+Description=StreamHib Session %i
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+Type=simple
+ExecStart=/bin/sh {STREAM_SCRIPT_DIR}/%i.sh
+Restart=always
+RestartSec=3
+User=root
+Nice={STREAM_NICE}
+"""
+
+last_unit_probe = {'probed_at': None, 'duration_ms': 0.0, 'units': 0}
+
+def run_systemctl(*args, check=False):
+    """Run a systemctl command and capture its output"""
+    return run_command([SYSTEMCTL_BIN, *args], capture_output=True, text=True, check=check)
+
+def systemctl_unit_states(patterns):
+    """Unit state backend that lists every matching unit in a single systemctl call"""
+    result = run_systemctl(
+        'list-units', '--type=service', '--all', '--no-legend', '--plain', '--no-pager', *patterns
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"systemctl list-units failed: {result.stderr.strip()}")
+    
+    states = {}
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        # Failed units are prefixed with a status marker on some systemd versions
+        if parts and not parts[0].endswith('.service'):
+            parts = parts[1:]
+        # UNIT LOAD ACTIVE SUB DESCRIPTION...
+        if len(parts) >= 4 and parts[0].endswith('.service'):
+            states[parts[0][:-len('.service')]] = parts[2]
+    return states
+
+# Replaceable so tests can plug in a fake: any callable taking a list of
+# unit patterns and returning {service_name: active_state}.
+unit_state_backend = systemctl_unit_states
+
+def get_stream_unit_states():
+    """Get the active state of every stream unit with one probe
+
+    Units systemd does not know about are missing from the result and should
+    be treated as inactive.
+    """
+    started = time.perf_counter()
+    states = unit_state_backend(STREAM_UNIT_PATTERNS)
+    last_unit_probe.update({
+        'probed_at': datetime.now(jakarta_tz).isoformat(),
+        'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+        'units': len(states)
+    })
+    return states
+
+def is_unit_active(unit_states, service_name):
+    """Check a unit state dict the way systemctl is-active would"""
+    return unit_states.get(service_name, 'inactive') in ('active', 'reloading')
+
+def is_service_active(service_name):
+    """Check a single unit with systemctl is-active, without a full unit probe"""
+    return run_systemctl('is-active', '--quiet', service_name).returncode == 0
+
+def get_stream_script_path(service_name):
+    """Get the script a stream@ instance executes"""
+    return os.path.join(STREAM_SCRIPT_DIR, f"{service_name.split('@', 1)[1]}.sh")
+
+def ensure_stream_template():
+    """Install the stream@ template unit, returns True if systemd must reload"""
+    template_path = os.path.join(SYSTEMD_UNIT_DIR, 'stream@.service')
+    os.makedirs(STREAM_SCRIPT_DIR, exist_ok=True)
+    try:
+        with open(template_path, 'r') as f:
+            if f.read() == STREAM_TEMPLATE_CONTENT:
+                return False
+    except OSError:
+        pass
+    with open(template_path, 'w') as f:
+        f.write(STREAM_TEMPLATE_CONTENT)
+    log("RECOVERY: Installed stream@.service template")
+    return True
+
+def write_stream_script(session_id, session_info, video_path):
+    """Write the ffmpeg command of a session for its stream@ instance"""
+    allocate_telemetry_port(session_id, session_info)
+    if len(session_info.get('playlist') or []) > 1:
+        session_info['playlist_file'] = write_playlist(get_service_name(session_id), session_info['playlist'])
+    elif session_info.pop('playlist_file', None):
+        remove_playlist(get_service_name(session_id))
+    script = (
+        "#!/bin/sh\n"
+        f"# StreamHib session {session_id}\n"
+        f"exec {shlex.join([FFMPEG_BIN, *build_ffmpeg_args(session_info, video_path)])}\n"
+    )
+    script_path = get_stream_script_path(get_service_name(session_id))
+    temp_path = f"{script_path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(script)
+    os.replace(temp_path, script_path)
+
+def remove_stream_script(service_name):
+    """Remove the script of a stream@ instance"""
+    script_path = get_stream_script_path(service_name)
+    if os.path.exists(script_path):
+        os.remove(script_path)
+    remove_playlist(service_name)
+
+def migrate_legacy_stream_units():
+    """Replace per-session stream-*.service units with stream@ instances
+
+    Returns the number of migrated units. Legacy units without an active
+    session are left for cleanup_unused_services.
+    """
+    try:
+        legacy_units = [
+            name[:-len('.service')] for name in os.listdir(SYSTEMD_UNIT_DIR)
+            if name.startswith('stream-') and name.endswith('.service')
+        ]
+    except OSError:
+        return 0
+    if not legacy_units:
+        return 0
+    
+    active_sessions = load_sessions(readonly=True).get('active_sessions', {})
+    by_prefix = {session_id[:8]: session_id for session_id in active_sessions}
+    unit_states = get_stream_unit_states()
+    migrated = []
+    
+    for legacy_name in legacy_units:
+        session_id = by_prefix.get(legacy_name[len('stream-'):])
+        if session_id is None:
+            continue
+        try:
+            session_info = _thaw(active_sessions[session_id])
+            video_path = os.path.join(VIDEOS_DIR, session_info.get('video_file', ''))
+            write_stream_script(session_id, session_info, video_path)
+            upsert_session('active_sessions', session_id, session_info)
+            run_systemctl('stop', legacy_name)
+            run_systemctl('disable', legacy_name)
+            os.remove(os.path.join(SYSTEMD_UNIT_DIR, f"{legacy_name}.service"))
+            migrated.append((session_id, is_unit_active(unit_states, legacy_name)))
+        except Exception as e:
+            log(f"RECOVERY ERROR: Failed to migrate {legacy_name}: {e}")
+    
+    if migrated:
+        ensure_stream_template()
+        run_systemctl('daemon-reload', check=True)
+        for session_id, was_active in migrated:
+            if was_active:
+                run_systemctl('start', get_service_name(session_id))
+        log(f"RECOVERY: Migrated {len(migrated)} legacy stream units to stream@.service")
+    return len(migrated)
+
+# Playlists
+# A session with a `playlist` plays several library videos through one
+# long-lived ffmpeg using the concat demuxer, so the RTMP connection and the
+# encoder survive from one file to the next and timestamps keep counting.
+# The concat list names fixed slot symlinks (<script dir>/<id>.playlist/NNN)
+# rather than the videos: concat opens each entry only when it is reached,
+# so retargeting the symlinks changes what plays next without touching the
+# running process. Only changing the number of items needs a restart.
+# With `loop`, -stream_loop -1 wraps the list (or a single video) forever.
+# concat passes every item's packets to the same decoder or muxer, so copy
+# and audio mode are only used when all items share one stream shape; a
+# mixed playlist is transcoded to a fixed frame size and rate instead.
+MAX_PLAYLIST_ITEMS = 200
+
+def get_playlist_dir(service_name):
+    """Get the slot directory of a stream@ instance"""
+    return f"{get_stream_script_path(service_name)[:-len('.sh')]}.playlist"
+
+def validate_playlist(playlist):
+    """Check that every playlist item is a library video"""
+    if not isinstance(playlist, list) or not playlist:
+        raise ValueError('Playlist must be a non-empty list of video files')
+    if len(playlist) > MAX_PLAYLIST_ITEMS:
+        raise ValueError(f"At most {MAX_PLAYLIST_ITEMS} playlist items")
+    for video_file in playlist:
+        if (not isinstance(video_file, str) or os.path.basename(video_file) != video_file
+                or not os.path.isfile(os.path.join(VIDEOS_DIR, video_file))):
+            raise ValueError(f"Video file not found: {video_file}")
+    return list(playlist)
+
+def _point_slot(slot_path, video_file):
+    """Atomically retarget a slot symlink"""
+    temp_path = f"{slot_path}.tmp"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.symlink(os.path.abspath(get_stream_source(os.path.join(VIDEOS_DIR, video_file))), temp_path)
+    os.replace(temp_path, slot_path)
+
+def write_playlist(service_name, playlist):
+    """Write the slot symlinks and concat list of a playlist, returns the list path"""
+    playlist_dir = get_playlist_dir(service_name)
+    os.makedirs(playlist_dir, exist_ok=True)
+    for name in os.listdir(playlist_dir):
+        os.remove(os.path.join(playlist_dir, name))
+    
+    lines = ['ffconcat version 1.0']
+    for index, video_file in enumerate(playlist):
+        slot_path = os.path.join(os.path.abspath(playlist_dir), f"{index:03d}")
+        _point_slot(slot_path, video_file)
+        lines.append(f"file '{slot_path}'")
+    
+    list_path = os.path.join(playlist_dir, 'list.ffconcat')
+    with open(list_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return os.path.abspath(list_path)
+
+def can_retarget_playlist(session_info, playlist):
+    """Check that the running ffmpeg can play new items without a restart"""
+    if session_info.get('encoding_frame'):
+        # Every item is scaled to the fixed frame of a mixed playlist
+        return True
+    videos = list(session_info.get('playlist') or []) + list(playlist)
+    return shapes_match([probe_video(get_stream_source(os.path.join(VIDEOS_DIR, v))) for v in videos])
+
+def retarget_playlist(service_name, playlist):
+    """Point existing slots at new videos, False if the item count changed"""
+    playlist_dir = get_playlist_dir(service_name)
+    slots = sorted(name for name in os.listdir(playlist_dir) if name.isdigit()) if os.path.isdir(playlist_dir) else []
+    if len(slots) != len(playlist):
+        return False
+    for slot, video_file in zip(slots, playlist):
+        _point_slot(os.path.join(playlist_dir, slot), video_file)
+    return True
+
+def remove_playlist(service_name):
+    """Remove the slot directory of a stream@ instance"""
+    shutil.rmtree(get_playlist_dir(service_name), ignore_errors=True)
+
+def build_input_args(session_info, video_path):
+    """Build the ffmpeg input arguments: one video, a looped video or a playlist"""
+    loop_args = ['-stream_loop', '-1'] if session_info.get('loop') else []
+    if session_info.get('playlist_file'):
+        return ['-re', *loop_args, '-f', 'concat', '-safe', '0', '-i', session_info['playlist_file']]
+    # Units run from /, so the input must be an absolute path
+    return ['-re', *loop_args, '-i', os.path.abspath(video_path)]
+
+# Encoding
+# Each session streams in one of three modes, picked from an ffprobe of the
+# source unless the session carries a manual `encoding_mode` override:
+#   copy      - source is already RTMP-ready H.264/AAC, remux only
+#   audio     - video is fine, only the audio track is re-encoded
+#   transcode - full libx264/AAC encode
+# Video only counts as fine with keyframes at most TRANSCODE_GOP_SECONDS
+# apart, checked over the first KEYFRAME_PROBE_SECONDS of the source.
+# A session with several `destinations` (stream keys or RTMP URLs) is encoded
+# once and fanned out with the tee muxer instead of one ffmpeg per channel.
+FFMPEG_BIN = os.environ.get('STREAMHIB_FFMPEG', '/usr/bin/ffmpeg')
+FFPROBE_BIN = os.environ.get('STREAMHIB_FFPROBE', 'ffprobe')
+RTMP_BASE_URL = 'rtmp://a.rtmp.youtube.com/live2'
+
+ENCODING_MODES = ('copy', 'audio', 'transcode')
+COPY_MAX_VIDEO_BITRATE = 8000000
+COPY_VIDEO_PIX_FMTS = ('yuv420p', 'yuvj420p')
+COPY_AUDIO_SAMPLE_RATES = (44100, 48000)
+
+TRANSCODE_AUDIO_ARGS = ['-c:a', 'aac', '-b:a', '160k', '-ac', '2', '-ar', '44100']
+
+# Transcode profiles, `source` keeps the source resolution. Profiles never
+# upscale and the GOP is always TRANSCODE_GOP_SECONDS of source frames.
+ENCODING_PROFILES = {
+    'source': {'height': None, 'preset': 'veryfast', 'maxrate': '3000k', 'audio_bitrate': '160k'},
+    '1080p': {'height': 1080, 'preset': 'veryfast', 'maxrate': '4500k', 'audio_bitrate': '160k'},
+    '720p': {'height': 720, 'preset': 'veryfast', 'maxrate': '3000k', 'audio_bitrate': '160k'},
+    '480p': {'height': 480, 'preset': 'superfast', 'maxrate': '1500k', 'audio_bitrate': '128k'},
+    '360p': {'height': 360, 'preset': 'ultrafast', 'maxrate': '800k', 'audio_bitrate': '96k'},
+}
+DEFAULT_ENCODING_PROFILE = 'source'
+PROFILE_LADDER = ('1080p', '720p', '480p', '360p')  # most to least expensive
+TRANSCODE_GOP_SECONDS = 2
+KEYFRAME_PROBE_SECONDS = 30
+KEYFRAME_GAP_TOLERANCE = 0.1  # 60 frames at 29.97 fps are 2.002 seconds
+DEFAULT_SOURCE_FPS = 25
+PLAYLIST_DEFAULT_FRAME = (1280, 720)
+MAX_DESTINATIONS = 5
+TEE_FAILURE_PATTERN = re.compile(r'Slave muxer #(\d+) failed: (.*?)(?:, continuing with|$)')
+
+_probe_cache = {}
+_probe_cache_lock = threading.Lock()
+
+def _parse_frame_rate(value):
+    """Parse an ffprobe rational frame rate such as 30000/1001"""
+    try:
+        num, _, den = (value or '0/1').partition('/')
+        return round(float(num) / float(den or 1), 3)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+def summarize_probe(probe):
+    """Reduce raw ffprobe JSON to the fields the encoder decisions need"""
+    summary = {'format': probe.get('format', {}).get('format_name', ''),
+               'duration': float(probe.get('format', {}).get('duration') or 0),
+               'bit_rate': int(probe.get('format', {}).get('bit_rate') or 0)}
+    for stream in probe.get('streams', []):
+        if stream.get('codec_type') == 'video' and 'video_codec' not in summary:
+            summary.update({
+                'video_codec': stream.get('codec_name'),
+                'pix_fmt': stream.get('pix_fmt'),
+                'width': stream.get('width', 0),
+                'height': stream.get('height', 0),
+                'fps': _parse_frame_rate(stream.get('avg_frame_rate')),
+                'video_bit_rate': int(stream.get('bit_rate') or 0)
+            })
+        elif stream.get('codec_type') == 'audio' and 'audio_codec' not in summary:
+            summary.update({
+                'audio_codec': stream.get('codec_name'),
+                'sample_rate': int(stream.get('sample_rate') or 0),
+                'channels': stream.get('channels', 0),
+                'audio_bit_rate': int(stream.get('bit_rate') or 0)
+            })
+    return summary
+
+def probe_video(video_path):
+    """Get codec information for a video
+
+    Results are cached in memory and in the state store, keyed by
+    (inode, size, mtime) so renames keep their probe and edits re-probe.
+    """
+    try:
+        st = os.stat(video_path)
+        cache_key = f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+        with _probe_cache_lock:
+            if cache_key in _probe_cache:
+                return _probe_cache[cache_key]
+        
+        summary = load_state_record('video_probes', cache_key)
+        if summary is not None and 'keyframe_gap' not in summary and 'video_codec' in summary:
+            # Probed before keyframe spacing was recorded
+            summary['keyframe_gap'] = probe_keyframe_gap(video_path, summary.get('duration', 0))
+            save_state_record('video_probes', cache_key, summary)
+        if summary is not None:
+            with _probe_cache_lock:
+                _probe_cache[cache_key] = summary
+            return summary
+        
+        result = run_command(
+            [FFPROBE_BIN, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', video_path],
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+        if result.returncode != 0:
+            log(f"ENCODING ERROR: ffprobe failed for {video_path}: {result.stderr.strip()}")
+            return None
+        
+        summary = summarize_probe(json.loads(result.stdout))
+        if 'video_codec' in summary:
+            summary['keyframe_gap'] = probe_keyframe_gap(video_path, summary['duration'])
+        save_state_record('video_probes', cache_key, summary)
+        with _probe_cache_lock:
+            _probe_cache[cache_key] = summary
+        return summary
+    except Exception as e:
+        log(f"ENCODING ERROR: Failed to probe {video_path}: {e}")
+        return None
+
+def probe_keyframe_gap(video_path, duration):
+    """Longest keyframe interval in seconds over the first KEYFRAME_PROBE_SECONDS, None if unknown
+
+    Only keyframes are decoded (-skip_frame nokey), so this reads the head of
+    the file without a full decode. The stretch after the last keyframe in
+    the window counts too, a lower bound for the GOP that follows it.
+    """
+    try:
+        result = run_command(
+            [FFPROBE_BIN, '-v', 'error', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+             '-read_intervals', f"%+{KEYFRAME_PROBE_SECONDS}", '-show_entries', 'frame=pts_time',
+             '-of', 'csv=p=0', video_path],
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+        if result.returncode != 0:
+            return None
+        times = sorted(float(line.strip().rstrip(',')) for line in result.stdout.splitlines()
+                       if line.strip().rstrip(',') not in ('', 'N/A'))
+    except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+        log(f"ENCODING ERROR: Keyframe probe failed for {video_path}: {e}")
+        return None
+    if not times:
+        return None
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    window_end = min(duration, times[0] + KEYFRAME_PROBE_SECONDS) if duration else times[-1]
+    gaps.append(max(0.0, window_end - times[-1]))
+    return round(max(gaps), 3)
+
+def choose_encoding_mode(probe):
+    """Pick the cheapest encoding mode that keeps the stream RTMP-compatible"""
+    if not probe:
+        return 'transcode'
+    
+    video_bit_rate = probe.get('video_bit_rate') or probe.get('bit_rate', 0)
+    video_ok = (
+        probe.get('video_codec') == 'h264'
+        and probe.get('pix_fmt') in COPY_VIDEO_PIX_FMTS
+        and 0 < video_bit_rate <= COPY_MAX_VIDEO_BITRATE
+    )
+    if not video_ok:
+        return 'transcode'
+    # Copying a long GOP would leave the ingest waiting seconds for each keyframe
+    if (probe.get('keyframe_gap') or 0) > TRANSCODE_GOP_SECONDS + KEYFRAME_GAP_TOLERANCE:
+        return 'transcode'
+    
+    audio_ok = (
+        probe.get('audio_codec') == 'aac'
+        and probe.get('sample_rate') in COPY_AUDIO_SAMPLE_RATES
+        and 0 < probe.get('channels', 0) <= 2
+    )
+    return 'copy' if audio_ok else 'audio'
+
+STREAM_SHAPE_FIELDS = ('video_codec', 'pix_fmt', 'width', 'height', 'fps', 'audio_codec', 'sample_rate', 'channels')
+
+def get_source_probes(session_info, video_path):
+    """Probe every video a session plays, one probe per playlist item"""
+    playlist = session_info.get('playlist') or []
+    if len(playlist) > 1:
+        return [probe_video(get_stream_source(os.path.join(VIDEOS_DIR, v))) for v in playlist]
+    return [probe_video(video_path)]
+
+def shapes_match(probes):
+    """Check that probed videos share codecs, frame size, frame rate and audio layout"""
+    if not all(probes):
+        return False
+    return len({tuple(probe.get(field) for field in STREAM_SHAPE_FIELDS) for probe in probes}) == 1
+
+def is_mixed_playlist(probes):
+    """Check if playlist items differ in shape and need a fixed output frame"""
+    return len(probes) > 1 and not shapes_match(probes)
+
+def resolve_encoding_mode(session_info, video_path):
+    """Get the encoding mode for a session, honouring a manual override"""
+    probes = get_source_probes(session_info, video_path)
+    if is_mixed_playlist(probes):
+        # Copying mixed items would change codecs mid-stream, even when forced
+        return 'transcode'
+    override = session_info.get('encoding_mode', 'auto')
+    if override in ENCODING_MODES:
+        return override
+    if get_active_profile(session_info) != DEFAULT_ENCODING_PROFILE:
+        return 'transcode'
+    return max((choose_encoding_mode(probe) for probe in probes), key=ENCODING_MODES.index)
+
+def get_active_profile(session_info):
+    """Get the profile a session currently encodes with"""
+    profile = session_info.get('encoding_profile_active') or session_info.get('encoding_profile')
+    return profile if profile in ENCODING_PROFILES else DEFAULT_ENCODING_PROFILE
+
+def profile_output_height(profile_name, probe):
+    """Output height of a profile for a source, None if unknown"""
+    source_height = (probe or {}).get('height') or None
+    height = ENCODING_PROFILES[profile_name]['height']
+    if height is None or (source_height and height >= source_height):
+        return source_height
+    return height
+
+def get_playlist_frame(profile_name, probes):
+    """Fixed output width, height and frame rate of a mixed playlist, from its first item"""
+    first = next((probe for probe in probes if probe and probe.get('height')), {})
+    height = profile_output_height(profile_name, first) or PLAYLIST_DEFAULT_FRAME[1]
+    if first:
+        width = round(first.get('width', 0) * height / first['height'] / 2) * 2 or PLAYLIST_DEFAULT_FRAME[0]
+    else:
+        width = PLAYLIST_DEFAULT_FRAME[0]
+    return width, height, first.get('fps') or DEFAULT_SOURCE_FPS
+
+def build_transcode_video_args(profile_name, probe, frame=None):
+    """Build the libx264 arguments of a profile, scaled and padded to `frame` if given"""
+    profile = ENCODING_PROFILES[profile_name]
+    fps = frame[2] if frame else (probe or {}).get('fps') or DEFAULT_SOURCE_FPS
+    gop = max(1, round(fps * TRANSCODE_GOP_SECONDS))
+    args = []
+    if frame:
+        width, height, _ = frame
+        args += ['-vf', f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps}"]
+    elif profile['height'] and profile_output_height(profile_name, probe) == profile['height']:
+        args += ['-vf', f"scale=-2:{profile['height']}"]
+    return args + ['-c:v', 'libx264', '-preset', profile['preset'],
+                   '-maxrate', profile['maxrate'], '-bufsize', f"{int(profile['maxrate'][:-1]) * 2}k",
+                   '-pix_fmt', 'yuv420p', '-g', str(gop), '-keyint_min', str(gop)]
+
+def build_transcode_args(profile_name, probe, frame=None):
+    """Build the full video and audio transcode arguments of a profile"""
+    return build_transcode_video_args(profile_name, probe, frame) + [
+        '-c:a', 'aac', '-b:a', ENCODING_PROFILES[profile_name]['audio_bitrate'], '-ac', '2', '-ar', '44100'
+    ]
+
+def build_ffmpeg_args(session_info, video_path):
+    """Build the ffmpeg argument list for a stream session"""
+    video_path = get_stream_source(video_path)
+    mode = resolve_encoding_mode(session_info, video_path)
+    session_info['encoding_mode_used'] = mode
+    frame = None
+    
+    args = ['-nostdin', '-progress', get_telemetry_url(session_info), *build_input_args(session_info, video_path)]
+    if mode == 'copy':
+        args += ['-c', 'copy']
+    elif mode == 'audio':
+        args += ['-c:v', 'copy'] + TRANSCODE_AUDIO_ARGS
+    else:
+        profile = get_active_profile(session_info)
+        session_info['encoding_profile_used'] = profile
+        probes = get_source_probes(session_info, video_path)
+        frame = get_playlist_frame(profile, probes) if is_mixed_playlist(probes) else None
+        args += build_transcode_args(profile, probes[0], frame)
+    if frame:
+        session_info['encoding_frame'] = list(frame)
+    else:
+        session_info.pop('encoding_frame', None)
+    
+    urls = get_destination_urls(session_info)
+    if len(urls) == 1:
+        args += ['-f', 'flv', urls[0]]
+    else:
+        # One encode fanned out by the tee muxer; a failing destination is
+        # dropped without taking the others down
+        slaves = '|'.join(f"[f=flv:onfail=ignore]{_tee_escape(url)}" for url in urls)
+        args += ['-map', '0:v:0', '-map', '0:a:0?', '-flags', '+global_header', '-f', 'tee', slaves]
+    return args
+
+def _tee_escape(url):
+    """Escape the characters the tee muxer treats as separators"""
+    return url.replace('\\', '\\\\').replace('|', '\\|')
+
+def normalize_destinations(raw_destinations):
+    """Validate a list of stream keys or RTMP URLs into destination dicts"""
+    destinations = []
+    for raw in raw_destinations or []:
+        if isinstance(raw, str):
+            raw = {'url': raw} if '://' in raw else {'stream_key': raw}
+        url = (raw.get('url') or '').strip()
+        stream_key = (raw.get('stream_key') or '').strip()
+        if url and not url.startswith(('rtmp://', 'rtmps://')):
+            raise ValueError(f"Destination must be an rtmp:// or rtmps:// URL: {url}")
+        if not url and not stream_key:
+            raise ValueError('Destination needs a stream key or URL')
+        destination = {'url': url} if url else {'stream_key': stream_key}
+        if raw.get('platform'):
+            destination['platform'] = raw['platform']
+        destinations.append(destination)
+    if len(destinations) > MAX_DESTINATIONS:
+        raise ValueError(f"At most {MAX_DESTINATIONS} destinations per session")
+    return destinations
+
+def get_destination_urls(session_info):
+    """Get the RTMP URLs a session pushes to, in destination order"""
+    destinations = session_info.get('destinations') or [{'stream_key': session_info.get('stream_key', '')}]
+    return [d.get('url') or f"{RTMP_BASE_URL}/{d.get('stream_key', '')}" for d in destinations]
+
+# Stream logs
+# Each worker runs one `journalctl -f` over every stream unit and keeps the
+# last STREAM_LOG_LINES lines of each unit in a ring buffer, so reading a
+# stream's ffmpeg output never spawns a process. Admins follow a stream over
+# Socket.IO by joining its `stream-log:<service>` room; new lines are sent
+# every STREAM_LOG_EMIT_SECONDS to the followers connected to this worker
+# only, since the other workers have the same lines. Buffers of units quiet
+# for STREAM_LOG_RETENTION_SECONDS and not followed are dropped.
+STREAM_LOG_LINES = int(os.environ.get('STREAMHIB_STREAM_LOG_LINES', 500))
+STREAM_LOG_BACKFILL_LINES = 2000
+STREAM_LOG_EMIT_SECONDS = 0.5
+STREAM_LOG_RETENTION_SECONDS = 3600
+STREAM_LOG_RETRY_SECONDS = 30
+
+_stream_logs = {}  # service -> deque of (timestamp, line)
+_stream_log_pending = {}  # service -> lines not yet sent to its followers
+_stream_log_watchers = {}  # service -> sids following it on this worker
+_stream_log_lock = threading.Lock()
+_stream_log_started = False
+_stream_log_following = False
+
+def get_stream_log_room(service_name):
+    """Get the Socket.IO room of a stream's log followers"""
+    return f"stream-log:{service_name}"
+
+def parse_journal_entry(raw):
+    """(service, timestamp, line) of one `journalctl -o json` record, or None"""
+    entry = json.loads(raw)
+    unit = entry.get('_SYSTEMD_UNIT', '')
+    message = entry.get('MESSAGE')
+    if not unit.endswith('.service') or message is None:
+        return None
+    if isinstance(message, list):
+        # journald hands out messages that are not valid UTF-8 as byte arrays
+        message = bytes(message).decode('utf-8', 'replace')
+    timestamp = int(entry.get('__REALTIME_TIMESTAMP', 0)) / 1_000_000
+    return unit[:-len('.service')], timestamp, message
+
+def append_stream_log(service_name, timestamp, line):
+    """Add a line to a unit's ring buffer and queue it for its followers"""
+    with _stream_log_lock:
+        buffer = _stream_logs.get(service_name)
+        if buffer is None:
+            buffer = _stream_logs[service_name] = deque(maxlen=STREAM_LOG_LINES)
+        buffer.append((timestamp, line))
+        if _stream_log_watchers.get(service_name):
+            pending = _stream_log_pending.setdefault(service_name, [])
+            if len(pending) < STREAM_LOG_LINES:
+                pending.append(line)
+
+def get_stream_log_entries(service_name):
+    """Buffered (timestamp, line) pairs of a unit, oldest first"""
+    with _stream_log_lock:
+        return list(_stream_logs.get(service_name, ()))
+
+def _stream_log_follow_loop():
+    """Follow the journal of all stream units, restarting journalctl if it exits"""
+    global _stream_log_following
+    args = [JOURNALCTL_BIN, '-f', '-o', 'json', '--no-pager', '-n', str(STREAM_LOG_BACKFILL_LINES),
+            '--output-fields=MESSAGE,_SYSTEMD_UNIT']
+    for pattern in STREAM_UNIT_PATTERNS:
+        args += ['-u', pattern]
+    while True:
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            _stream_log_following = True
+            for raw in process.stdout:
+                try:
+                    entry = parse_journal_entry(raw)
+                except ValueError:
+                    continue
+                if entry:
+                    append_stream_log(*entry)
+            process.wait()
+            log(f"STREAMLOG WARNING: journalctl exited with {process.returncode}, retrying in {STREAM_LOG_RETRY_SECONDS}s")
+        except OSError as e:
+            log(f"STREAMLOG ERROR: Cannot run journalctl: {e}")
+        _stream_log_following = False
+        time.sleep(STREAM_LOG_RETRY_SECONDS)
+
+def _stream_log_emit_loop():
+    """Send new lines to this worker's followers and drop stale buffers"""
+    pruned_at = time.time()
+    while True:
+        socketio.sleep(STREAM_LOG_EMIT_SECONDS)
+        try:
+            with _stream_log_lock:
+                pending = dict(_stream_log_pending)
+                _stream_log_pending.clear()
+                if time.time() - pruned_at > 60:
+                    pruned_at = time.time()
+                    for service_name in [
+                        name for name, buffer in _stream_logs.items()
+                        if not _stream_log_watchers.get(name)
+                        and (not buffer or pruned_at - buffer[-1][0] > STREAM_LOG_RETENTION_SECONDS)
+                    ]:
+                        del _stream_logs[service_name]
+            for service_name, lines in pending.items():
+                socketio.emit('stream_log', {'service': service_name, 'lines': lines},
+                              to=get_stream_log_room(service_name), ignore_queue=True)
+        except Exception as e:
+            log(f"STREAMLOG ERROR: Emit failed: {e}")
+
+def start_stream_log_follower():
+    """Start the journal follower and the emitter of this worker"""
+    global _stream_log_started
+    if _stream_log_started:
+        return
+    _stream_log_started = True
+    threading.Thread(target=_stream_log_follow_loop, daemon=True).start()
+    socketio.start_background_task(_stream_log_emit_loop)
+
+def _stop_following_stream_log(sid):
+    """Forget every stream log a connection follows"""
+    with _stream_log_lock:
+        for service_name, sids in list(_stream_log_watchers.items()):
+            sids.discard(sid)
+            if not sids:
+                del _stream_log_watchers[service_name]
+                _stream_log_pending.pop(service_name, None)
+
+@socketio.on('stream_log_follow')
+def handle_stream_log_follow(data):
+    """Follow one stream's log, replying with the buffered lines"""
+    if not is_admin_logged_in():
+        return {'success': False, 'message': 'Admin access required'}
+    session_id = (data or {}).get('session_id') or ''
+    if not session_id:
+        return {'success': False, 'message': 'session_id is required'}
+
+    service_name = get_service_name(session_id)
+    with _stream_log_lock:
+        previous = [name for name, sids in _stream_log_watchers.items() if request.sid in sids]
+    for name in previous:
+        leave_room(get_stream_log_room(name))
+    _stop_following_stream_log(request.sid)
+
+    join_room(get_stream_log_room(service_name))
+    with _stream_log_lock:
+        _stream_log_watchers.setdefault(service_name, set()).add(request.sid)
+    return {
+        'success': True,
+        'service': service_name,
+        'following': _stream_log_following,
+        'lines': [line for _, line in get_stream_log_entries(service_name)]
+    }
+
+@socketio.on('stream_log_unfollow')
+def handle_stream_log_unfollow():
+    """Stop following stream logs"""
+    with _stream_log_lock:
+        followed = [name for name, sids in _stream_log_watchers.items() if request.sid in sids]
+    for name in followed:
+        leave_room(get_stream_log_room(name))
+    _stop_following_stream_log(request.sid)
+    return {'success': True}
+
+@socketio.on('disconnect')
+def handle_socket_disconnect(*args):
+    """Drop the stream logs a closed connection followed"""
+    _stop_following_stream_log(request.sid)
+
+def read_stream_log(session_id, since=None):
+    """Read a stream unit's recent output as plain lines
+
+    Served from the ring buffer while the journal follower runs, with a
+    one-off journalctl call as the fallback.
+    """
+    service_name = get_service_name(session_id)
+    if _stream_log_following:
+        since_ts = datetime.fromisoformat(since).timestamp() if since else 0
+        return [line for timestamp, line in get_stream_log_entries(service_name) if timestamp >= since_ts]
+    
+    args = [JOURNALCTL_BIN, '-u', f"{service_name}.service", '-o', 'cat', '--no-pager']
+    if since:
+        args += ['--since', datetime.fromisoformat(since).astimezone(pytz.utc).strftime('%Y-%m-%d %H:%M:%S UTC')]
+    result = run_command(args, capture_output=True, text=True, timeout=10)
+    return result.stdout.splitlines()
+
+def get_destination_status(session_id, session_info, unit_active):
+    """Per-destination state of a session's current ffmpeg run
+
+    The tee muxer logs "Slave muxer #N failed" when it drops a destination;
+    only lines after the last "Input #0" banner (the current run, since the
+    unit restarts ffmpeg) are considered.
+    """
+    lines = read_stream_log(session_id, session_info.get('recovered_at') or session_info.get('started_at'))
+    run_start = max((i for i, line in enumerate(lines) if line.startswith('Input #0')), default=0)
+    
+    failures = {}
+    for line in lines[run_start:]:
+        match = TEE_FAILURE_PATTERN.search(line)
+        if match:
+            failures[int(match.group(1))] = match.group(2)
+        elif 'All tee outputs failed' in line:
+            failures = {i: 'All tee outputs failed' for i in range(len(get_destination_urls(session_info)))}
+    
+    telemetry = summarize_telemetry(session_id)
+    flowing = telemetry is not None and telemetry['last_sample_age'] < TELEMETRY_PUSH_SECONDS * 2
+    destinations = session_info.get('destinations') or [{'stream_key': session_info.get('stream_key', '')}]
+    status = []
+    for index, destination in enumerate(destinations):
+        if index in failures:
+            state = 'failed'
+        elif not unit_active:
+            state = 'stopped'
+        else:
+            state = 'live' if flowing else 'starting'
+        entry = dict(destination, index=index, state=state)
+        if index in failures:
+            entry['error'] = failures[index]
+        status.append(entry)
+    return status
+
+# Normalization
+# Library videos are normalized once in the background into stream-ready
+# MP4s (H.264/AAC, fixed 2 second GOP, faststart) under VIDEOS_DIR/.normalized.
+# Artifacts are keyed by a content hash of the source plus the profile id, so
+# renames reuse them and edits produce a new one. Sessions pick up a finished
+# artifact automatically, which lets them stream in copy mode.
+# Jobs are keyed by the same content hash, so a renamed file keeps its job
+# and a failed job is retried with exponential backoff. An artifact is only
+# removed once no library file maps to it, no stream script or playlist slot
+# points at it and the file it came from is not being replaced right now.
+NORMALIZED_DIR = os.path.join(VIDEOS_DIR, '.normalized')
+NORMALIZE_CPU_BUDGET = int(os.environ.get('STREAMHIB_NORMALIZE_CPU_BUDGET', max(1, (os.cpu_count() or 2) // 2)))
+NORMALIZE_WORKERS = int(os.environ.get('STREAMHIB_NORMALIZE_WORKERS', 1))
+NORMALIZE_SETTLE_SECONDS = 30  # skip files modified this recently, they may still be copying
+NORMALIZE_GOP_SECONDS = 2
+HASH_SAMPLE_BYTES = 4 * 1024 * 1024
+NORMALIZE_RETRY_SECONDS = 300
+NORMALIZE_RETRY_MAX_SECONDS = 6 * 3600
+ARTIFACT_NAME_PATTERN = re.compile(r'[0-9a-f]{16}-[0-9a-f]{8}\.mp4')
+
+NORMALIZE_PROFILE = {
+    'video': ['-c:v', 'libx264', '-preset', 'veryfast', '-maxrate', '3000k', '-bufsize', '6000k',
+              '-pix_fmt', 'yuv420p', '-sc_threshold', '0'],
+    'audio': TRANSCODE_AUDIO_ARGS,
+    'gop_seconds': NORMALIZE_GOP_SECONDS,
+}
+NORMALIZE_PROFILE_ID = hashlib.sha1(json.dumps(NORMALIZE_PROFILE, sort_keys=True).encode()).hexdigest()[:8]
+
+normalize_jobs = {}  # content hash -> job
+_normalize_files = {}  # library file -> content hash of its last settled version
+_normalize_lock = threading.Lock()
+_normalize_pool = ThreadPoolExecutor(max_workers=max(1, NORMALIZE_WORKERS))
+_content_hash_cache = {}  # video path -> hash of its current version
+
+def content_hash(video_path):
+    """Hash a video's size and sampled head, middle and tail, cached per file version
+
+    Hashing multi-GB files in full on every scan is too slow for small VPS
+    disks; sampling three blocks plus the size is enough to key artifacts.
+    """
+    st = os.stat(video_path)
+    version = f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+    with _normalize_lock:
+        cached = _content_hash_cache.get(video_path)
+    if cached is not None and cached['version'] == version:
+        return cached['hash']
+    
+    digest = hashlib.sha256(str(st.st_size).encode())
+    with open(video_path, 'rb') as f:
+        for offset in (0, max(0, st.st_size // 2 - HASH_SAMPLE_BYTES // 2), max(0, st.st_size - HASH_SAMPLE_BYTES)):
+            f.seek(offset)
+            digest.update(f.read(HASH_SAMPLE_BYTES))
+    key = digest.hexdigest()[:16]
+    with _normalize_lock:
+        _content_hash_cache[video_path] = {'version': version, 'hash': key}
+    return key
+
+def normalized_artifact_path(video_path):
+    """Get where the normalized artifact of a video lives"""
+    return os.path.join(NORMALIZED_DIR, f"{content_hash(video_path)}-{NORMALIZE_PROFILE_ID}.mp4")
+
+def is_faststart_mp4(video_path):
+    """Check whether an MP4's moov atom comes before its mdat atom"""
+    try:
+        with open(video_path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size = int.from_bytes(header[:4], 'big')
+                box_type = header[4:8]
+                if box_type == b'moov':
+                    return True
+                if box_type == b'mdat':
+                    return False
+                if size == 1:
+                    size = int.from_bytes(f.read(8), 'big')
+                    f.seek(size - 16, os.SEEK_CUR)
+                elif size < 8:
+                    return False
+                else:
+                    f.seek(size - 8, os.SEEK_CUR)
+    except OSError:
+        return False
+
+def build_normalize_args(video_path, probe, output_path):
+    """Build the ffmpeg arguments that normalize a video, or None if it is already stream-ready"""
+    mode = choose_encoding_mode(probe)
+    if mode == 'copy' and video_path.lower().endswith('.mp4') and is_faststart_mp4(video_path):
+        return None
+    
+    args = ['-y', '-nostdin', '-v', 'error', '-nostats', '-progress', 'pipe:1',
+            '-i', video_path, '-map', '0:v:0', '-map', '0:a:0?']
+    if mode == 'copy':
+        args += ['-c', 'copy']
+    elif mode == 'audio':
+        args += ['-c:v', 'copy'] + NORMALIZE_PROFILE['audio']
+    else:
+        gop = max(1, round((probe or {}).get('fps') or 25) * NORMALIZE_PROFILE['gop_seconds'])
+        threads = max(1, NORMALIZE_CPU_BUDGET // max(1, NORMALIZE_WORKERS))
+        args += NORMALIZE_PROFILE['video'] + ['-g', str(gop), '-keyint_min', str(gop), '-threads', str(threads)]
+        args += NORMALIZE_PROFILE['audio']
+    args += ['-movflags', '+faststart', '-f', 'mp4', output_path]
+    return args
+
+def _set_normalize_job(key, **fields):
+    """Update the status record of a normalization job"""
+    with _normalize_lock:
+        normalize_jobs.setdefault(key, {}).update(fields)
+
+def normalize_video(key, video_file):
+    """Normalize one library video into its stream-ready artifact"""
+    video_path = os.path.join(VIDEOS_DIR, video_file)
+    try:
+        artifact_path = normalized_artifact_path(video_path)
+        if os.path.exists(artifact_path):
+            _set_normalize_job(key, status='ready', progress=100, artifact=artifact_path)
+            return
+        
+        probe = probe_video(video_path)
+        temp_path = f"{artifact_path}.part"
+        args = build_normalize_args(video_path, probe, temp_path)
+        if args is None:
+            _set_normalize_job(key, status='ready', progress=100, artifact=None)
+            return
+        
+        _set_normalize_job(key, status='running', progress=0, started_at=datetime.now(jakarta_tz).isoformat())
+        log(f"NORMALIZE: Processing {video_file}")
+        
+        duration_us = (probe or {}).get('duration', 0) * 1_000_000
+        started = time.perf_counter()
+        # stderr goes to a file: a corrupt source can print more decode errors
+        # than a pipe holds while we are still reading progress from stdout
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(['nice', '-n', '15', FFMPEG_BIN, *args],
+                                       stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+            for line in process.stdout:
+                key_name, _, value = line.strip().partition('=')
+                if key_name == 'out_time_us' and duration_us > 0 and value.isdigit():
+                    _set_normalize_job(key, progress=min(99, int(int(value) * 100 / duration_us)))
+            
+            returncode = process.wait()
+            record_subprocess(process.args, started, 'ok' if returncode == 0 else 'failed')
+            if returncode != 0:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                stderr_file.seek(max(0, stderr_file.seek(0, os.SEEK_END) - 4096))
+                stderr = stderr_file.read().decode('utf-8', 'replace').strip()
+                raise RuntimeError(stderr.splitlines()[-1] if stderr else f"ffmpeg exited with {returncode}")
+        
+        os.replace(temp_path, artifact_path)
+        _set_normalize_job(key, status='ready', progress=100, artifact=artifact_path, attempts=0,
+                           finished_at=datetime.now(jakarta_tz).isoformat())
+        log(f"NORMALIZE: {video_file} ready as {os.path.basename(artifact_path)}")
+        
+    except Exception as e:
+        with _normalize_lock:
+            job = normalize_jobs.setdefault(key, {})
+            attempts = job.get('attempts', 0) + 1
+            delay = min(NORMALIZE_RETRY_MAX_SECONDS, NORMALIZE_RETRY_SECONDS * 2 ** (attempts - 1))
+            job.update(status='failed', error=str(e), attempts=attempts, retry_at=time.time() + delay)
+        log(f"NORMALIZE ERROR: Failed to normalize {video_file} (attempt {attempts}, retry in {delay}s): {e}")
+
+def get_referenced_artifacts():
+    """Artifact names that stream scripts or playlist slots currently point at"""
+    referenced = set()
+    for session_id in load_sessions(readonly=True).get('active_sessions', {}):
+        service_name = get_service_name(session_id)
+        try:
+            with open(get_stream_script_path(service_name)) as f:
+                referenced.update(ARTIFACT_NAME_PATTERN.findall(f.read()))
+        except OSError:
+            pass
+        playlist_dir = get_playlist_dir(service_name)
+        if os.path.isdir(playlist_dir):
+            for slot in os.listdir(playlist_dir):
+                slot_path = os.path.join(playlist_dir, slot)
+                if os.path.islink(slot_path):
+                    referenced.update(ARTIFACT_NAME_PATTERN.findall(os.path.basename(os.readlink(slot_path))))
+    return referenced
+
+def scan_videos_for_normalization():
+    """Queue every library video that has no artifact yet and drop orphaned artifacts"""
+    try:
+        os.makedirs(NORMALIZED_DIR, exist_ok=True)
+        wanted = set()
+        files = {}
+        now = time.time()
+        
+        for video_file in get_video_files():
+            video_path = os.path.join(VIDEOS_DIR, video_file)
+            if now - os.path.getmtime(video_path) < NORMALIZE_SETTLE_SECONDS:
+                # Still being written: keep whatever it mapped to until it settles
+                previous = _normalize_files.get(video_file)
+                if previous:
+                    files[video_file] = previous
+                    wanted.add(f"{previous}-{NORMALIZE_PROFILE_ID}.mp4")
+                continue
+            key = content_hash(video_path)
+            files[video_file] = key
+            wanted.add(f"{key}-{NORMALIZE_PROFILE_ID}.mp4")
+            
+            with _normalize_lock:
+                job = normalize_jobs.get(key, {})
+            status = job.get('status')
+            if status in ('queued', 'running', 'ready'):
+                continue
+            if status == 'failed' and now < job.get('retry_at', 0):
+                continue
+            _set_normalize_job(key, status='queued', progress=0)
+            _normalize_pool.submit(normalize_video, key, video_file)
+        
+        with _normalize_lock:
+            _normalize_files.clear()
+            _normalize_files.update(files)
+            library = {os.path.join(VIDEOS_DIR, video_file) for video_file in files}
+            for video_path in set(_content_hash_cache) - library:
+                del _content_hash_cache[video_path]
+            for key in set(normalize_jobs) - set(files.values()):
+                if normalize_jobs[key].get('status') not in ('queued', 'running'):
+                    del normalize_jobs[key]
+        
+        wanted |= get_referenced_artifacts()
+        for artifact in os.listdir(NORMALIZED_DIR):
+            if artifact.endswith('.mp4') and artifact not in wanted:
+                os.remove(os.path.join(NORMALIZED_DIR, artifact))
+                log(f"NORMALIZE: Removed orphaned artifact {artifact}")
+                
+    except Exception as e:
+        log(f"NORMALIZE ERROR: Scan failed: {e}")
+
+def get_normalization_status():
+    """Get the normalization status of every known video"""
+    if not is_leader():
+        return load_leader_snapshot('normalization', {})
+    with _normalize_lock:
+        return {
+            video_file: dict(normalize_jobs[key])
+            for video_file, key in _normalize_files.items() if key in normalize_jobs
+        }
+
+def get_stream_source(video_path):
+    """Get the file a session should stream: the normalized artifact when it is ready"""
+    try:
+        artifact_path = normalized_artifact_path(video_path)
+        if os.path.exists(artifact_path):
+            return artifact_path
+    except OSError:
+        pass
+    return video_path
+
+# Telemetry
+# Every stream's ffmpeg sends its -progress blocks as UDP datagrams to one
+# collector socket. UDP keeps ffmpeg independent of the panel: if nobody is
+# listening the datagrams are simply dropped. Each session binds a fixed
+# local port from TELEMETRY_PORT_RANGE, which is how the collector tells
+# streams apart. Samples go into a fixed-size ring buffer per session.
+# Only the leader collects; other workers read the summaries it mirrors into
+# the state store, and port reservations live there too.
+TELEMETRY_HOST = '127.0.0.1'
+TELEMETRY_PORT = int(os.environ.get('STREAMHIB_TELEMETRY_PORT', 5010))
+TELEMETRY_PORT_RANGE = (29000, 29999)  # below the kernel's ephemeral range
+TELEMETRY_SAMPLES = 120  # ~1 minute at ffmpeg's 0.5 s progress interval
+TELEMETRY_PUSH_SECONDS = 5
+TELEMETRY_RESERVATION_SECONDS = 300  # allocated ports are saved with the session well within this
+TELEMETRY_MISS_SECONDS = 5  # unknown ports are not looked up again for this long
+
+_telemetry_buffers = {}
+_telemetry_partial = {}
+_telemetry_ports = {}
+_telemetry_port_misses = {}  # port -> monotonic time the miss expires
+_telemetry_lock = threading.Lock()
+_telemetry_started = False
+
+def allocate_telemetry_port(session_id, session_info):
+    """Get the session's telemetry source port, allocating a free one if needed"""
+    port = session_info.get('telemetry_port')
+    sessions_data = load_sessions(readonly=True)
+    used = {
+        info.get('telemetry_port')
+        for bucket in ('active_sessions', 'scheduled_sessions')
+        for other_id, info in sessions_data.get(bucket, {}).items()
+        if other_id != session_id
+    }
+    # Ports handed out but not saved yet, e.g. during a recovery batch, in any worker
+    with state_transaction() as conn:
+        now = time.time()
+        for other_id, data in conn.execute(
+            'SELECT key, data FROM state_records WHERE doc = ?', ('telemetry_ports',)
+        ).fetchall():
+            reserved_port, reserved_at = json.loads(data)
+            if now - reserved_at > TELEMETRY_RESERVATION_SECONDS:
+                conn.execute('DELETE FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+                             ('telemetry_ports', '', other_id))
+            elif other_id != session_id:
+                used.add(reserved_port)
+        if port is None or port in used:
+            port = next(p for p in range(TELEMETRY_PORT_RANGE[0], TELEMETRY_PORT_RANGE[1] + 1) if p not in used)
+            session_info['telemetry_port'] = port
+        conn.execute('INSERT OR REPLACE INTO state_records (doc, bucket, key, data) VALUES (?, ?, ?, ?)',
+                     ('telemetry_ports', '', session_id, json.dumps([port, now])))
+    with _telemetry_lock:
+        _telemetry_ports.pop(port, None)
+        _telemetry_port_misses.pop(port, None)
+    return port
+
+def get_telemetry_url(session_info):
+    """Get the -progress URL for a session"""
+    port = session_info.get('telemetry_port')
+    if port is None:
+        return 'pipe:1'
+    return f"udp://{TELEMETRY_HOST}:{TELEMETRY_PORT}?localport={port}"
+
+def _parse_progress_block(fields):
+    """Turn one ffmpeg -progress block into a telemetry sample"""
+    def number(key, strip=''):
+        try:
+            return float(fields.get(key, '').rstrip(strip))
+        except ValueError:
+            return None
+    
+    out_time_us = number('out_time_us')
+    if out_time_us is None:
+        out_time_us = number('out_time_ms')  # older ffmpeg reports microseconds here too
+    return {
+        't': time.time(),
+        'frame': number('frame'),
+        'fps': number('fps'),
+        'speed': number('speed', 'x'),
+        'bitrate_kbps': number('bitrate', 'kbits/s'),
+        'out_time': out_time_us / 1_000_000 if out_time_us is not None else None,
+        'drop_frames': number('drop_frames'),
+        'dup_frames': number('dup_frames'),
+        'total_size': number('total_size'),
+        'progress': fields.get('progress')
+    }
+
+def _telemetry_session_for_port(port):
+    """Map a telemetry source port to a session id
+
+    Hits and misses are cached; a miss is looked up in the session index,
+    which is only rebuilt when the sessions document changes.
+    """
+    now = time.monotonic()
+    with _telemetry_lock:
+        session_id = _telemetry_ports.get(port)
+        if session_id is not None or _telemetry_port_misses.get(port, 0) > now:
+            return session_id
+    
+    sessions_data = load_sessions(readonly=True)
+    with _state_cache_lock:
+        session_id = _session_index_for(sessions_data)['by_port'].get(port)
+    with _telemetry_lock:
+        if session_id is None:
+            _telemetry_port_misses[port] = now + TELEMETRY_MISS_SECONDS
+        else:
+            _telemetry_ports[port] = session_id
+    return session_id
+
+def record_progress(session_id, payload):
+    """Feed raw -progress text for a session into its ring buffer"""
+    with _telemetry_lock:
+        fields = _telemetry_partial.setdefault(session_id, {})
+        for line in payload.splitlines():
+            key, sep, value = line.strip().partition('=')
+            if not sep:
+                continue
+            fields[key] = value
+            if key == 'progress':
+                buffer = _telemetry_buffers.get(session_id)
+                if buffer is None:
+                    buffer = _telemetry_buffers[session_id] = deque(maxlen=TELEMETRY_SAMPLES)
+                buffer.append(_parse_progress_block(fields))
+                fields = _telemetry_partial[session_id] = {}
+
+def _telemetry_collector_loop(sock):
+    """Receive progress datagrams until the process exits"""
+    while True:
+        try:
+            payload, (host, port) = sock.recvfrom(65535)
+            if host != TELEMETRY_HOST:
+                continue
+            session_id = _telemetry_session_for_port(port)
+            if session_id is not None:
+                record_progress(session_id, payload.decode('utf-8', 'replace'))
+        except Exception as e:
+            log(f"TELEMETRY ERROR: {e}")
+
+def summarize_telemetry(session_id):
+    """Summarize the buffered samples of a session"""
+    if not _telemetry_started:
+        return load_leader_snapshot('telemetry', {}).get(session_id)
+    with _telemetry_lock:
+        samples = list(_telemetry_buffers.get(session_id, ()))
+    if not samples:
+        return None
+    
+    def average(key):
+        values = [s[key] for s in samples if s[key] is not None]
+        return round(sum(values) / len(values), 3) if values else None
+    
+    first, last = samples[0], samples[-1]
+    drops = (last['drop_frames'] or 0) - (first['drop_frames'] or 0)
+    return {
+        'session_id': session_id,
+        'samples': len(samples),
+        'window_seconds': round(last['t'] - first['t'], 1),
+        'last_sample_age': round(time.time() - last['t'], 1),
+        'fps': last['fps'],
+        'speed': last['speed'],
+        'bitrate_kbps': last['bitrate_kbps'],
+        'out_time': last['out_time'],
+        'drop_frames': last['drop_frames'],
+        'dup_frames': last['dup_frames'],
+        'avg_fps': average('fps'),
+        'avg_speed': average('speed'),
+        'avg_bitrate_kbps': average('bitrate_kbps'),
+        'drops_in_window': drops
+    }
+
+def get_telemetry_summaries(session_ids=None):
+    """Summaries for the given sessions, or every session with samples"""
+    if not _telemetry_started:
+        summaries = load_leader_snapshot('telemetry', {})
+        return summaries if session_ids is None else {s: summaries[s] for s in session_ids if s in summaries}
+    with _telemetry_lock:
+        known = list(_telemetry_buffers)
+    wanted = known if session_ids is None else [s for s in session_ids if s in known]
+    return {session_id: summarize_telemetry(session_id) for session_id in wanted}
+
+def _telemetry_push_loop():
+    """Push telemetry summaries to clients and forget ended sessions"""
+    while True:
+        socketio.sleep(TELEMETRY_PUSH_SECONDS)
+        try:
+            active_sessions = load_sessions(readonly=True).get('active_sessions', {})
+            active = set(active_sessions)
+            with _telemetry_lock:
+                for session_id in list(_telemetry_buffers):
+                    if session_id not in active:
+                        del _telemetry_buffers[session_id]
+                        _telemetry_partial.pop(session_id, None)
+                # Ports may have been reassigned by another worker
+                _telemetry_ports.clear()
+                _telemetry_port_misses.clear()
+            for session_id, summary in get_telemetry_summaries().items():
+                owner = active_sessions.get(session_id, {}).get('username')
+                rooms = [ADMIN_ROOM] + ([get_user_room(owner)] if owner else [])
+                publish_delta('stream_telemetry', rooms, session_id, summary)
+        except Exception as e:
+            log(f"TELEMETRY ERROR: Push failed: {e}")
+
+def start_telemetry_collector():
+    """Bind the collector socket and start the receive and push loops"""
+    global _telemetry_started
+    if _telemetry_started:
+        return
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((TELEMETRY_HOST, TELEMETRY_PORT))
+    except OSError as e:
+        log(f"TELEMETRY ERROR: Cannot bind {TELEMETRY_HOST}:{TELEMETRY_PORT}: {e}")
+        return
+    _telemetry_started = True
+    threading.Thread(target=_telemetry_collector_loop, args=(sock,), daemon=True).start()
+    socketio.start_background_task(_telemetry_push_loop)
+    log(f"TELEMETRY: Collecting ffmpeg progress on udp://{TELEMETRY_HOST}:{TELEMETRY_PORT}")
+
+# Recovery pipeline
+# Orphaned sessions are recovered in two phases: write every stream script,
+# then start the stream@ instances from a bounded worker pool that is also
+# rate limited so a node reboot does not launch every encoder in the same
+# instant. systemd only reloads when the template itself was (re)installed.
+RECOVERY_CONCURRENCY = int(os.environ.get('STREAMHIB_RECOVERY_CONCURRENCY', 4))
+RECOVERY_START_RATE = float(os.environ.get('STREAMHIB_RECOVERY_START_RATE', 2.0))  # starts per second
+RECOVERY_ORDER = os.environ.get('STREAMHIB_RECOVERY_ORDER', 'oldest_first')  # oldest_first or newest_first
+
+recovery_lock = FileLock('streamhib.recovery.lock', thread_local=False)  # one run across all workers
+
+def order_recovery_queue(candidates):
+    """Sort (session_id, session_info) pairs by the recovery ordering policy"""
+    return sorted(
+        candidates,
+        key=lambda item: item[1].get('started_at') or '',
+        reverse=(RECOVERY_ORDER == 'newest_first')
+    )
+
+def make_start_limiter(rate):
+    """Build a blocking limiter that spaces calls at most `rate` per second"""
+    limiter_lock = threading.Lock()
+    next_slot = [time.monotonic()]
+    interval = 1.0 / rate if rate > 0 else 0.0
+    
+    def wait_for_slot():
+        with limiter_lock:
+            now = time.monotonic()
+            slot = max(now, next_slot[0])
+            next_slot[0] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+    
+    return wait_for_slot
+
+def start_recovered_sessions(queue):
+    """Start units for queued sessions through a bounded, rate-limited pool"""
+    wait_for_slot = make_start_limiter(RECOVERY_START_RATE)
+    
+    def start_one(item):
+        session_id, session_info = item
+        service_name = get_service_name(session_id)
+        try:
+            admit_session(session_id, session_info['cpu_cost'])
+        except RuntimeError as e:
+            # Left orphaned, the next recovery run tries again
+            log(f"RECOVERY: Deferred session {session_id[:8]}: {e}", session_id=session_id)
+            return {'outcome': 'deferred', 'session_id': session_id, 'service': service_name,
+                    'error': str(e), 'start_ms': 0}
+        wait_for_slot()
+        started = time.perf_counter()
+        try:
+            apply_stream_quota(service_name, session_info['cpu_cost'])
+            run_systemctl('start', service_name, check=True)
+            session_info['recovered_at'] = datetime.now(jakarta_tz).isoformat()
+            upsert_session('active_sessions', session_id, session_info)
+            log(f"RECOVERY: Successfully recovered session {session_id[:8]} for user {session_info.get('username', 'unknown')}", session_id=session_id)
+            outcome = {'outcome': 'recovered'}
+        except Exception as e:
+            release_session(session_id)
+            log(f"RECOVERY ERROR: Failed to start {service_name}: {e}", session_id=session_id, service=service_name)
+            outcome = {'outcome': 'failed', 'error': str(e)}
+        outcome.update({
+            'session_id': session_id,
+            'service': service_name,
+            'start_ms': round((time.perf_counter() - started) * 1000, 2)
+        })
+        return outcome
+    
+    if not queue:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, RECOVERY_CONCURRENCY)) as pool:
+        return list(pool.map(start_one, queue))
+
+def record_cycle(cycle, started, result, outcomes=None):
+    """Record the duration and per-item outcomes of a recovery or cleanup run"""
+    labels = (('cycle', cycle),)
+    if started is not None:
+        observe_metric('streamhib_cycle_duration_seconds', labels, time.perf_counter() - started)
+    count_metric('streamhib_cycle_runs_total', labels + (('result', result),))
+    for outcome, count in (outcomes or {}).items():
+        count_metric('streamhib_cycle_items_total', labels + (('outcome', outcome),), count)
+
+def recovery_orphaned_sessions():
+    """Recovery function for orphaned sessions"""
+    try:
+        recovery_lock.acquire(timeout=0)
+    except Timeout:
+        log("RECOVERY: Another recovery run is in progress, skipping")
+        record_cycle('recovery', None, 'skipped')
+        return {'recovered': 0, 'moved_to_inactive': 0, 'failed': 0, 'deferred': 0, 'total_active': 0,
+                'probe_ms': 0, 'skipped': True, 'sessions': []}
+    cycle_started = time.perf_counter()
+    try:
+        log("RECOVERY: Starting orphaned session recovery...")
+        
+        sessions_data = load_sessions()
+        active_sessions = sessions_data.get('active_sessions', {})
+        
+        outcomes = []
+        queue = []
+        
+        for service_name, session_ids in get_service_collisions().items():
+            log(f"RECOVERY WARNING: Service {service_name} is shared by sessions {', '.join(session_ids)}", service=service_name)
+        
+        if migrate_legacy_stream_units():
+            sessions_data = load_sessions()
+            active_sessions = sessions_data.get('active_sessions', {})
+        
+        # Check all stream services in one probe
+        unit_states = get_stream_unit_states()
+        log(f"RECOVERY: Probed {last_unit_probe['units']} stream units in {last_unit_probe['duration_ms']} ms")
+        
+        sync_admitted_sessions({
+            session_id: session_info for session_id, session_info in active_sessions.items()
+            if is_unit_active(unit_states, get_service_name(session_id))
+        })
+        
+        for session_id, session_info in list(active_sessions.items()):
+            service_name = get_service_name(session_id)
+            if is_unit_active(unit_states, service_name) or is_backing_off(session_info):
+                continue
+            
+            log(f"RECOVERY: Found orphaned session {session_id[:8]}...", session_id=session_id)
+            try:
+                video_path = os.path.join(VIDEOS_DIR, session_info.get('video_file', ''))
+                
+                if os.path.exists(video_path):
+                    # Phase 1: write the stream script, start it later
+                    write_stream_script(session_id, session_info, video_path)
+                    session_info['cpu_cost'] = estimate_session_cost(session_info, video_path)
+                    queue.append((session_id, session_info))
+                else:
+                    # Video file doesn't exist, move to inactive
+                    session_info['ended_at'] = datetime.now(jakarta_tz).isoformat()
+                    session_info['end_reason'] = 'video_file_missing'
+                    move_session(session_id, 'active_sessions', 'inactive_sessions', session_info)
+                    
+                    del active_sessions[session_id]
+                    outcomes.append({'session_id': session_id, 'service': service_name, 'outcome': 'moved_to_inactive'})
+                    log(f"RECOVERY: Moved session {session_id[:8]} to inactive (video file missing)", session_id=session_id)
+                    
+            except Exception as e:
+                log(f"RECOVERY ERROR: Failed to process session {session_id[:8]}: {e}", session_id=session_id)
+                outcomes.append({'session_id': session_id, 'service': service_name, 'outcome': 'failed', 'error': str(e)})
+        
+        if queue:
+            if ensure_stream_template():
+                run_systemctl('daemon-reload', check=True)
+            prewarm_sources(os.path.join(VIDEOS_DIR, info.get('video_file', '')) for _, info in queue)
+            
+            # Phase 2: start in policy order through the worker pool
+            outcomes.extend(start_recovered_sessions(order_recovery_queue(queue)))
+        
+        recovered_count = sum(1 for o in outcomes if o['outcome'] == 'recovered')
+        moved_to_inactive = sum(1 for o in outcomes if o['outcome'] == 'moved_to_inactive')
+        failed_count = sum(1 for o in outcomes if o['outcome'] == 'failed')
+        deferred_count = sum(1 for o in outcomes if o['outcome'] == 'deferred')
+        
+        recovery_result = {
+            'recovered': recovered_count,
+            'moved_to_inactive': moved_to_inactive,
+            'failed': failed_count,
+            'deferred': deferred_count,
+            'total_active': len(active_sessions),
+            'probe_ms': last_unit_probe['duration_ms'],
+            'sessions': outcomes
+        }
+        
+        log(f"RECOVERY: Completed - Recovered: {recovered_count}, Moved to inactive: {moved_to_inactive}, Failed: {failed_count}, Deferred: {deferred_count}")
+        record_cycle('recovery', cycle_started, 'ok', {
+            'recovered': recovered_count, 'moved_to_inactive': moved_to_inactive,
+            'failed': failed_count, 'deferred': deferred_count
+        })
+        publish_snapshot('recovery_update', ADMIN_ROOM, recovery_result)
+        return recovery_result
+        
+    except Exception as e:
+        log(f"RECOVERY ERROR: {e}")
+        record_cycle('recovery', cycle_started, 'error')
+        return {'recovered': 0, 'moved_to_inactive': 0, 'failed': 0, 'deferred': 0, 'total_active': 0,
+                'probe_ms': 0, 'sessions': []}
+    finally:
+        recovery_lock.release()
+
+def cleanup_unused_services():
+    """Cleanup unused systemd services"""
+    cycle_started = time.perf_counter()
+    try:
+        log("RECOVERY: Starting service cleanup...")
+        
+        active_services = get_active_service_names()
+        
+        # Get all stream services
+        unit_states = get_stream_unit_states()
+        
+        cleanup_count = 0
+        legacy_removed = False
+        
+        for service_name in unit_states:
+            # Check if an active session owns this service
+            if service_name in active_services:
+                continue
+            
+            try:
+                run_systemctl('stop', service_name, check=True)
+                
+                if service_name.startswith('stream@'):
+                    remove_stream_script(service_name)
+                else:
+                    # Legacy per-session unit
+                    run_systemctl('disable', service_name, check=True)
+                    service_file = os.path.join(SYSTEMD_UNIT_DIR, f"{service_name}.service")
+                    if os.path.exists(service_file):
+                        os.remove(service_file)
+                        legacy_removed = True
+                
+                cleanup_count += 1
+                log(f"RECOVERY: Cleaned up unused service {service_name}", service=service_name)
+                
+            except Exception as e:
+                log(f"RECOVERY ERROR: Failed to cleanup {service_name}: {e}", service=service_name)
+        
+        # Drop scripts of instances systemd has already forgotten
+        if os.path.isdir(STREAM_SCRIPT_DIR):
+            for script in os.listdir(STREAM_SCRIPT_DIR):
+                service_name = f"stream@{os.path.splitext(script)[0]}"
+                if (script.endswith(('.sh', '.playlist'))
+                        and service_name not in active_services and service_name not in unit_states):
+                    remove_stream_script(service_name)
+        
+        # Only removed unit files require systemd to reload
+        if legacy_removed:
+            run_systemctl('daemon-reload', check=True)
+        
+        log(f"RECOVERY: Service cleanup completed - Removed: {cleanup_count}")
+        record_cycle('cleanup', cycle_started, 'ok', {'removed': cleanup_count})
+        return cleanup_count
+        
+    except Exception as e:
+        log(f"RECOVERY ERROR: Service cleanup failed: {e}")
+        record_cycle('cleanup', cycle_started, 'error')
+        return 0
+
+# Admission control
+# Every stream is charged an estimated CPU cost in cores before it starts:
+# remuxing is nearly free, audio-only re-encodes are cheap, and a full
+# transcode costs a calibrated amount per pixel per second. The per-pixel
+# figure comes from a short libx264 benchmark of a synthetic 720p30 source
+# run once per node (cached in the state store). Starts are admitted only
+# while the committed total stays under cpu_count * ADMISSION_HEADROOM;
+# otherwise they wait up to ADMISSION_QUEUE_SECONDS for a stream to stop, or
+# are rejected. Each admitted instance also gets a runtime CPUQuota so one
+# runaway encode cannot starve the rest. The ledger of admitted streams and
+# the counters live in the `admission` document and every admission is one
+# write transaction, so workers share the node's capacity.
+NODE_CPUS = os.cpu_count() or 1
+ADMISSION_HEADROOM = float(os.environ.get('STREAMHIB_ADMISSION_HEADROOM', 0.8))
+ADMISSION_QUEUE_SECONDS = float(os.environ.get('STREAMHIB_ADMISSION_QUEUE_SECONDS', 0))
+ADMISSION_QUOTA_FACTOR = 1.5  # CPUQuota as a multiple of the estimate, leaves room for spikes
+COPY_STREAM_COST = 0.03
+AUDIO_STREAM_COST = 0.08
+DEFAULT_PIXEL_COST = 2.0e-8  # core-seconds per pixel, used until calibration finishes
+PRESET_COST_FACTORS = {'veryfast': 1.0, 'superfast': 0.7, 'ultrafast': 0.45}  # relative to the calibrated preset
+CALIBRATION_SIZE = (1280, 720)
+CALIBRATION_FPS = 30
+CALIBRATION_SECONDS = 3
+ADMISSION_POLL_SECONDS = 1  # queued starts also notice streams stopped by other workers
+
+ADMISSION_OUTCOMES = ('admitted', 'queued', 'rejected')
+_admission_cond = threading.Condition()
+_pixel_cost = {'value': DEFAULT_PIXEL_COST, 'calibrated': False}
+
+def get_node_capacity():
+    """Cores streams may commit"""
+    return NODE_CPUS * ADMISSION_HEADROOM
+
+def _calibration_key():
+    return hashlib.sha1(json.dumps([FFMPEG_BIN, NODE_CPUS, ENCODING_PROFILES[DEFAULT_ENCODING_PROFILE]]).encode()).hexdigest()[:12]
+
+def get_pixel_cost():
+    """Transcode cost per pixel, picking up a calibration finished by another worker"""
+    if not _pixel_cost['calibrated']:
+        cached = load_state_record('node', 'pixel_cost', bucket=_calibration_key())
+        if cached is not None:
+            _pixel_cost.update(value=cached, calibrated=True)
+    return _pixel_cost['value']
+
+def calibrate_admission():
+    """Measure the transcode cost per pixel with a short local benchmark"""
+    cached = load_state_record('node', 'pixel_cost', bucket=_calibration_key())
+    if cached is not None:
+        _pixel_cost.update(value=cached, calibrated=True)
+        return cached
+    
+    width, height = CALIBRATION_SIZE
+    frames = CALIBRATION_FPS * CALIBRATION_SECONDS
+    try:
+        result = run_command(
+            [FFMPEG_BIN, '-nostdin', '-benchmark', '-f', 'lavfi',
+             '-i', f"testsrc2=size={width}x{height}:rate={CALIBRATION_FPS}",
+             '-frames:v', str(frames),
+             *build_transcode_video_args(DEFAULT_ENCODING_PROFILE, {'height': height, 'fps': CALIBRATION_FPS}),
+             '-f', 'null', '-'],
+            capture_output=True, text=True, timeout=120
+        )
+        match = re.search(r'bench: utime=([\d.]+)s stime=([\d.]+)s', result.stderr)
+        if result.returncode != 0 or not match:
+            raise RuntimeError(result.stderr.strip()[-200:] or f"exit code {result.returncode}")
+        cpu_seconds = float(match.group(1)) + float(match.group(2))
+        pixel_cost = cpu_seconds / (width * height * frames)
+    except Exception as e:
+        log(f"ADMISSION ERROR: Calibration failed, using the default estimate: {e}")
+        return _pixel_cost['value']
+    
+    save_state_record('node', 'pixel_cost', pixel_cost, bucket=_calibration_key())
+    _pixel_cost.update(value=pixel_cost, calibrated=True)
+    log(f"ADMISSION: Calibrated transcode cost at {pixel_cost * 1280 * 720 * 30:.2f} cores per 720p30 stream")
+    return pixel_cost
+
+def estimate_session_cost(session_info, video_path):
+    """Estimate the cores a session needs to stream in real time"""
+    source = get_stream_source(video_path)
+    mode = resolve_encoding_mode(session_info, source)
+    if mode == 'copy':
+        return COPY_STREAM_COST
+    if mode == 'audio':
+        return AUDIO_STREAM_COST
+    
+    probes = get_source_probes(session_info, source)
+    probe = probes[0] or {}
+    profile = get_active_profile(session_info)
+    if is_mixed_playlist(probes):
+        width, height, fps = get_playlist_frame(profile, probes)
+    else:
+        source_width = probe.get('width') or CALIBRATION_SIZE[0]
+        source_height = probe.get('height') or CALIBRATION_SIZE[1]
+        height = profile_output_height(profile, probe) or source_height
+        width = source_width * height / source_height
+        fps = probe.get('fps') or CALIBRATION_FPS
+    preset_factor = PRESET_COST_FACTORS.get(ENCODING_PROFILES[profile]['preset'], 1.0)
+    return round(AUDIO_STREAM_COST + get_pixel_cost() * preset_factor * width * height * fps, 3)
+
+def _read_admitted(conn):
+    """session_id -> cost in cores of every admitted stream"""
+    return {
+        key: json.loads(data)
+        for key, data in conn.execute(
+            'SELECT key, data FROM state_records WHERE doc = ? AND bucket = ?', ('admission', 'streams')
+        )
+    }
+
+def _set_admitted(conn, session_id, cost):
+    conn.execute('INSERT OR REPLACE INTO state_records (doc, bucket, key, data) VALUES (?, ?, ?, ?)',
+                 ('admission', 'streams', session_id, json.dumps(cost)))
+
+def _count_admission(conn, outcome):
+    conn.execute(
+        'INSERT INTO state_records (doc, bucket, key, data) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT(doc, bucket, key) DO UPDATE SET data = CAST(data AS INTEGER) + 1',
+        ('admission', 'stats', outcome, '1')
+    )
+
+def get_committed_capacity():
+    """Cores committed to admitted streams"""
+    return round(sum(_read_admitted(get_state_db()).values()), 3)
+
+def admit_session(session_id, cost, wait=0):
+    """Reserve capacity for a stream, raises RuntimeError if the node is full"""
+    deadline = time.monotonic() + wait
+    queued = False
+    while True:
+        with state_transaction() as conn:
+            admitted = _read_admitted(conn)
+            committed = sum(admitted.values())
+            current = admitted.get(session_id, 0)
+            # A lone stream is always admitted, it could never start otherwise;
+            # an admitted stream only needs room for what its new cost adds
+            fits = (not admitted.keys() - {session_id} or cost <= current
+                    or committed - current + cost <= get_node_capacity())
+            remaining = deadline - time.monotonic()
+            if fits:
+                _set_admitted(conn, session_id, cost)
+                _count_admission(conn, 'admitted')
+            elif remaining <= 0:
+                _count_admission(conn, 'rejected')
+            elif not queued:
+                _count_admission(conn, 'queued')
+        if fits:
+            return
+        if remaining <= 0:
+            raise RuntimeError(
+                f"Node is at capacity: {committed:.2f} of {get_node_capacity():.2f} cores "
+                f"committed, stream needs {cost:.2f}"
+            )
+        queued = True
+        with _admission_cond:
+            _admission_cond.wait(min(remaining, ADMISSION_POLL_SECONDS))
+
+def release_session(session_id):
+    """Return a stream's capacity and wake queued starts"""
+    with state_transaction() as conn:
+        released = conn.execute(
+            'DELETE FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+            ('admission', 'streams', session_id)
+        ).rowcount
+    if released:
+        with _admission_cond:
+            _admission_cond.notify_all()
+
+def sync_admitted_sessions(running_sessions):
+    """Align the committed capacity with the streams actually running"""
+    active = set(load_sessions(readonly=True).get('active_sessions', {}))
+    with state_transaction() as conn:
+        admitted = _read_admitted(conn)
+        for session_id in admitted:
+            if session_id not in active:
+                conn.execute('DELETE FROM state_records WHERE doc = ? AND bucket = ? AND key = ?',
+                             ('admission', 'streams', session_id))
+        for session_id, session_info in running_sessions.items():
+            if session_id not in admitted:
+                _set_admitted(conn, session_id, session_info.get('cpu_cost', COPY_STREAM_COST))
+    with _admission_cond:
+        _admission_cond.notify_all()
+
+def apply_stream_quota(service_name, cost):
+    """Cap a stream instance's CPU at a multiple of its estimate"""
+    quota = min(NODE_CPUS * 100, max(10, int(cost * 100 * ADMISSION_QUOTA_FACTOR)))
+    try:
+        run_systemctl('set-property', '--runtime', service_name, f"CPUQuota={quota}%", check=True)
+    except Exception as e:
+        log(f"ADMISSION ERROR: Failed to set CPUQuota on {service_name}: {e}", service=service_name)
+
+def get_admission_status():
+    """Capacity, commitment and counters of the admission controller"""
+    conn = get_state_db()
+    admitted = _read_admitted(conn)
+    committed = round(sum(admitted.values()), 3)
+    counters = dict.fromkeys(ADMISSION_OUTCOMES, 0)
+    counters.update(
+        (key, int(data)) for key, data in conn.execute(
+            'SELECT key, data FROM state_records WHERE doc = ? AND bucket = ?', ('admission', 'stats')
+        )
+    )
+    return {
+        'cpus': NODE_CPUS,
+        'capacity': round(get_node_capacity(), 3),
+        'committed': committed,
+        'available': round(get_node_capacity() - committed, 3),
+        'streams': len(admitted),
+        'pixel_cost': get_pixel_cost(),
+        'calibrated': _pixel_cost['calibrated'],
+        **counters
+    }
+
+def start_admission_calibration():
+    """Calibrate in the background so startup is not delayed"""
+    threading.Thread(target=calibrate_admission, daemon=True).start()
+
+# Pre-warm
+# Before a scheduled start, and before any batch of starts, the head of each
+# source video is pulled into the page cache with posix_fadvise(WILLNEED) so
+# ffmpeg's first reads don't wait on the disk. The page cache is shared, so
+# one readahead serves every stream of the same file; warm files are
+# remembered for PREWARM_TTL_SECONDS to avoid repeating the advice.
+# ffmpeg itself is not spawned early, as it would start pushing to the
+# ingest; instead the probe, template unit and prerequisite checks are done
+# ahead so go-live only has to write the script and start the unit.
+PREWARM_LEAD_SECONDS = int(os.environ.get('STREAMHIB_PREWARM_LEAD', 30))  # 0 disables scheduled pre-warm
+PREWARM_BYTES = int(os.environ.get('STREAMHIB_PREWARM_BYTES', 64 * 1024 * 1024))
+PREWARM_TTL_SECONDS = 60
+PREWARM_READ_CHUNK = 1024 * 1024
+
+_prewarmed_files = {}  # (path, inode, mtime_ns) -> monotonic time of the last readahead
+_prewarm_lock = threading.Lock()
+
+def prewarm_video(video_path):
+    """Read the head of a video into the page cache, returns True if advice was issued"""
+    st = os.stat(video_path)
+    warm_key = (os.path.abspath(video_path), st.st_ino, st.st_mtime_ns)
+    now = time.monotonic()
+    with _prewarm_lock:
+        if now - _prewarmed_files.get(warm_key, float('-inf')) < PREWARM_TTL_SECONDS:
+            return False
+        _prewarmed_files[warm_key] = now
+        for key, warmed_at in list(_prewarmed_files.items()):
+            if now - warmed_at >= PREWARM_TTL_SECONDS:
+                del _prewarmed_files[key]
+    
+    length = min(PREWARM_BYTES, st.st_size)
+    fd = os.open(video_path, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+        else:
+            # No fadvise on this platform, reading has the same effect
+            remaining = length
+            while remaining > 0:
+                chunk = os.read(fd, min(PREWARM_READ_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+    finally:
+        os.close(fd)
+    return True
+
+def prewarm_sources(video_paths):
+    """Pre-warm the stream sources of a batch of videos, each file once"""
+    for source in dict.fromkeys(get_stream_source(path) for path in video_paths):
+        try:
+            prewarm_video(source)
+        except OSError as e:
+            log(f"PREWARM ERROR: Failed to pre-warm {source}: {e}")
+
+def prepare_stream_start(session_info):
+    """Check and warm everything a session needs to go live, returns its source path"""
+    video_path = os.path.join(VIDEOS_DIR, session_info.get('video_file', ''))
+    if not os.path.exists(video_path):
+        raise FileNotFoundError(f"Video file not found: {session_info.get('video_file')}")
+    
+    source = get_stream_source(video_path)
+    prewarm_video(source)
+    if session_info.get('encoding_mode', 'auto') == 'auto':
+        probe_video(source)
+    if ensure_stream_template():
+        run_systemctl('daemon-reload', check=True)
+    return source
+
+# Stream lifecycle
+def start_stream_session(session_info):
+    """Start a new stream@ instance for a session, returns its session id"""
+    session_id = str(uuid.uuid4())
+    prepare_stream_start(session_info)
+    video_path = os.path.join(VIDEOS_DIR, session_info['video_file'])
+    
+    session_info['cpu_cost'] = estimate_session_cost(session_info, video_path)
+    admit_session(session_id, session_info['cpu_cost'], wait=ADMISSION_QUEUE_SECONDS)
+    
+    service_name = get_service_name(session_id)
+    try:
+        write_stream_script(session_id, session_info, video_path)
+        apply_stream_quota(service_name, session_info['cpu_cost'])
+        run_systemctl('start', service_name, check=True)
+    except Exception:
+        release_session(session_id)
+        remove_stream_script(service_name)
+        raise
+    
+    session_info['started_at'] = datetime.now(jakarta_tz).isoformat()
+    upsert_session('active_sessions', session_id, session_info)
+    return session_id
+
+def stop_stream_session(session_id, end_reason='stopped'):
+    """Stop a session's stream@ instance and move it to inactive"""
+    session_info = load_sessions(readonly=True).get('active_sessions', {}).get(session_id)
+    if session_info is None:
+        return False
+    
+    service_name = get_service_name(session_id)
+    run_systemctl('stop', service_name)
+    remove_stream_script(service_name)
+    release_session(session_id)
+    
+    session_info = _thaw(session_info)
+    session_info['ended_at'] = datetime.now(jakarta_tz).isoformat()
+    session_info['end_reason'] = end_reason
+    return move_session(session_id, 'active_sessions', 'inactive_sessions', session_info)
+
+# Scheduling
+# Schedules are APScheduler jobs kept in the `schedules` job store, a table in
+# the state database, so they survive restarts without rescanning sessions.
+# The schedule definitions shown to users stay in the scheduled_sessions
+# bucket. APScheduler sleeps until the next due job, so starts fire on time
+# rather than on a polling tick; start latency is measured from the planned
+# run time to the moment systemd accepted the start.
+# Missed starts older than SCHEDULE_MISFIRE_GRACE_SECONDS are skipped (daily
+# schedules simply wait for the next day); missed stops always run.
+SCHEDULE_MISFIRE_GRACE_SECONDS = int(os.environ.get('STREAMHIB_SCHEDULE_MISFIRE_GRACE', 300))
+SCHEDULE_LATENCY_SAMPLES = 500
+RECURRENCE_TYPES = ('one_time', 'daily')
+
+schedule_latencies = deque(maxlen=SCHEDULE_LATENCY_SAMPLES)
+
+class StateJobStore(BaseJobStore):
+    """APScheduler job store backed by the state database"""
+    
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        with state_transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS scheduler_jobs (
+                    id TEXT PRIMARY KEY,
+                    next_run_time REAL,
+                    job_state BLOB NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS scheduler_jobs_next_run ON scheduler_jobs (next_run_time)')
+    
+    def _reconstitute_job(self, job_state):
+        job = Job.__new__(Job)
+        job.__setstate__(pickle.loads(job_state))
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+    
+    def _get_jobs(self, where='', params=()):
+        rows = get_state_db().execute(
+            f'SELECT id, job_state FROM scheduler_jobs {where} '
+            'ORDER BY next_run_time IS NULL, next_run_time', params
+        ).fetchall()
+        jobs = []
+        for job_id, job_state in rows:
+            try:
+                jobs.append(self._reconstitute_job(job_state))
+            except Exception as e:
+                log(f"SCHEDULER ERROR: Dropping unrestorable job {job_id}: {e}")
+                self.remove_job(job_id)
+        return jobs
+    
+    def lookup_job(self, job_id):
+        row = get_state_db().execute('SELECT job_state FROM scheduler_jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._reconstitute_job(row[0]) if row else None
+    
+    def get_due_jobs(self, now):
+        return self._get_jobs('WHERE next_run_time <= ?', (datetime_to_utc_timestamp(now),))
+    
+    def get_next_run_time(self):
+        row = get_state_db().execute(
+            'SELECT MIN(next_run_time) FROM scheduler_jobs WHERE next_run_time IS NOT NULL'
+        ).fetchone()
+        return utc_timestamp_to_datetime(row[0]) if row and row[0] is not None else None
+    
+    def get_all_jobs(self):
+        jobs = self._get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+    
+    def add_job(self, job):
+        try:
+            with state_transaction() as conn:
+                conn.execute(
+                    'INSERT INTO scheduler_jobs (id, next_run_time, job_state) VALUES (?, ?, ?)',
+                    (job.id, datetime_to_utc_timestamp(job.next_run_time),
+                     pickle.dumps(job.__getstate__(), pickle.HIGHEST_PROTOCOL))
+                )
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+    
+    def update_job(self, job):
+        with state_transaction() as conn:
+            updated = conn.execute(
+                'UPDATE scheduler_jobs SET next_run_time = ?, job_state = ? WHERE id = ?',
+                (datetime_to_utc_timestamp(job.next_run_time),
+                 pickle.dumps(job.__getstate__(), pickle.HIGHEST_PROTOCOL), job.id)
+            ).rowcount
+        if not updated:
+            raise JobLookupError(job.id)
+    
+    def remove_job(self, job_id):
+        with state_transaction() as conn:
+            removed = conn.execute('DELETE FROM scheduler_jobs WHERE id = ?', (job_id,)).rowcount
+        if not removed:
+            raise JobLookupError(job_id)
+    
+    def remove_all_jobs(self):
+        with state_transaction() as conn:
+            conn.execute('DELETE FROM scheduler_jobs')
+
+def _parse_local_datetime(value):
+    """Parse a datetime-local form value as Jakarta time"""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else jakarta_tz.localize(parsed)
+
+def _parse_time_of_day(value):
+    """Parse an HH:MM form value"""
+    hour, minute = value.split(':')[:2]
+    return int(hour), int(minute)
+
+def build_schedule_triggers(schedule_info):
+    """Build the start trigger and optional stop trigger of a schedule"""
+    if schedule_info['recurrence_type'] == 'daily':
+        start_hour, start_minute = _parse_time_of_day(schedule_info['start_time_of_day'])
+        stop_hour, stop_minute = _parse_time_of_day(schedule_info['stop_time_of_day'])
+        return (CronTrigger(hour=start_hour, minute=start_minute, timezone=jakarta_tz),
+                CronTrigger(hour=stop_hour, minute=stop_minute, timezone=jakarta_tz))
+    
+    start_time = _parse_local_datetime(schedule_info['start_time'])
+    stop_trigger = None
+    if schedule_info.get('duration_minutes'):
+        stop_trigger = DateTrigger(run_date=start_time + timedelta(minutes=schedule_info['duration_minutes']))
+    return DateTrigger(run_date=start_time), stop_trigger
+
+def build_prewarm_trigger(schedule_info):
+    """Build the trigger firing PREWARM_LEAD_SECONDS before each start, None if disabled"""
+    if PREWARM_LEAD_SECONDS <= 0:
+        return None
+    
+    if schedule_info['recurrence_type'] == 'daily':
+        hour, minute = _parse_time_of_day(schedule_info['start_time_of_day'])
+        seconds_of_day = (hour * 3600 + minute * 60 - PREWARM_LEAD_SECONDS) % 86400
+        return CronTrigger(hour=seconds_of_day // 3600, minute=seconds_of_day % 3600 // 60,
+                           second=seconds_of_day % 60, timezone=jakarta_tz)
+    
+    prewarm_time = _parse_local_datetime(schedule_info['start_time']) - timedelta(seconds=PREWARM_LEAD_SECONDS)
+    if prewarm_time <= datetime.now(jakarta_tz):
+        return None
+    return DateTrigger(run_date=prewarm_time)
+
+def add_schedule_jobs(schedule_id, schedule_info):
+    """Register (or replace) the start/stop jobs of a schedule"""
+    start_trigger, stop_trigger = build_schedule_triggers(schedule_info)
+    scheduler.add_job(
+        run_scheduled_start, trigger=start_trigger, args=[schedule_id],
+        id=f"schedule-start:{schedule_id}", jobstore='schedules', replace_existing=True,
+        misfire_grace_time=SCHEDULE_MISFIRE_GRACE_SECONDS, coalesce=True
+    )
+    stop_job_id = f"schedule-stop:{schedule_id}"
+    if stop_trigger is not None:
+        scheduler.add_job(
+            run_scheduled_stop, trigger=stop_trigger, args=[schedule_id],
+            id=stop_job_id, jobstore='schedules', replace_existing=True,
+            misfire_grace_time=None, coalesce=True
+        )
+    elif scheduler.get_job(stop_job_id, jobstore='schedules'):
+        scheduler.remove_job(stop_job_id, jobstore='schedules')
+    
+    prewarm_job_id = f"schedule-prewarm:{schedule_id}"
+    prewarm_trigger = build_prewarm_trigger(schedule_info)
+    if prewarm_trigger is not None:
+        scheduler.add_job(
+            run_scheduled_prewarm, trigger=prewarm_trigger, args=[schedule_id],
+            id=prewarm_job_id, jobstore='schedules', replace_existing=True,
+            misfire_grace_time=PREWARM_LEAD_SECONDS, coalesce=True
+        )
+    elif scheduler.get_job(prewarm_job_id, jobstore='schedules'):
+        scheduler.remove_job(prewarm_job_id, jobstore='schedules')
+
+def remove_schedule_jobs(schedule_id):
+    """Remove the start/stop/pre-warm jobs of a schedule"""
+    for job_id in (f"schedule-start:{schedule_id}", f"schedule-stop:{schedule_id}", f"schedule-prewarm:{schedule_id}"):
+        if scheduler.get_job(job_id, jobstore='schedules'):
+            scheduler.remove_job(job_id, jobstore='schedules')
+
+def _finish_one_time_schedule(schedule_id, schedule_info, end_reason):
+    """Retire a one-time schedule that has nothing left to run"""
+    if schedule_info.get('active_session_id'):
+        return
+    schedule_info['ended_at'] = datetime.now(jakarta_tz).isoformat()
+    schedule_info['end_reason'] = end_reason
+    move_session(schedule_id, 'scheduled_sessions', 'inactive_sessions', schedule_info)
+
+def run_scheduled_start(schedule_id):
+    """Start the stream of a schedule"""
+    schedule_info = load_sessions(readonly=True).get('scheduled_sessions', {}).get(schedule_id)
+    if schedule_info is None:
+        log(f"SCHEDULER: Schedule {schedule_id[:8]} no longer exists, skipping start", session_id=schedule_id)
+        return
+    schedule_info = _thaw(schedule_info)
+    
+    previous_session_id = schedule_info.get('active_session_id')
+    if previous_session_id and previous_session_id in load_sessions(readonly=True).get('active_sessions', {}):
+        log(f"SCHEDULER: Schedule {schedule_id[:8]} is still live as {previous_session_id[:8]}, skipping start", session_id=schedule_id)
+        return
+    
+    session_id = start_stream_session({
+        'username': schedule_info.get('username'),
+        'video_file': schedule_info.get('video_file'),
+        'stream_key': schedule_info.get('stream_key'),
+        'destinations': schedule_info.get('destinations'),
+        'playlist': schedule_info.get('playlist'),
+        'loop': schedule_info.get('loop', False),
+        'encoding_profile': schedule_info.get('encoding_profile', DEFAULT_ENCODING_PROFILE),
+        'auto_adapt': schedule_info.get('auto_adapt', ADAPT_DEFAULT),
+        'platform': schedule_info.get('platform'),
+        'session_name': schedule_info.get('session_name_original'),
+        'schedule_id': schedule_id
+    })
+    schedule_info['active_session_id'] = session_id
+    schedule_info['last_started_at'] = datetime.now(jakarta_tz).isoformat()
+    
+    if schedule_info['recurrence_type'] == 'one_time' and not schedule_info.get('duration_minutes'):
+        # Runs until stopped by hand, the schedule itself is done
+        schedule_info.pop('active_session_id')
+        _finish_one_time_schedule(schedule_id, schedule_info, 'schedule_started')
+    else:
+        upsert_session('scheduled_sessions', schedule_id, schedule_info)
+    log(f"SCHEDULER: Started session {session_id[:8]} for schedule {schedule_id[:8]}", session_id=session_id, schedule_id=schedule_id)
+
+def run_scheduled_prewarm(schedule_id):
+    """Warm up a schedule's video and unit ahead of its start"""
+    schedule_info = load_sessions(readonly=True).get('scheduled_sessions', {}).get(schedule_id)
+    if schedule_info is None:
+        return
+    schedule_info = _thaw(schedule_info)
+    
+    started = time.perf_counter()
+    try:
+        prepare_stream_start(schedule_info)
+        schedule_info.pop('prewarm_error', None)
+    except Exception as e:
+        # The start still runs, the error is shown until then
+        log(f"PREWARM ERROR: Schedule {schedule_id[:8]} is not ready: {e}", session_id=schedule_id)
+        schedule_info['prewarm_error'] = str(e)
+    schedule_info['prewarmed_at'] = datetime.now(jakarta_tz).isoformat()
+    schedule_info['prewarm_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    upsert_session('scheduled_sessions', schedule_id, schedule_info)
+    log(f"PREWARM: Schedule {schedule_id[:8]} ready in {schedule_info['prewarm_ms']} ms", session_id=schedule_id)
+
+def run_scheduled_stop(schedule_id):
+    """Stop the stream of a schedule"""
+    schedule_info = load_sessions(readonly=True).get('scheduled_sessions', {}).get(schedule_id)
+    if schedule_info is None:
+        return
+    schedule_info = _thaw(schedule_info)
+    
+    session_id = schedule_info.pop('active_session_id', None)
+    if session_id:
+        stop_stream_session(session_id, end_reason='schedule_ended')
+        log(f"SCHEDULER: Stopped session {session_id[:8]} for schedule {schedule_id[:8]}", session_id=session_id, schedule_id=schedule_id)
+    
+    if schedule_info['recurrence_type'] == 'one_time':
+        _finish_one_time_schedule(schedule_id, schedule_info, 'schedule_completed')
+    else:
+        upsert_session('scheduled_sessions', schedule_id, schedule_info)
+
+def _on_schedule_job_event(event):
+    """Record start latency and handle missed or failed schedule jobs"""
+    if not event.job_id.startswith('schedule-start:'):
+        return
+    schedule_id = event.job_id.split(':', 1)[1]
+    
+    if event.code == EVENT_JOB_EXECUTED:
+        latency_ms = (datetime.now(pytz.utc) - event.scheduled_run_time).total_seconds() * 1000
+        schedule_latencies.append(latency_ms)
+        return
+    
+    schedule_info = load_sessions(readonly=True).get('scheduled_sessions', {}).get(schedule_id)
+    if schedule_info is None:
+        return
+    schedule_info = _thaw(schedule_info)
+    
+    if event.code == EVENT_JOB_MISSED:
+        log(f"SCHEDULER: Missed start of schedule {schedule_id[:8]} planned for {event.scheduled_run_time}", session_id=schedule_id)
+        end_reason = 'schedule_missed'
+    else:
+        log(f"SCHEDULER ERROR: Start of schedule {schedule_id[:8]} failed: {event.exception}", session_id=schedule_id)
+        end_reason = 'schedule_failed'
+    schedule_info['last_error'] = end_reason
+    
+    if schedule_info['recurrence_type'] == 'one_time':
+        remove_schedule_jobs(schedule_id)
+        _finish_one_time_schedule(schedule_id, schedule_info, end_reason)
+    else:
+        upsert_session('scheduled_sessions', schedule_id, schedule_info)
+
+def _on_job_metrics_event(event):
+    """Record scheduler lag and missed or failed runs of every job"""
+    if event.jobstore == 'schedules':
+        job = 'watchdog_resume' if event.job_id.startswith('watchdog-resume:') else 'schedule'
+    else:
+        job = event.job_id
+    if event.code == EVENT_JOB_SUBMITTED:
+        lag = (datetime.now(pytz.utc) - max(event.scheduled_run_times)).total_seconds()
+        observe_metric('streamhib_scheduler_job_lag_seconds', (('job', job),), max(0.0, lag))
+    else:
+        outcome = 'missed' if event.code == EVENT_JOB_MISSED else 'error'
+        count_metric('streamhib_scheduler_job_failures_total', (('job', job), ('outcome', outcome)))
+
+def get_schedule_latency_stats():
+    """Summarize measured schedule start latencies in milliseconds"""
+    if not is_leader():
+        return load_leader_snapshot('schedule_latency', {'count': 0})
+    samples = sorted(schedule_latencies)
+    if not samples:
+        return {'count': 0}
+    
+    def percentile(p):
+        return round(samples[min(len(samples) - 1, int(p / 100 * len(samples)))], 1)
+    
+    return {
+        'count': len(samples),
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p99_ms': percentile(99),
+        'max_ms': round(samples[-1], 1)
+    }
+
+# Adaptive encoding
+# Transcoding sessions with `auto_adapt` are watched through their telemetry.
+# When ffmpeg's speed stays under ADAPT_DOWN_SPEED for ADAPT_DOWN_WINDOW
+# seconds the session restarts one rung lower on PROFILE_LADDER. Because -re
+# pins a healthy stream at 1.0x, speed alone can't show headroom, so a step
+# back up (never above the profile the user picked) needs a steady 1.0x for
+# ADAPT_UP_WINDOW seconds plus admission capacity for the dearer profile.
+# A cooldown and an hourly cap on changes keep streams from flapping.
+ADAPT_DEFAULT = os.environ.get('STREAMHIB_AUTO_ADAPT', '0') == '1'
+ADAPT_CHECK_SECONDS = 10
+ADAPT_DOWN_SPEED = 0.95
+ADAPT_DOWN_WINDOW = int(os.environ.get('STREAMHIB_ADAPT_DOWN_WINDOW', 30))
+ADAPT_UP_SPEED = 0.99
+ADAPT_UP_WINDOW = int(os.environ.get('STREAMHIB_ADAPT_UP_WINDOW', 600))
+ADAPT_COOLDOWN_SECONDS = 120
+ADAPT_MAX_CHANGES_PER_HOUR = 4
+
+_adapt_state = {}  # session_id -> {'slow_since', 'steady_since'}
+
+def _recent_speed(session_id):
+    """Average encode speed over the last check interval"""
+    cutoff = time.time() - ADAPT_CHECK_SECONDS
+    with _telemetry_lock:
+        speeds = [s['speed'] for s in _telemetry_buffers.get(session_id, ())
+                  if s['t'] >= cutoff and s['speed'] is not None]
+    return sum(speeds) / len(speeds) if speeds else None
+
+def step_profile(session_info, probe, direction):
+    """Get the next cheaper (+1) or dearer (-1) profile, None at either end"""
+    requested = session_info.get('encoding_profile')
+    requested = requested if requested in ENCODING_PROFILES else DEFAULT_ENCODING_PROFILE
+    ceiling = profile_output_height(requested, probe) or CALIBRATION_SIZE[1]
+    rungs = [requested] + [name for name in PROFILE_LADDER if ENCODING_PROFILES[name]['height'] < ceiling]
+    
+    active = get_active_profile(session_info)
+    index = rungs.index(active) if active in rungs else 0
+    target = index + direction
+    return rungs[target] if 0 <= target < len(rungs) else None
+
+def restart_with_profile(session_id, session_info, profile, reason):
+    """Re-encode a running session with another profile"""
+    video_path = os.path.join(VIDEOS_DIR, session_info.get('video_file', ''))
+    service_name = get_service_name(session_id)
+    now = time.time()
+    
+    previous_cost = session_info.get('cpu_cost', 0)
+    cost = estimate_session_cost(dict(session_info, encoding_profile_active=profile), video_path)
+    try:
+        admit_session(session_id, cost, wait=0)
+    except RuntimeError:
+        log(f"ADAPT: Session {session_id[:8]} stays at {get_active_profile(session_info)}, "
+            f"no room for {profile}", session_id=session_id)
+        return False
+    if cost < previous_cost:
+        with _admission_cond:
+            _admission_cond.notify_all()
+    
+    session_info['encoding_profile_active'] = profile
+    session_info['cpu_cost'] = cost
+    session_info['profile_changes'] = [t for t in session_info.get('profile_changes', []) if now - t < 3600] + [now]
+    session_info['profile_changed_at'] = datetime.now(jakarta_tz).isoformat()
+    
+    write_stream_script(session_id, session_info, video_path)
+    apply_stream_quota(service_name, session_info['cpu_cost'])
+    run_systemctl('restart', service_name, check=True)
+    upsert_session('active_sessions', session_id, session_info)
+    
+    with _telemetry_lock:
+        _telemetry_buffers.pop(session_id, None)
+        _telemetry_partial.pop(session_id, None)
+    _adapt_state.pop(session_id, None)
+    log(f"ADAPT: Session {session_id[:8]} now encodes at {profile} ({reason})", session_id=session_id)
+    return True
 
-[Install]
-WantedBy=multi-user.target
-"""
-                        
-                        service_file_path = f"/etc/systemd/system/{service_name}.service"
-                        with open(service_file_path, 'w') as f:
-                            f.write(service_content)
-                        
-                        # Reload systemd and start service
-                        subprocess.run(['systemctl', 'daemon-reload'], check=True)
-                        subprocess.run(['systemctl', 'start', service_name], check=True)
-                        
-                        # Update session info
-                        sessions_data['active_sessions'][session_id]['recovered_at'] = datetime.now(jakarta_tz).isoformat()
-                        
-                        recovered_count += 1
-                        print(f"RECOVERY: Successfully recovered session {session_id[:8]} for user {username}")
-                        
-                    else:
-                        # Video file doesn't exist, move to inactive
-                        sessions_data['inactive_sessions'][session_id] = session_info
-                        sessions_data['inactive_sessions'][session_id]['ended_at'] = datetime.now(jakarta_tz).isoformat()
-                        sessions_data['inactive_sessions'][session_id]['end_reason'] = 'video_file_missing'
-                        
-                        del sessions_data['active_sessions'][session_id]
-                        moved_to_inactive += 1
-                        print(f"RECOVERY: Moved session {session_id[:8]} to inactive (video file missing)")
-                        
-            except Exception as e:
-                print(f"RECOVERY ERROR: Failed to process session {session_id[:8]}: {e}")
+def adapt_encoding_profiles():
+    """Step auto-adapting sessions down when they lag and up when there is room"""
+    active_sessions = load_sessions(readonly=True).get('active_sessions', {})
+    for session_id in list(_adapt_state):
+        if session_id not in active_sessions:
+            del _adapt_state[session_id]
+    
+    now = time.time()
+    for session_id, session_info in active_sessions.items():
+        if not session_info.get('auto_adapt', ADAPT_DEFAULT) or session_info.get('encoding_mode_used') != 'transcode':
+            continue
+        try:
+            speed = _recent_speed(session_id)
+            state = _adapt_state.setdefault(session_id, {'slow_since': None, 'steady_since': None})
+            if speed is None:
+                state.update(slow_since=None, steady_since=None)
                 continue
-        
-        # Save updated sessions
-        save_sessions(sessions_data)
-        
-        recovery_result = {
-            'recovered': recovered_count,
-            'moved_to_inactive': moved_to_inactive,
-            'total_active': len(sessions_data.get('active_sessions', {}))
-        }
-        
-        print(f"RECOVERY: Completed - Recovered: {recovered_count}, Moved to inactive: {moved_to_inactive}")
-        return recovery_result
-        
+            if speed < ADAPT_DOWN_SPEED:
+                state.update(slow_since=state['slow_since'] or now, steady_since=None)
+            elif speed >= ADAPT_UP_SPEED:
+                state.update(slow_since=None, steady_since=state['steady_since'] or now)
+            else:
+                state.update(slow_since=None, steady_since=None)
+            
+            changes = [t for t in session_info.get('profile_changes', ()) if now - t < 3600]
+            if len(changes) >= ADAPT_MAX_CHANGES_PER_HOUR or (changes and now - changes[-1] < ADAPT_COOLDOWN_SECONDS):
+                continue
+            
+            probe = probe_video(get_stream_source(os.path.join(VIDEOS_DIR, session_info.get('video_file', ''))))
+            if state['slow_since'] and now - state['slow_since'] >= ADAPT_DOWN_WINDOW:
+                lower = step_profile(session_info, probe, 1)
+                if lower:
+                    restart_with_profile(session_id, _thaw(session_info), lower, f"speed {speed:.2f}x")
+            elif state['steady_since'] and now - state['steady_since'] >= ADAPT_UP_WINDOW:
+                higher = step_profile(session_info, probe, -1)
+                if higher and not restart_with_profile(session_id, _thaw(session_info), higher, 'steady at real time'):
+                    state['steady_since'] = now  # no room yet, wait another window before retrying
+        except Exception as e:
+            log(f"ADAPT ERROR: Session {session_id[:8]}: {e}", session_id=session_id)
+
+# Watchdog
+# Every WATCHDOG_CHECK_SECONDS the active streams are checked with a single
+# `systemctl show` plus their telemetry:
+#   stalled     - the unit is up but ffmpeg's output time has not moved for
+#                 WATCHDOG_STALL_SECONDS; the unit is restarted
+#   crash loop  - WATCHDOG_CRASH_THRESHOLD failed exits (or stall restarts)
+#                 within WATCHDOG_CRASH_WINDOW; the unit is stopped and started
+#                 again after an exponentially growing, jittered delay
+# After WATCHDOG_MAX_BACKOFFS consecutive backoffs the session is moved to
+# inactive_sessions with end_reason 'crash_loop'. A stream that stays up for
+# WATCHDOG_STABLE_SECONDS has its backoff level reset.
+WATCHDOG_CHECK_SECONDS = 10
+WATCHDOG_STALL_SECONDS = int(os.environ.get('STREAMHIB_STALL_SECONDS', 60))
+WATCHDOG_CRASH_THRESHOLD = int(os.environ.get('STREAMHIB_CRASH_THRESHOLD', 3))
+WATCHDOG_CRASH_WINDOW = 300
+WATCHDOG_BACKOFF_BASE = float(os.environ.get('STREAMHIB_BACKOFF_BASE', 10))
+WATCHDOG_BACKOFF_MAX = float(os.environ.get('STREAMHIB_BACKOFF_MAX', 600))
+WATCHDOG_MAX_BACKOFFS = int(os.environ.get('STREAMHIB_MAX_BACKOFFS', 5))
+WATCHDOG_STABLE_SECONDS = 600
+
+_watchdog_state = {}  # session_id -> in-memory progress and restart tracking
+watchdog_lock = threading.Lock()
+
+def get_unit_properties(service_names, properties):
+    """Read systemd properties of several units with one systemctl show"""
+    if not service_names:
+        return {}
+    result = run_systemctl('show', '-p', ','.join(('Id', *properties)), *service_names)
+    units = {}
+    for block in result.stdout.split('\n\n'):
+        fields = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+        if fields.get('Id', '').endswith('.service'):
+            units[fields.pop('Id')[:-len('.service')]] = fields
+    return units
+
+def backoff_delay(level):
+    """Exponential backoff with equal jitter for a backoff level starting at 1"""
+    delay = min(WATCHDOG_BACKOFF_MAX, WATCHDOG_BACKOFF_BASE * 2 ** (level - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def _record_restart(session_info, kind):
+    """Count a restart on the session"""
+    session_info['restart_count'] = session_info.get('restart_count', 0) + 1
+    if kind == 'stall':
+        session_info['stall_restarts'] = session_info.get('stall_restarts', 0) + 1
+    session_info['last_restart_at'] = datetime.now(jakarta_tz).isoformat()
+
+def back_off_session(session_id, session_info):
+    """Stop a crash-looping stream and start it again later, or give up"""
+    service_name = get_service_name(session_id)
+    level = session_info.get('backoff_level', 0) + 1
+    if level > WATCHDOG_MAX_BACKOFFS:
+        log(f"WATCHDOG: Session {session_id[:8]} kept crashing, moving to inactive", session_id=session_id)
+        upsert_session('active_sessions', session_id, session_info)
+        stop_stream_session(session_id, end_reason='crash_loop')
+        _watchdog_state.pop(session_id, None)
+        return
+    
+    delay = backoff_delay(level)
+    run_systemctl('stop', service_name)
+    release_session(session_id)
+    session_info['backoff_level'] = level
+    session_info['backoff_until'] = (datetime.now(jakarta_tz) + timedelta(seconds=delay)).isoformat()
+    upsert_session('active_sessions', session_id, session_info)
+    # Persisted with the schedules so a restart or a new leader still resumes it
+    scheduler.add_job(
+        resume_backed_off_session, 'date', args=[session_id],
+        run_date=datetime.now(jakarta_tz) + timedelta(seconds=delay),
+        id=f"watchdog-resume:{session_id}", jobstore='schedules', replace_existing=True,
+        misfire_grace_time=None
+    )
+    _watchdog_state.pop(session_id, None)
+    log(f"WATCHDOG: Session {session_id[:8]} is crash-looping, retrying in {delay:.0f}s (backoff {level})", session_id=session_id)
+
+def resume_backed_off_session(session_id):
+    """Start a stream again once its backoff has passed, through admission like recovery"""
+    session_info = load_sessions(readonly=True).get('active_sessions', {}).get(session_id)
+    if session_info is None:
+        return
+    session_info = _thaw(session_info)
+    session_info.pop('backoff_until', None)
+    
+    service_name = get_service_name(session_id)
+    video_path = os.path.join(VIDEOS_DIR, session_info.get('video_file', ''))
+    try:
+        write_stream_script(session_id, session_info, video_path)
+        session_info['cpu_cost'] = estimate_session_cost(session_info, video_path)
+        admit_session(session_id, session_info['cpu_cost'])
+    except RuntimeError as e:
+        # Left orphaned, the next recovery run admits it once there is room
+        log(f"WATCHDOG: Deferred resuming session {session_id[:8]}: {e}", session_id=session_id)
+        upsert_session('active_sessions', session_id, session_info)
+        return
+    except Exception as e:
+        log(f"WATCHDOG ERROR: Failed to resume session {session_id[:8]}: {e}", session_id=session_id)
+        upsert_session('active_sessions', session_id, session_info)
+        return
+    
+    try:
+        apply_stream_quota(service_name, session_info['cpu_cost'])
+        run_systemctl('start', service_name, check=True)
+        log(f"WATCHDOG: Resumed session {session_id[:8]} after backoff", session_id=session_id)
     except Exception as e:
-        print(f"RECOVERY ERROR: {e}")
-        return {'recovered': 0, 'moved_to_inactive': 0, 'total_active': 0}
+        release_session(session_id)
+        log(f"WATCHDOG ERROR: Failed to resume session {session_id[:8]}: {e}", session_id=session_id)
+    upsert_session('active_sessions', session_id, session_info)
 
-def cleanup_unused_services():
-    """Cleanup unused systemd services"""
+def is_backing_off(session_info):
+    """Check if a session is waiting out a crash-loop backoff"""
+    backoff_until = session_info.get('backoff_until')
+    return bool(backoff_until) and datetime.fromisoformat(backoff_until) > datetime.now(jakarta_tz)
+
+def check_stream_health():
+    """Restart stalled streams and back off crash-looping ones"""
+    if not watchdog_lock.acquire(blocking=False):
+        return
     try:
-        print("RECOVERY: Starting service cleanup...")
-        
-        sessions_data = load_sessions()
-        active_sessions = sessions_data.get('active_sessions', {})
+        active_sessions = load_sessions(readonly=True).get('active_sessions', {})
+        for session_id in list(_watchdog_state):
+            if session_id not in active_sessions:
+                del _watchdog_state[session_id]
         
-        # Get all stream services
-        result = subprocess.run(
-            ['systemctl', 'list-units', '--type=service', '--all', '--no-pager'],
-            capture_output=True,
-            text=True
+        watched = {get_service_name(sid): sid for sid, info in active_sessions.items() if not is_backing_off(info)}
+        units = get_unit_properties(
+            list(watched), ('ActiveState', 'NRestarts', 'ExecMainStatus', 'ActiveEnterTimestampMonotonic')
         )
+        now = time.time()
+        uptime_now = time.monotonic()
         
-        cleanup_count = 0
-        
-        if result.returncode == 0:
-            lines = result.stdout.split('\n')
-            for line in lines:
-                if 'stream-' in line and '.service' in line:
-                    # Extract service name
-                    parts = line.split()
-                    if parts:
-                        service_name = parts[0]
-                        if service_name.startswith('stream-') and service_name.endswith('.service'):
-                            # Extract session ID from service name
-                            session_prefix = service_name.replace('stream-', '').replace('.service', '')
-                            
-                            # Check if this session exists in active sessions
-                            session_exists = any(
-                                session_id.startswith(session_prefix) 
-                                for session_id in active_sessions.keys()
-                            )
-                            
-                            if not session_exists:
-                                try:
-                                    # Stop and disable service
-                                    subprocess.run(['systemctl', 'stop', service_name], check=True)
-                                    subprocess.run(['systemctl', 'disable', service_name], check=True)
-                                    
-                                    # Remove service file
-                                    service_file = f"/etc/systemd/system/{service_name}"
-                                    if os.path.exists(service_file):
-                                        os.remove(service_file)
-                                    
-                                    cleanup_count += 1
-                                    print(f"RECOVERY: Cleaned up unused service {service_name}")
-                                    
-                                except Exception as e:
-                                    print(f"RECOVERY ERROR: Failed to cleanup {service_name}: {e}")
-        
-        # Reload systemd
-        subprocess.run(['systemctl', 'daemon-reload'], check=True)
-        
-        print(f"RECOVERY: Service cleanup completed - Removed: {cleanup_count}")
-        return cleanup_count
-        
+        for service_name, props in units.items():
+            session_id = watched.get(service_name)
+            if session_id is None:
+                continue
+            session_info = _thaw(active_sessions[session_id])
+            state = _watchdog_state.setdefault(session_id, {
+                'n_restarts': None, 'crashes': deque(), 'out_time': None, 'progress_at': now
+            })
+            changed = False
+            
+            # Crash loop: systemd restarted ffmpeg after a failed exit
+            n_restarts = int(props.get('NRestarts') or 0)
+            if state['n_restarts'] is not None and n_restarts > state['n_restarts'] and props.get('ExecMainStatus', '0') != '0':
+                for _ in range(n_restarts - state['n_restarts']):
+                    state['crashes'].append(now)
+                    _record_restart(session_info, 'crash')
+                changed = True
+            state['n_restarts'] = n_restarts
+            
+            # Stall: the unit is up but the output clock is frozen
+            if props.get('ActiveState') == 'active':
+                telemetry = summarize_telemetry(session_id)
+                out_time = telemetry['out_time'] if telemetry else None
+                if out_time is not None and out_time != state['out_time']:
+                    state.update(out_time=out_time, progress_at=now)
+                
+                up_for = uptime_now - int(props.get('ActiveEnterTimestampMonotonic') or 0) / 1_000_000
+                if (state['out_time'] is not None and now - state['progress_at'] >= WATCHDOG_STALL_SECONDS
+                        and up_for >= WATCHDOG_STALL_SECONDS):
+                    log(f"WATCHDOG: Session {session_id[:8]} stalled for {now - state['progress_at']:.0f}s, restarting", session_id=session_id)
+                    run_systemctl('restart', service_name)
+                    state['crashes'].append(now)
+                    state.update(out_time=None, progress_at=now, n_restarts=None)
+                    with _telemetry_lock:
+                        _telemetry_buffers.pop(session_id, None)
+                    _record_restart(session_info, 'stall')
+                    changed = True
+            
+            while state['crashes'] and now - state['crashes'][0] > WATCHDOG_CRASH_WINDOW:
+                state['crashes'].popleft()
+            
+            if len(state['crashes']) >= WATCHDOG_CRASH_THRESHOLD:
+                back_off_session(session_id, session_info)
+                continue
+            
+            last_restart = session_info.get('last_restart_at')
+            if (session_info.get('backoff_level') and last_restart
+                    and (datetime.now(jakarta_tz) - datetime.fromisoformat(last_restart)).total_seconds() >= WATCHDOG_STABLE_SECONDS):
+                session_info['backoff_level'] = 0
+                changed = True
+            
+            if changed:
+                upsert_session('active_sessions', session_id, session_info)
     except Exception as e:
-        print(f"RECOVERY ERROR: Service cleanup failed: {e}")
-        return 0
+        log(f"WATCHDOG ERROR: {e}")
+    finally:
+        watchdog_lock.release()
 
 # Routes
 @app.route('/')
@@ -449,14 +4512,10 @@ def index():
         return redirect(url_for('customer_login'))
     
     username = session.get('username')
-    sessions_data = load_sessions()
     video_files = get_video_files()
     
     # Get user's sessions
-    user_sessions = {}
-    for session_id, session_info in sessions_data.get('active_sessions', {}).items():
-        if session_info.get('username') == username:
-            user_sessions[session_id] = session_info
+    user_sessions = get_user_sessions(username)
     
     return render_template('index.html', 
                          username=username,
@@ -477,7 +4536,7 @@ def customer_register():
         return redirect(url_for('index'))
     
     # Check if any users exist (only allow one user)
-    users_data = load_users()
+    users_data = load_users(readonly=True)
     if len(users_data) > 0:
         return render_template('registration_closed.html')
     
@@ -497,8 +4556,8 @@ def admin_index():
         return redirect(url_for('admin_login'))
     
     stats = get_stats()
-    sessions_data = load_sessions()
-    domain_config = load_domain_config()
+    sessions_data = load_sessions(readonly=True)
+    domain_config = load_domain_config(readonly=True)
     
     return render_template('admin_index.html', 
                          stats=stats,
@@ -511,7 +4570,7 @@ def admin_domain():
     if not is_admin_logged_in():
         return redirect(url_for('admin_login'))
     
-    domain_config = load_domain_config()
+    domain_config = load_domain_config(readonly=True)
     return render_template('admin_domain.html', domain_config=domain_config)
 
 @app.route('/admin/users')
@@ -520,7 +4579,7 @@ def admin_users():
     if not is_admin_logged_in():
         return redirect(url_for('admin_login'))
     
-    users_data = load_users()
+    users_data = load_users(readonly=True)
     return render_template('admin_users.html', users=users_data)
 
 @app.route('/admin/recovery')
@@ -529,7 +4588,16 @@ def admin_recovery():
     if not is_admin_logged_in():
         return redirect(url_for('admin_login'))
     
-    return render_template('admin_recovery.html')
+    active_sessions = load_sessions(readonly=True).get('active_sessions', {})
+    streams = sorted(
+        (
+            {'id': session_id, 'service': get_service_name(session_id),
+             'name': info.get('session_name') or session_id[:8], 'username': info.get('username', '')}
+            for session_id, info in active_sessions.items()
+        ),
+        key=lambda stream: (stream['username'], stream['name'])
+    )
+    return render_template('admin_recovery.html', streams=streams)
 
 @app.route('/admin/logout')
 def admin_logout():
@@ -556,7 +4624,7 @@ def api_customer_login():
         if not username or not password:
             return jsonify({'success': False, 'message': 'Username and password required'})
         
-        users_data = load_users()
+        users_data = load_users(readonly=True)
         
         if username not in users_data:
             return jsonify({'success': False, 'message': 'Invalid username or password'})
@@ -640,7 +4708,7 @@ def api_domain_setup():
             return jsonify({'success': False, 'message': 'Domain name required'})
         
         # Load current config
-        domain_config = load_domain_config()
+        domain_config = load_domain_config(readonly=True)
         
         # Remove old nginx config if exists
         if domain_config.get('domain_name') and domain_config.get('nginx_configured'):
@@ -662,7 +4730,7 @@ def api_domain_setup():
         }
         
         if save_domain_config(new_config):
-            print(f"DOMAIN SUCCESS: Domain {domain_name} configured successfully")
+            log(f"DOMAIN SUCCESS: Domain {domain_name} configured successfully")
             return jsonify({
                 'success': True, 
                 'message': f'Domain {domain_name} configured successfully',
@@ -672,7 +4740,7 @@ def api_domain_setup():
             return jsonify({'success': False, 'message': 'Failed to save domain configuration'})
         
     except Exception as e:
-        print(f"DOMAIN ERROR: {e}")
+        log(f"DOMAIN ERROR: {e}")
         return jsonify({'success': False, 'message': f'Domain setup error: {str(e)}'})
 
 @app.route('/api/domain/remove', methods=['POST'])
@@ -682,7 +4750,7 @@ def api_domain_remove():
         return jsonify({'success': False, 'message': 'Admin access required'})
     
     try:
-        domain_config = load_domain_config()
+        domain_config = load_domain_config(readonly=True)
         
         if domain_config.get('domain_name') and domain_config.get('nginx_configured'):
             # Remove nginx config
@@ -752,6 +4820,472 @@ def api_delete_user(username):
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error deleting user: {str(e)}'})
 
+@app.route('/api/sessions/<session_id>/encoding-mode', methods=['POST'])
+def api_set_encoding_mode(session_id):
+    """Override the encoding mode of an active session"""
+    if not is_admin_logged_in():
+        return jsonify({'success': False, 'message': 'Admin access required'})
+    
+    try:
+        data = request.get_json()
+        mode = data.get('encoding_mode', 'auto')
+        
+        if mode != 'auto' and mode not in ENCODING_MODES:
+            return jsonify({'success': False, 'message': f'Invalid encoding mode: {mode}'})
+        
+        sessions_data = load_sessions()
+        session_info = sessions_data['active_sessions'].get(session_id)
+        if session_info is None:
+            return jsonify({'success': False, 'message': 'Session not found'})
+        
+        session_info['encoding_mode'] = mode
+        if upsert_session('active_sessions', session_id, session_info):
+            return jsonify({'success': True, 'message': f'Encoding mode set to {mode}, applied on next restart'})
+        else:
+            return jsonify({'success': False, 'message': 'Failed to save session'})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error setting encoding mode: {str(e)}'})
+
+@app.route('/api/sessions/<session_id>/encoding-profile', methods=['POST'])
+def api_set_encoding_profile(session_id):
+    """Choose the encoding profile and auto-adapt policy of an active session"""
+    if not is_admin_logged_in() and not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        data = request.get_json()
+        sessions_data = load_sessions()
+        session_info = sessions_data['active_sessions'].get(session_id)
+        if session_info is None or (not is_admin_logged_in() and session_info.get('username') != session.get('username')):
+            return jsonify({'success': False, 'message': 'Session not found'})
+        
+        profile = data.get('encoding_profile', session_info.get('encoding_profile', DEFAULT_ENCODING_PROFILE))
+        if profile not in ENCODING_PROFILES:
+            return jsonify({'success': False, 'message': f'Invalid encoding profile: {profile}'})
+        
+        session_info['encoding_profile'] = profile
+        session_info['encoding_profile_active'] = profile
+        if 'auto_adapt' in data:
+            session_info['auto_adapt'] = bool(data['auto_adapt'])
+        if upsert_session('active_sessions', session_id, session_info):
+            return jsonify({'success': True, 'message': f'Encoding profile set to {profile}, applied on next restart',
+                            'profiles': ENCODING_PROFILES})
+        else:
+            return jsonify({'success': False, 'message': 'Failed to save session'})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error setting encoding profile: {str(e)}'})
+
+@app.route('/api/sessions/<session_id>/playlist', methods=['PUT'])
+def api_update_playlist(session_id):
+    """Replace the upcoming items of a live playlist session"""
+    if not is_admin_logged_in() and not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        data = request.get_json()
+        session_info = load_sessions().get('active_sessions', {}).get(session_id)
+        if session_info is None or (not is_admin_logged_in() and session_info.get('username') != session.get('username')):
+            return jsonify({'success': False, 'message': 'Session not found'})
+        
+        playlist = validate_playlist(data.get('playlist'))
+        loop = bool(data.get('loop', session_info.get('loop', False)))
+        service_name = get_service_name(session_id)
+        
+        # Same layout and stream shape: retarget the slots, the running
+        # ffmpeg picks them up. Anything else is a new start of the stream.
+        restarted = False
+        same_layout = (loop == bool(session_info.get('loop')) and session_info.get('playlist_file')
+                       and len(playlist) > 1 and can_retarget_playlist(session_info, playlist))
+        if not (same_layout and retarget_playlist(service_name, playlist)):
+            session_info.update(playlist=playlist, loop=loop, video_file=playlist[0])
+            video_path = os.path.join(VIDEOS_DIR, playlist[0])
+            session_info['cpu_cost'] = estimate_session_cost(session_info, video_path)
+            admit_session(session_id, session_info['cpu_cost'], wait=ADMISSION_QUEUE_SECONDS)
+            write_stream_script(session_id, session_info, video_path)
+            apply_stream_quota(service_name, session_info['cpu_cost'])
+            run_systemctl('restart', service_name, check=True)
+            restarted = True
+        
+        session_info.update(playlist=playlist, loop=loop, video_file=playlist[0])
+        if not upsert_session('active_sessions', session_id, session_info):
+            return jsonify({'success': False, 'message': 'Failed to save session'})
+        
+        message = 'Playlist updated, stream restarted' if restarted else 'Playlist updated, applies from the next item'
+        return jsonify({'success': True, 'message': message, 'restarted': restarted})
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error updating playlist: {str(e)}'})
+
+@app.route('/api/sessions/<session_id>/destinations')
+def api_session_destinations(session_id):
+    """Per-destination status of a live session"""
+    if not is_admin_logged_in() and not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        session_info = load_sessions(readonly=True).get('active_sessions', {}).get(session_id)
+        if session_info is None or (not is_admin_logged_in() and session_info.get('username') != session.get('username')):
+            return jsonify({'success': False, 'message': 'Session not found'})
+        
+        unit_active = is_service_active(get_service_name(session_id))
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'destinations': get_destination_status(session_id, session_info, unit_active)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error getting destination status: {str(e)}'})
+
+@app.route('/api/streams/telemetry')
+def api_stream_telemetry():
+    """Live ffmpeg progress summaries"""
+    if not is_admin_logged_in() and not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        if is_admin_logged_in():
+            summaries = get_telemetry_summaries()
+        else:
+            summaries = get_telemetry_summaries(list(get_user_sessions(session.get('username'))))
+        return jsonify({'success': True, 'telemetry': summaries})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error getting telemetry: {str(e)}'})
+
+@app.route('/api/schedule', methods=['POST'])
+def api_schedule():
+    """Create or update a scheduled stream"""
+    if not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        data = request.get_json()
+        username = session.get('username')
+        session_name = (data.get('session_name_original') or '').strip()
+        recurrence_type = data.get('recurrence_type')
+        
+        destinations = normalize_destinations(data.get('destinations'))
+        playlist = validate_playlist(data['playlist']) if data.get('playlist') else None
+        if playlist:
+            data['video_file'] = playlist[0]
+        if not session_name or not data.get('video_file') or not (data.get('stream_key') or destinations):
+            return jsonify({'success': False, 'message': 'Session name, video file and stream key are required'})
+        if recurrence_type not in RECURRENCE_TYPES:
+            return jsonify({'success': False, 'message': f'Invalid recurrence type: {recurrence_type}'})
+        if not os.path.exists(os.path.join(VIDEOS_DIR, data['video_file'])):
+            return jsonify({'success': False, 'message': 'Video file not found'})
+        
+        # Saving under an existing name updates that schedule
+        user_schedules = get_user_sessions(username, 'scheduled_sessions')
+        schedule_id = next(
+            (sid for sid, info in user_schedules.items() if info.get('session_name_original') == session_name),
+            str(uuid.uuid4())
+        )
+        previous = user_schedules.get(schedule_id, {})
+        
+        schedule_info = {
+            'id': schedule_id,
+            'username': username,
+            'session_name_original': session_name,
+            'video_file': data['video_file'],
+            'stream_key': data.get('stream_key') or destinations[0].get('stream_key', ''),
+            'platform': data.get('platform', 'YouTube'),
+            'recurrence_type': recurrence_type,
+            'created_at': previous.get('created_at') or datetime.now(jakarta_tz).isoformat()
+        }
+        if destinations:
+            schedule_info['destinations'] = destinations
+        if playlist:
+            schedule_info['playlist'] = playlist
+        if data.get('loop'):
+            schedule_info['loop'] = True
+        if data.get('encoding_profile'):
+            if data['encoding_profile'] not in ENCODING_PROFILES:
+                return jsonify({'success': False, 'message': f"Invalid encoding profile: {data['encoding_profile']}"})
+            schedule_info['encoding_profile'] = data['encoding_profile']
+        if 'auto_adapt' in data:
+            schedule_info['auto_adapt'] = bool(data['auto_adapt'])
+        if previous.get('active_session_id'):
+            schedule_info['active_session_id'] = previous['active_session_id']
+        
+        if recurrence_type == 'one_time':
+            start_time = _parse_local_datetime(data.get('start_time') or '')
+            duration_minutes = int(round(float(data.get('duration') or 0) * 60))
+            if start_time <= datetime.now(jakarta_tz):
+                return jsonify({'success': False, 'message': 'Start time must be in the future'})
+            schedule_info.update({
+                'start_time': start_time.isoformat(),
+                'duration_minutes': duration_minutes,
+                'start_time_original': start_time.isoformat(),
+                'duration_minutes_original': duration_minutes,
+                'start_time_display': start_time.strftime('%d-%m-%Y %H:%M'),
+                'stop_time_display': ((start_time + timedelta(minutes=duration_minutes)).strftime('%d-%m-%Y %H:%M')
+                                      if duration_minutes else 'Manual')
+            })
+        else:
+            _parse_time_of_day(data.get('start_time_of_day') or '')
+            _parse_time_of_day(data.get('stop_time_of_day') or '')
+            schedule_info.update({
+                'start_time_of_day': data['start_time_of_day'],
+                'stop_time_of_day': data['stop_time_of_day'],
+                'start_time_display': f"Daily {data['start_time_of_day']}",
+                'stop_time_display': f"Daily {data['stop_time_of_day']}"
+            })
+        
+        add_schedule_jobs(schedule_id, schedule_info)
+        if not upsert_session('scheduled_sessions', schedule_id, schedule_info):
+            remove_schedule_jobs(schedule_id)
+            return jsonify({'success': False, 'message': 'Failed to save schedule'})
+        
+        action = 'updated' if previous else 'scheduled'
+        return jsonify({'success': True, 'message': f"Session '{session_name}' {action}", 'id': schedule_id})
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Invalid schedule: {str(e)}'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error scheduling session: {str(e)}'})
+
+@app.route('/api/schedule-list')
+def api_schedule_list():
+    """List the scheduled streams of the logged in customer"""
+    if not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        schedules = []
+        for schedule_id, schedule_info in get_user_sessions(session.get('username'), 'scheduled_sessions').items():
+            schedule_info = _thaw(schedule_info)
+            job = scheduler.get_job(f"schedule-start:{schedule_id}", jobstore='schedules')
+            schedule_info['id'] = schedule_id
+            schedule_info['next_run_time'] = job.next_run_time.isoformat() if job and job.next_run_time else None
+            schedules.append(schedule_info)
+        schedules.sort(key=lambda s: s['next_run_time'] or '')
+        return jsonify(schedules)
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error listing schedules: {str(e)}'})
+
+@app.route('/api/cancel-schedule', methods=['POST'])
+def api_cancel_schedule():
+    """Cancel a scheduled stream, stopping it if it is live"""
+    if not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        data = request.get_json()
+        schedule_id = data.get('id')
+        schedule_info = load_sessions(readonly=True).get('scheduled_sessions', {}).get(schedule_id)
+        if schedule_info is None or schedule_info.get('username') != session.get('username'):
+            return jsonify({'success': False, 'message': 'Schedule not found'})
+        
+        remove_schedule_jobs(schedule_id)
+        if schedule_info.get('active_session_id'):
+            stop_stream_session(schedule_info['active_session_id'], end_reason='schedule_cancelled')
+        delete_session('scheduled_sessions', schedule_id)
+        
+        return jsonify({'success': True, 'message': f"Schedule '{schedule_info.get('session_name_original')}' cancelled"})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error cancelling schedule: {str(e)}'})
+
+@app.route('/api/admin/scheduler-stats')
+def api_scheduler_stats():
+    """Scheduled start latency distribution"""
+    if not is_admin_logged_in():
+        return jsonify({'success': False, 'message': 'Admin access required'})
+    
+    return jsonify({
+        'success': True,
+        'start_latency': get_schedule_latency_stats(),
+        'scheduled_jobs': sum(1 for job in scheduler.get_jobs(jobstore='schedules') if job.id.startswith('schedule-'))
+    })
+
+@app.route('/api/download', methods=['POST'])
+def api_download():
+    """Queue a video download from Google Drive or an HTTP URL"""
+    if not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        data = request.get_json()
+        source = data.get('file_id') or data.get('url')
+        if not source:
+            return jsonify({'success': False, 'message': 'Google Drive link or URL is required'})
+        
+        job = enqueue_download(source, username=session.get('username'), expected_sha256=data.get('sha256'))
+        return jsonify({'success': True, 'message': 'Download queued', 'job_id': job['id']})
+        
+    except queue.Full:
+        return jsonify({'success': False, 'message': 'Download queue is full, try again later'})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error queueing download: {str(e)}'})
+
+@app.route('/api/downloads')
+def api_downloads():
+    """List download jobs"""
+    if not is_admin_logged_in() and not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    username = None if is_admin_logged_in() else session.get('username')
+    return jsonify({'success': True, 'downloads': get_download_jobs(username)})
+
+@app.route('/api/downloads/<job_id>/<action>', methods=['POST'])
+def api_download_action(job_id, action):
+    """Cancel or retry a download job"""
+    if not is_admin_logged_in() and not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        job = load_state_record('downloads', job_id)
+        if job is None or (not is_admin_logged_in() and job.get('username') != session.get('username')):
+            return jsonify({'success': False, 'message': 'Download not found'})
+        with _download_lock:
+            local_job = _download_jobs.get(job_id)
+        
+        if action == 'cancel':
+            # The worker running the job picks this up within DOWNLOAD_CANCEL_POLL_SECONDS
+            save_state_record('download_cancels', job_id, True)
+            if local_job is not None:
+                local_job['cancelled'] = True
+            if job['status'] == 'queued':
+                job['status'] = 'cancelled'
+                _remove_download_files(job_id)
+                if local_job is not None:
+                    local_job.update(status='cancelled', chunks_done=[])
+                _save_download_record(job)
+                _publish_download(job)
+            return jsonify({'success': True, 'message': 'Download cancelled'})
+        if action == 'retry':
+            if job['status'] not in ('failed', 'cancelled'):
+                return jsonify({'success': False, 'message': f"Download is {job['status']}"})
+            delete_state_record('download_cancels', job_id)
+            job['chunks_done'] = (_load_sidecar(job_id) or {}).get('chunks_done', [])
+            enqueue_download(job['source'], job=job)
+            return jsonify({'success': True, 'message': 'Download queued'})
+        return jsonify({'success': False, 'message': f'Unknown action: {action}'})
+        
+    except queue.Full:
+        return jsonify({'success': False, 'message': 'Download queue is full, try again later'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error updating download: {str(e)}'})
+
+def _parse_upload_metadata(header):
+    """Parse a tus Upload-Metadata header into a dict"""
+    metadata = {}
+    for pair in header.split(','):
+        key, _, value = pair.strip().partition(' ')
+        if key:
+            metadata[key] = base64.b64decode(value).decode('utf-8', 'replace') if value else ''
+    return metadata
+
+@app.route('/api/uploads', methods=['POST'])
+def api_create_upload():
+    """Start a resumable upload"""
+    if not is_admin_logged_in() and not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'}), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        metadata = _parse_upload_metadata(request.headers.get('Upload-Metadata', ''))
+        filename = metadata.get('filename') or data.get('filename')
+        length = int(request.headers.get('Upload-Length') or data.get('size') or 0)
+        
+        upload = create_upload(filename, length, session.get('username'))
+        headers = dict(TUS_HEADERS, Location=url_for('api_upload', upload_id=upload['id']),
+                       **upload_expires_header(upload))
+        return jsonify({'success': True, 'upload_id': upload['id'], 'offset': 0}), 201, headers
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400, TUS_HEADERS
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            return jsonify({'success': False, 'message': e.strerror or str(e)}), 507, TUS_HEADERS
+        log(f"UPLOAD ERROR: Failed to create upload: {e}")
+        return jsonify({'success': False, 'message': f'Error creating upload: {str(e)}'}), 500, TUS_HEADERS
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error creating upload: {str(e)}'}), 500, TUS_HEADERS
+
+@app.route('/api/uploads/<upload_id>', methods=['HEAD', 'PATCH', 'DELETE'])
+def api_upload(upload_id):
+    """Query, continue or abort a resumable upload"""
+    if not is_admin_logged_in() and not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'}), 401
+    
+    upload = load_upload(upload_id)
+    if upload is None or (not is_admin_logged_in() and upload['username'] != session.get('username')):
+        return jsonify({'success': False, 'message': 'Upload not found'}), 404, TUS_HEADERS
+    if upload['expires_at'] <= time.time() and request.method != 'DELETE':
+        return jsonify({'success': False, 'message': 'Upload has expired'}), 410, TUS_HEADERS
+    
+    offset_headers = dict(TUS_HEADERS, **{'Upload-Offset': str(upload['offset']),
+                                          'Upload-Length': str(upload['length']),
+                                          'Cache-Control': 'no-store'}, **upload_expires_header(upload))
+    if request.method == 'HEAD':
+        return '', 200, offset_headers
+    
+    upload_lock = lock_upload(upload_id)
+    if upload_lock is None:
+        return jsonify({'success': False, 'message': 'Upload is already in progress'}), 423, offset_headers
+    if request.method == 'DELETE':
+        remove_upload(upload_id)
+        unlock_upload(upload_id, upload_lock)
+        return '', 204, TUS_HEADERS
+    slot = acquire_upload_slot()
+    if slot is None:
+        upload_lock.release()
+        return jsonify({'success': False, 'message': 'Too many uploads in progress, retry later'}), 429, offset_headers
+    
+    try:
+        # Re-read under the lock, a request in another worker may have just appended
+        upload = load_upload(upload_id)
+        if upload is None:
+            return jsonify({'success': False, 'message': 'Upload not found'}), 404, TUS_HEADERS
+        if request.headers.get('Upload-Offset') != str(upload['offset']):
+            return jsonify({'success': False, 'message': 'Upload-Offset does not match', 'offset': upload['offset']}), 409, offset_headers
+        
+        content_length = request.content_length
+        if content_length is None:
+            return jsonify({'success': False, 'message': 'Content-Length required'}), 411, offset_headers
+        
+        offset = append_upload(upload, request.stream, upload['offset'], content_length)
+        headers = dict(TUS_HEADERS, **{'Upload-Offset': str(offset)})
+        if offset == upload['length']:
+            headers['Upload-Filename'] = finish_upload(upload)
+        else:
+            headers.update(upload_expires_header(load_upload(upload_id) or upload))
+        return '', 204, headers
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400, offset_headers
+    except Exception as e:
+        if isinstance(e, OSError) and e.errno == errno.ENOSPC:
+            log(f"UPLOAD ERROR: {upload_id[:8]} ran out of disk space", upload_id=upload_id)
+            return jsonify({'success': False, 'message': 'Not enough disk space'}), 507, offset_headers
+        log(f"UPLOAD ERROR: {upload_id[:8]} failed: {e}", upload_id=upload_id)
+        return jsonify({'success': False, 'message': f'Error uploading: {str(e)}'}), 500, TUS_HEADERS
+    finally:
+        slot.release()
+        unlock_upload(upload_id, upload_lock)
+
+@app.route('/api/admin/capacity')
+def api_admission_status():
+    """Node capacity and committed stream cost"""
+    if not is_admin_logged_in():
+        return jsonify({'success': False, 'message': 'Admin access required'})
+    
+    return jsonify({'success': True, 'capacity': get_admission_status()})
+
+@app.route('/api/admin/cache-stats')
+def api_cache_stats():
+    """State cache hit/miss counters"""
+    if not is_admin_logged_in():
+        return jsonify({'success': False, 'message': 'Admin access required'})
+    
+    return jsonify({'success': True, 'cache': get_state_cache_stats()})
+
 @app.route('/api/videos')
 def api_get_videos():
     """Get video files"""
@@ -759,35 +5293,333 @@ def api_get_videos():
         return jsonify({'success': False, 'message': 'Login required'})
     
     try:
-        video_files = get_video_files()
-        return jsonify({'success': True, 'videos': video_files})
+        page = request.args.get('page', type=int)
+        per_page = request.args.get('per_page', 50, type=int)
+        items, total = query_video_catalog(
+            sort=request.args.get('sort', 'name'),
+            order=request.args.get('order', 'asc'),
+            search=request.args.get('q'),
+            extension=request.args.get('ext'),
+            page=max(1, page) if page is not None else None,
+            per_page=per_page
+        )
+        
+        normalization = get_normalization_status()
+        for item in items:
+            item['normalization'] = normalization.get(item['name'])
+        
+        return jsonify({
+            'success': True,
+            'videos': [item['name'] for item in items],
+            'items': items,
+            'total': total,
+            'page': page,
+            'per_page': per_page if page is not None else None
+        })
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error getting videos: {str(e)}'})
 
+@app.route('/api/inactive-sessions')
+def api_inactive_sessions():
+    """Page through finished sessions, newest first, including archived ones"""
+    if not is_admin_logged_in() and not is_customer_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'})
+    
+    try:
+        username = request.args.get('user') if is_admin_logged_in() else session.get('username')
+        limit = max(1, min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_MAX_PAGE_SIZE))
+        items, next_cursor = query_session_history(
+            username=username or None,
+            end_reason=request.args.get('end_reason') or None,
+            since=request.args.get('since') or None,
+            until=request.args.get('until') or None,
+            cursor=request.args.get('cursor') or None,
+            limit=limit
+        )
+        return jsonify({
+            'success': True,
+            'inactive_sessions': items,
+            'next_cursor': next_cursor,
+            'limit': limit
+        })
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error getting inactive sessions: {str(e)}'})
+
+# Metrics endpoint
+# /metrics answers to localhost (a Prometheus agent on the node) and to a
+# logged-in admin. Requests proxied by nginx carry X-Forwarded-For and count
+# as remote. The first scrape switches collection on in the state store, and
+# every worker follows within METRICS_PUBLISH_SECONDS; it stays on from then.
+@app.before_request
+def _metrics_request_started():
+    if _metrics_enabled:
+        request.environ['streamhib.started'] = time.perf_counter()
+
+@app.after_request
+def _metrics_request_finished(response):
+    if _metrics_enabled:
+        started = request.environ.get('streamhib.started')
+        if started is not None:
+            endpoint = request.endpoint or 'unmatched'
+            observe_metric('streamhib_http_request_duration_seconds',
+                           (('endpoint', endpoint), ('method', request.method)), time.perf_counter() - started)
+            count_metric('streamhib_http_requests_total', (('endpoint', endpoint), ('status', str(response.status_code))))
+    return response
+
+def enable_metrics():
+    """Turn on hot-path collection here and in the other workers"""
+    global _metrics_enabled
+    if _metrics_enabled:
+        return
+    _metrics_enabled = True
+    save_state_record('runtime', 'metrics', {'enabled_at': datetime.now(jakarta_tz).isoformat()})
+    log("METRICS: Collection enabled")
+
+def dump_metrics():
+    """Copy of this worker's series in a JSON-friendly form"""
+    with _metrics_lock:
+        return {
+            'saved_at': time.time(),
+            'histograms': [[name, labels, list(series)] for (name, labels), series in _metrics_histograms.items()],
+            'counters': [[name, labels, value] for (name, labels), value in _metrics_counters.items()]
+        }
+
+def collect_metrics():
+    """This worker's series merged with the ones other live workers published"""
+    dumps = [dump_metrics()]
+    if WEB_WORKERS > 1:
+        published = load_state_document('metrics', {}, readonly=True)
+        dumps += [
+            dump for pid, dump in published.items()
+            if pid != str(os.getpid()) and time.time() - dump['saved_at'] < METRICS_STALE_SECONDS
+        ]
+
+    histograms, counters = {}, {}
+    for dump in dumps:
+        for name, labels, series in dump['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            merged = histograms.setdefault(key, [0] * len(series))
+            for i, value in enumerate(series):
+                merged[i] += value
+        for name, labels, value in dump['counters']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+    return histograms, counters
+
+def collect_metric_gauges(admission):
+    """Point-in-time values read from the state store and systemd at scrape time"""
+    gauges = {}
+    sessions_data = load_sessions(readonly=True)
+    for bucket in ('active_sessions', 'inactive_sessions', 'scheduled_sessions'):
+        gauges[('streamhib_sessions', (('state', bucket.split('_')[0]),))] = len(sessions_data.get(bucket, {}))
+    try:
+        unit_states = get_stream_unit_states()
+        gauges[('streamhib_stream_units_active', ())] = sum(1 for state in unit_states.values() if state == 'active')
+    except Exception as e:
+        log(f"METRICS ERROR: Unit probe failed: {e}")
+    gauges[('streamhib_admission_capacity_cores', ())] = admission['capacity']
+    gauges[('streamhib_admission_committed_cores', ())] = admission['committed']
+    gauges[('streamhib_admission_streams', ())] = admission['streams']
+    gauges[('streamhib_leader', (('pid', str(os.getpid())),))] = 1 if is_leader() else 0
+    return gauges
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+def render_metrics():
+    """Prometheus text exposition of every series"""
+    histograms, counters = collect_metrics()
+    lines = []
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (series_name, labels), series in sorted(histograms.items()):
+            if series_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(METRICS_LATENCY_BUCKETS + ('+Inf',), series[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {series[-1]:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    admission = get_admission_status()
+    for outcome in ADMISSION_OUTCOMES:
+        counters[('streamhib_admission_decisions_total', (('outcome', outcome),))] = admission[outcome]
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        lines.extend(
+            f"{name}{_format_labels(labels)} {value}"
+            for (series_name, labels), value in sorted(counters.items()) if series_name == name
+        )
+
+    gauges = collect_metric_gauges(admission)
+    for name in sorted({name for name, _ in gauges}):
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(
+            f"{name}{_format_labels(labels)} {value}"
+            for (series_name, labels), value in sorted(gauges.items()) if series_name == name
+        )
+    return '\n'.join(lines) + '\n'
+
+def _metrics_publish_loop():
+    """Follow the shared switch and publish this worker's series for the others"""
+    global _metrics_enabled
+    while True:
+        socketio.sleep(METRICS_PUBLISH_SECONDS)
+        try:
+            if not _metrics_enabled and load_state_record('runtime', 'metrics'):
+                _metrics_enabled = True
+            if not _metrics_enabled or WEB_WORKERS <= 1:
+                continue
+            save_state_record('metrics', str(os.getpid()), dump_metrics())
+            for pid, dump in load_state_document('metrics', {}, readonly=True).items():
+                if time.time() - dump['saved_at'] > METRICS_STALE_SECONDS:
+                    delete_state_record('metrics', pid)
+        except Exception as e:
+            log(f"METRICS ERROR: Publishing failed: {e}")
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for localhost scrapers and admins"""
+    is_local = request.remote_addr in METRICS_LOCAL_ADDRS and 'X-Forwarded-For' not in request.headers
+    if not is_local and not is_admin_logged_in():
+        return 'Admin access required\n', 403, {'Content-Type': 'text/plain; charset=utf-8'}
+
+    try:
+        enable_metrics()
+        return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    except Exception as e:
+        log(f"METRICS ERROR: {e}")
+        return f"# error: {e}\n", 500, {'Content-Type': 'text/plain; charset=utf-8'}
+
+# Background services
+# Every worker starts its scheduler paused - it can still add and remove
+# schedule jobs in the shared job store - plus the event bus flusher, then
+# campaigns for leadership. The leader resumes its scheduler, so interval
+# jobs like recovery_job run exactly once on the host, and starts the
+# singleton services. A paused scheduler wakes for store changes made by
+# other workers at the leader's next tick, at most a few seconds later.
+LEADER_SNAPSHOT_SECONDS = 5
+
+_services_started = False
+
+def save_leader_snapshot():
+    """Mirror the leader's in-memory diagnostics for the other workers"""
+    save_state_record('runtime', 'leader', {
+        'pid': os.getpid(),
+        'saved_at': datetime.now(jakarta_tz).isoformat(),
+        'telemetry': get_telemetry_summaries(),
+        'normalization': get_normalization_status(),
+        'schedule_latency': get_schedule_latency_stats()
+    })
+
+def start_leader_services():
+    """Start the work only one worker may do"""
+    log(f"CLUSTER: Worker {os.getpid()} is the leader")
+    scheduler.resume()
+    start_telemetry_collector()
+    start_admission_calibration()
+    resume_pending_downloads()
+
+def _leader_election_loop():
+    """Retry the leader lock until this worker gets it"""
+    while not try_become_leader():
+        socketio.sleep(LEADER_RETRY_SECONDS)
+    start_leader_services()
+
+def start_background_services():
+    """Start this worker's services, called once per process"""
+    global _services_started
+    if _services_started:
+        return
+    _services_started = True
+    scheduler.start(paused=True)
+    start_event_bus()
+    socketio.start_background_task(_leader_election_loop)
+    socketio.start_background_task(_metrics_publish_loop)
+    start_stream_log_follower()
+
 # Initialize scheduler
-scheduler = BackgroundScheduler()
+scheduler = BackgroundScheduler(timezone=jakarta_tz)
+scheduler.add_jobstore(StateJobStore(), alias='schedules')
+scheduler.add_listener(_on_schedule_job_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+scheduler.add_listener(_on_job_metrics_event, EVENT_JOB_SUBMITTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
 scheduler.add_job(
     func=recovery_orphaned_sessions,
     trigger="interval",
     minutes=5,
     id='recovery_job'
 )
+scheduler.add_job(
+    func=refresh_video_catalog,
+    trigger="interval",
+    seconds=5,
+    id='catalog_job'
+)
+scheduler.add_job(
+    func=check_stream_health,
+    trigger="interval",
+    seconds=WATCHDOG_CHECK_SECONDS,
+    id='watchdog_job'
+)
+scheduler.add_job(
+    func=adapt_encoding_profiles,
+    trigger="interval",
+    seconds=ADAPT_CHECK_SECONDS,
+    id='adapt_job'
+)
+scheduler.add_job(
+    func=scan_videos_for_normalization,
+    trigger="interval",
+    minutes=1,
+    id='normalize_job',
+    next_run_time=datetime.now()
+)
+scheduler.add_job(
+    func=sweep_expired_uploads,
+    trigger="interval",
+    minutes=15,
+    id='upload_sweep_job'
+)
+scheduler.add_job(
+    func=compact_inactive_sessions,
+    trigger="cron",
+    hour=3,
+    minute=30,
+    id='archive_job'
+)
+scheduler.add_job(
+    func=save_leader_snapshot,
+    trigger="interval",
+    seconds=LEADER_SNAPSHOT_SECONDS,
+    id='leader_snapshot_job'
+)
 
 def cleanup_on_exit():
     """Cleanup function on exit"""
     try:
         if scheduler.running:
             scheduler.shutdown()
-        print("StreamHib V2 shutdown completed")
+        log("StreamHib V2 shutdown completed")
     except Exception as e:
-        print(f"Error during cleanup: {e}")
+        log(f"Error during cleanup: {e}")
+    stop_logging()
 
 # Register cleanup function
 atexit.register(cleanup_on_exit)
 
 def signal_handler(sig, frame):
     """Handle shutdown signals"""
-    print(f"Received signal {sig}, shutting down...")
+    log(f"Received signal {sig}, shutting down...")
     cleanup_on_exit()
     sys.exit(0)
 
@@ -796,15 +5628,14 @@ signal.signal(signal.SIGTERM, signal_handler)
 
 if __name__ == '__main__':
     try:
-        print("Starting StreamHib V2...")
-        print("Scheduler dimulai untuk recovery otomatis setiap 5 menit")
+        log("Starting StreamHib V2...")
+        log("Scheduler dimulai untuk recovery otomatis setiap 5 menit")
         
-        # Start scheduler
-        scheduler.start()
+        start_background_services()
         
         # Run Flask app
         socketio.run(app, host='0.0.0.0', port=5000, debug=False)
         
     except Exception as e:
-        print(f"Error starting StreamHib V2: {e}")
+        log(f"Error starting StreamHib V2: {e}")
         cleanup_on_exit()
\ No newline at end of file
@@ -0,0 +1,473 @@
+"""Benchmark harness for the StreamHib panel
+
+Builds a synthetic fleet - sessions.json with N sessions, users.json, a video
+library of thousands of files - in a scratch directory, puts fake systemctl,
+ffprobe, ffmpeg and journalctl binaries (bench/fakes) on PATH and measures how
+the dashboards, the API and the maintenance jobs scale:
+
+    python bench/bench.py                              # 10/100/1000/10000 sessions
+    python bench/bench.py --sessions 1000 --videos 5000
+    python bench/bench.py --save-baseline              # write bench/baseline.json
+    python bench/bench.py --tolerance 0.25             # compare against it
+
+Every endpoint is measured twice: serially through the Flask test client, and
+the HTTP routes again under concurrent load against a threaded server. Besides
+the read-only dashboards, a schedule POST and a start/stop cycle write to the
+state store so lock contention can show up. The report has p50/p95/p99
+latency, throughput and the time spent waiting for and holding
+sessions_lock/users_lock/domain_lock and state database write transactions
+(BEGIN IMMEDIATE, which waits out SQLite's busy lock) per call. Each fleet size runs in
+its own process since the app keeps module-level state. When a baseline
+exists, a p95 slower than baseline * (1 + tolerance) fails the run.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FAKES_DIR = os.path.join(BENCH_DIR, 'fakes')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+LOCK_NAMES = ('sessions_lock', 'users_lock', 'domain_lock')
+
+def schedule_body():
+    """A new daily schedule, a fresh name each time so every request inserts"""
+    return {'session_name_original': f"bench-schedule-{uuid.uuid4().hex[:12]}", 'video_file': 'video_00000.mp4',
+            'stream_key': 'bench-key', 'recurrence_type': 'daily',
+            'start_time_of_day': '03:00', 'stop_time_of_day': '04:00'}
+
+def start_stop(streamhib):
+    """Start a stream and stop it again: admission, sessions and unit writes"""
+    session_id = streamhib.start_stream_session({'username': 'user0', 'video_file': 'video_00000.mp4',
+                                                 'stream_key': 'bench-key', 'platform': 'YouTube',
+                                                 'session_name': 'bench-start-stop'})
+    streamhib.stop_stream_session(session_id)
+
+# name -> (path, login, JSON body factory or None for GET); served by the app's routes
+HTTP_ENDPOINTS = {
+    'index': ('/', 'customer', None),
+    'admin_index': ('/admin', 'admin', None),
+    'api_videos': ('/api/videos', 'customer', None),
+    'api_videos_page': ('/api/videos?page=1&per_page=50&sort=mtime&order=desc', 'customer', None),
+    'api_schedule': ('/api/schedule', 'customer', schedule_body),
+}
+# name -> app function name, or a function taking the app module
+CALL_ENDPOINTS = {
+    'get_stats': 'get_stats',
+    'recovery': 'recovery_orphaned_sessions',
+    'cleanup': 'cleanup_unused_services',
+    'start_stop': start_stop,
+}
+
+# Fixtures
+def build_fleet(workdir, sessions, videos, orphaned, seed):
+    """Write sessions.json, users.json, the video library and the fake unit states"""
+    rng = random.Random(seed)
+    video_dir = os.path.join(workdir, 'videos')
+    os.makedirs(video_dir, exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'units'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'streams'), exist_ok=True)
+
+    now = time.time()
+    video_files = []
+    for i in range(videos):
+        name = f"video_{i:05d}.mp4"
+        path = os.path.join(video_dir, name)
+        with open(path, 'wb') as f:
+            f.truncate(rng.randint(1, 64) * 1024 * 1024)  # sparse, sizes still vary
+        mtime = now - rng.randint(0, 90 * 86400)
+        os.utime(path, (mtime, mtime))
+        video_files.append(name)
+
+    user_count = max(1, sessions // 10)
+    password = hashlib.sha256(b'bench').hexdigest()
+    users = {f"user{i}": {'password': password, 'created_at': datetime.now().isoformat()} for i in range(user_count)}
+
+    fleet = {'active_sessions': {}, 'inactive_sessions': {}, 'scheduled_sessions': {}}
+    running_units = []
+    started = datetime.now() - timedelta(hours=1)
+    for i in range(sessions):
+        session_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        info = {
+            'username': f"user{i % user_count}",
+            'video_file': rng.choice(video_files) if video_files else 'missing.mp4',
+            'stream_key': f"key-{i:05d}",
+            'platform': 'YouTube',
+            'session_name': f"bench-{i:05d}",
+            'started_at': started.isoformat(),
+        }
+        slot = i % 10
+        if slot < 5:
+            fleet['active_sessions'][session_id] = info
+            if rng.random() >= orphaned:
+                running_units.append(f"stream@{session_id[:8]}")
+        elif slot < 9:
+            info.update({'ended_at': datetime.now().isoformat(), 'end_reason': 'stopped'})
+            fleet['inactive_sessions'][session_id] = info
+        else:
+            info.update({'recurrence_type': 'daily', 'start_time': '08:00', 'stop_time': '10:00',
+                         'session_name_original': info['session_name']})
+            fleet['scheduled_sessions'][session_id] = info
+
+    with open(os.path.join(workdir, 'sessions.json'), 'w') as f:
+        json.dump(fleet, f)
+    with open(os.path.join(workdir, 'users.json'), 'w') as f:
+        json.dump(users, f)
+    with open(os.path.join(workdir, 'domain_config.json'), 'w') as f:
+        json.dump({}, f)
+    with open(os.path.join(workdir, 'fake-systemd.units'), 'w') as f:
+        f.write(''.join(f"{unit}\n" for unit in running_units))
+
+def bench_environment(workdir):
+    """Environment pointing the app at the fakes"""
+    env = dict(os.environ)
+    env.update({
+        'PATH': f"{FAKES_DIR}{os.pathsep}{env.get('PATH', '')}",
+        'FAKE_SYSTEMD_STATE': os.path.join(workdir, 'fake-systemd.units'),
+        'STREAMHIB_SYSTEMCTL': os.path.join(FAKES_DIR, 'systemctl'),
+        'STREAMHIB_JOURNALCTL': os.path.join(FAKES_DIR, 'journalctl'),
+        'STREAMHIB_FFMPEG': os.path.join(FAKES_DIR, 'ffmpeg'),
+        'STREAMHIB_FFPROBE': os.path.join(FAKES_DIR, 'ffprobe'),
+        'STREAMHIB_UNIT_DIR': os.path.join(workdir, 'units'),
+        'STREAMHIB_STREAM_DIR': os.path.join(workdir, 'streams'),
+        # Orphans are restarted in one go and never gated by the node's real CPU count
+        'STREAMHIB_RECOVERY_START_RATE': '100000',
+        'STREAMHIB_ADMISSION_HEADROOM': '100000',
+    })
+    return env
+
+# Measurement
+class LockTimer:
+    """Attributes FileLock wait and hold time to the endpoint being measured"""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.totals = {}  # label -> {'wait': s, 'hold': s, 'acquires': n}
+
+    def label(self):
+        from flask import has_request_context, request
+        if has_request_context():
+            return request.headers.get('X-Bench-Endpoint') or request.endpoint
+        return getattr(self.local, 'label', None)
+
+    def add(self, kind, seconds):
+        label = self.label()
+        if label is None:
+            return
+        with self.lock:
+            totals = self.totals.setdefault(label, {'wait': 0.0, 'hold': 0.0, 'acquires': 0})
+            totals[kind] += seconds
+            if kind == 'wait':
+                totals['acquires'] += 1
+
+    def instrument(self, lock):
+        acquire, release = lock.acquire, lock.release
+        held_since = threading.local()
+
+        def timed_acquire(*args, **kwargs):
+            started = time.perf_counter()
+            result = acquire(*args, **kwargs)
+            self.add('wait', time.perf_counter() - started)
+            if lock.lock_counter == 1:
+                held_since.value = time.perf_counter()
+            return result
+
+        def timed_release(*args, **kwargs):
+            release(*args, **kwargs)
+            if lock.lock_counter == 0 and getattr(held_since, 'value', None) is not None:
+                self.add('hold', time.perf_counter() - held_since.value)
+                held_since.value = None
+
+        lock.acquire, lock.release = timed_acquire, timed_release
+
+    def instrument_transactions(self, streamhib):
+        """Count state database write transactions as one more lock"""
+        transaction = streamhib.state_transaction
+
+        @contextmanager
+        def timed_transaction():
+            started = time.perf_counter()
+            acquired = None
+            try:
+                with transaction() as conn:
+                    acquired = time.perf_counter()
+                    self.add('wait', acquired - started)
+                    yield conn
+            finally:
+                if acquired is not None:
+                    self.add('hold', time.perf_counter() - acquired)
+
+        # Callers look the name up in the module on every call
+        streamhib.state_transaction = timed_transaction
+
+    def take(self, label):
+        with self.lock:
+            return self.totals.pop(label, {'wait': 0.0, 'hold': 0.0, 'acquires': 0})
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+def summarize(latencies, wall_seconds, errors, locks):
+    samples = sorted(latencies)
+    count = len(samples)
+    if not count:
+        return {'count': 0, 'errors': errors}
+    return {
+        'count': count,
+        'errors': errors,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'mean_ms': round(sum(samples) / count * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+        'throughput_rps': round(count / wall_seconds, 1) if wall_seconds else None,
+        'lock_wait_ms': round(locks['wait'] / count * 1000, 4),
+        'lock_hold_ms': round(locks['hold'] / count * 1000, 4),
+        'lock_acquires': round(locks['acquires'] / count, 2),
+    }
+
+def session_cookie(app, login):
+    data = {'admin_logged_in': True} if login == 'admin' else {'customer_logged_in': True, 'username': 'user0'}
+    return app.session_interface.get_signing_serializer(app).dumps(data)
+
+def wait_for_probes(streamhib, timeout):
+    """Let the background ffprobe pool finish so it does not skew the first endpoints"""
+    deadline = time.time() + timeout
+    streamhib.refresh_video_catalog(force=True)
+    while time.time() < deadline:
+        with streamhib._catalog_lock:
+            if all(entry['probed'] for entry in streamhib._video_catalog['entries'].values()):
+                return True
+        time.sleep(0.2)
+    return False
+
+def run_serial(streamhib, timer, iterations):
+    """Time every endpoint through the test client and the functions directly"""
+    results = {}
+    client = streamhib.app.test_client()
+    for name, (path, login, body) in HTTP_ENDPOINTS.items():
+        client.set_cookie(streamhib.app.config['SESSION_COOKIE_NAME'], session_cookie(streamhib.app, login))
+        latencies, errors = [], 0
+        timer.take(name)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            if body is None:
+                response = client.get(path, headers={'X-Bench-Endpoint': name})
+            else:
+                response = client.post(path, json=body(), headers={'X-Bench-Endpoint': name})
+            latencies.append(time.perf_counter() - t0)
+            errors += response.status_code != 200 or (body is not None and not response.get_json().get('success'))
+        results[name] = summarize(latencies, time.perf_counter() - started, errors, timer.take(name))
+
+    for name, target in CALL_ENDPOINTS.items():
+        function = getattr(streamhib, target) if isinstance(target, str) else (lambda target=target: target(streamhib))
+        latencies = []
+        timer.local.label = name
+        started = time.perf_counter()
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            function()
+            latencies.append(time.perf_counter() - t0)
+        timer.local.label = None
+        results[name] = summarize(latencies, time.perf_counter() - started, 0, timer.take(name))
+    return results
+
+def run_http(streamhib, timer, clients, requests_per_client):
+    """Hit the HTTP routes from concurrent clients against a threaded server"""
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, streamhib.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    cookie_name = streamhib.app.config['SESSION_COOKIE_NAME']
+    results = {}
+    try:
+        for name, (path, login, body) in HTTP_ENDPOINTS.items():
+            headers = {'Cookie': f"{cookie_name}={session_cookie(streamhib.app, login)}", 'X-Bench-Endpoint': name,
+                       'Content-Type': 'application/json'}
+
+            def worker(_):
+                latencies, errors = [], 0
+                for _ in range(requests_per_client):
+                    data = json.dumps(body()).encode() if body else None
+                    t0 = time.perf_counter()
+                    try:
+                        with urllib.request.urlopen(urllib.request.Request(base_url + path, data=data, headers=headers)) as response:
+                            payload = response.read()
+                            errors += response.status != 200 or (body is not None and not json.loads(payload).get('success'))
+                    except OSError:
+                        errors += 1
+                    latencies.append(time.perf_counter() - t0)
+                return latencies, errors
+
+            timer.take(name)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                outcomes = list(pool.map(worker, range(clients)))
+            wall = time.perf_counter() - started
+            latencies = [latency for client_latencies, _ in outcomes for latency in client_latencies]
+            errors = sum(client_errors for _, client_errors in outcomes)
+            results[name] = summarize(latencies, wall, errors, timer.take(name))
+    finally:
+        server.shutdown()
+    return results
+
+def run_worker(config):
+    """Build one fleet, import the app inside it and measure"""
+    workdir = config['workdir']
+    build_fleet(workdir, config['sessions'], config['videos'], config['orphaned'], config['seed'])
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import app as streamhib
+
+    timer = LockTimer()
+    for name in LOCK_NAMES:
+        timer.instrument(getattr(streamhib, name))
+    timer.instrument_transactions(streamhib)
+    # Paused: schedules land in the schedules job store but nothing fires
+    streamhib.scheduler.start(paused=True)
+
+    setup_started = time.perf_counter()
+    probes_done = wait_for_probes(streamhib, config['probe_timeout'])
+    # The first recovery restarts the orphans, later runs measure the steady state
+    first_recovery = streamhib.recovery_orphaned_sessions()
+    streamhib.cleanup_unused_services()
+    setup_seconds = time.perf_counter() - setup_started
+
+    return {
+        'sessions': config['sessions'],
+        'videos': config['videos'],
+        'setup_seconds': round(setup_seconds, 2),
+        'probes_done': probes_done,
+        'first_recovery': {key: first_recovery.get(key) for key in ('recovered', 'moved_to_inactive', 'failed', 'total_active')},
+        'serial': run_serial(streamhib, timer, config['iterations']),
+        'http': run_http(streamhib, timer, config['clients'], config['requests']),
+    }
+
+# Reporting
+def flatten(results):
+    """{'<sessions>/<mode>/<endpoint>': summary}"""
+    return {
+        f"{run['sessions']}/{mode}/{endpoint}": summary
+        for run in results['runs']
+        for mode in ('serial', 'http')
+        for endpoint, summary in run[mode].items()
+    }
+
+def print_report(results):
+    header = f"{'sessions':>8} {'mode':<6} {'endpoint':<16} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'wait ms':>8} {'hold ms':>8} {'err':>4}"
+    print(header)
+    print('-' * len(header))
+    for key, summary in flatten(results).items():
+        sessions, mode, endpoint = key.split('/')
+        if not summary['count']:
+            continue
+        print(f"{sessions:>8} {mode:<6} {endpoint:<16} {summary['count']:>6} {summary['p50_ms']:>9.2f} "
+              f"{summary['p95_ms']:>9.2f} {summary['p99_ms']:>9.2f} {summary['throughput_rps'] or 0:>8.1f} "
+              f"{summary['lock_wait_ms']:>8.3f} {summary['lock_hold_ms']:>8.3f} {summary['errors']:>4}")
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """List p95 regressions against a baseline"""
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for key, summary in current.items():
+        before = previous.get(key)
+        if not before or not before.get('count') or not summary.get('count'):
+            continue
+        limit = before['p95_ms'] * (1 + tolerance)
+        if summary['p95_ms'] > limit and summary['p95_ms'] - before['p95_ms'] > min_delta_ms:
+            regressions.append(f"{key}: p95 {summary['p95_ms']:.2f} ms vs baseline {before['p95_ms']:.2f} ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--sessions', type=int, action='append', help='fleet size, repeatable (default 10/100/1000/10000)')
+    parser.add_argument('--videos', type=int, default=2000, help='files in the video library')
+    parser.add_argument('--orphaned', type=float, default=0.02, help='share of active sessions without a running unit')
+    parser.add_argument('--iterations', type=int, default=50, help='serial calls per endpoint')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent HTTP clients')
+    parser.add_argument('--requests', type=int, default=25, help='HTTP requests per client and endpoint')
+    parser.add_argument('--seed', type=int, default=2025)
+    parser.add_argument('--probe-timeout', type=float, default=120)
+    parser.add_argument('--output', default='bench_output.json', help='where to write the full results')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 slowdown against the baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='ignore slowdowns smaller than this')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directories')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(args.worker) as f:
+            config = json.load(f)
+        result = run_worker(config)
+        with open(config['result_file'], 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    results = {'created_at': datetime.now().isoformat(), 'python': sys.version.split()[0],
+               'cpus': os.cpu_count(), 'runs': []}
+    for sessions in args.sessions or DEFAULT_SIZES:
+        workdir = tempfile.mkdtemp(prefix=f"streamhib-bench-{sessions}-")
+        config = {
+            'workdir': workdir, 'sessions': sessions, 'videos': args.videos, 'orphaned': args.orphaned,
+            'iterations': args.iterations, 'clients': args.clients, 'requests': args.requests,
+            'seed': args.seed, 'probe_timeout': args.probe_timeout,
+            'result_file': os.path.join(workdir, 'result.json'),
+        }
+        config_file = os.path.join(workdir, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump(config, f)
+
+        print(f"Running {sessions} sessions / {args.videos} videos in {workdir} ...", flush=True)
+        with open(os.path.join(workdir, 'app.log'), 'w') as log:
+            code = subprocess.call([sys.executable, os.path.abspath(__file__), '--worker', config_file],
+                                   env=bench_environment(workdir), stdout=log, stderr=subprocess.STDOUT)
+        if code != 0:
+            print(f"Run with {sessions} sessions failed, see {os.path.join(workdir, 'app.log')}")
+            return code
+        with open(config['result_file']) as f:
+            results['runs'].append(json.load(f))
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print_report(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.baseline}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""Check that Socket.IO emits cross worker processes
+
+Starts two processes that import the app against one scratch state database,
+as two gunicorn workers would: a listener that starts its client manager's
+queue thread and an emitter that calls socketio.emit. The check passes when
+the listener's manager receives the emit, which is what fans it out to the
+clients connected to that worker.
+
+    python bench/check_message_queue.py                                    # built-in state queue
+    python bench/check_message_queue.py --message-queue redis://localhost:6379/0
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from bench import bench_environment  # noqa: E402
+
+EVENT = 'queue_check'
+
+def run_listener(workdir, token, timeout):
+    """Wait for the emitter's event on this process's client manager"""
+    import app as streamhib
+    manager = streamhib.socketio.server.manager
+    received = []
+    handle_emit = manager._handle_emit
+
+    def recording_handle_emit(message):
+        if message.get('event') == EVENT:
+            received.append(message.get('data'))
+        return handle_emit(message)
+
+    manager._handle_emit = recording_handle_emit
+    manager.initialize()
+    time.sleep(1)  # let the queue thread subscribe before the emitter starts
+    with open(os.path.join(workdir, 'listener.ready'), 'w'):
+        pass
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if [token] in received:  # emit arguments travel as a list
+            print(f"Listener {os.getpid()} received the emit")
+            return 0
+        time.sleep(0.05)
+    print(f"Listener {os.getpid()} got no emit within {timeout}s, received {received}")
+    return 1
+
+def run_emitter(workdir, token, timeout):
+    """Emit once the listener is subscribed"""
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(os.path.join(workdir, 'listener.ready')):
+        if time.monotonic() > deadline:
+            print('Listener never became ready')
+            return 1
+        time.sleep(0.05)
+    import app as streamhib
+    streamhib.socketio.emit(EVENT, token)
+    print(f"Emitter {os.getpid()} sent the emit")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--message-queue', default='state', help='STREAMHIB_MESSAGE_QUEUE to check')
+    parser.add_argument('--timeout', type=float, default=15)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    parser.add_argument('--role', choices=('listener', 'emitter'), help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--token', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role:
+        os.chdir(args.workdir)
+        sys.path.insert(0, REPO_DIR)
+        role = run_listener if args.role == 'listener' else run_emitter
+        return role(args.workdir, args.token, args.timeout)
+
+    workdir = tempfile.mkdtemp(prefix='streamhib-queue-')
+    for name in ('units', 'streams', 'videos'):
+        os.makedirs(os.path.join(workdir, name))
+    env = bench_environment(workdir)
+    env.update({'STREAMHIB_WORKERS': '2', 'STREAMHIB_MESSAGE_QUEUE': args.message_queue})
+    token = uuid.uuid4().hex
+    command = [sys.executable, os.path.abspath(__file__), '--workdir', workdir, '--token', token,
+               '--timeout', str(args.timeout)]
+
+    with open(os.path.join(workdir, 'listener.log'), 'w') as listener_log, \
+            open(os.path.join(workdir, 'emitter.log'), 'w') as emitter_log:
+        listener = subprocess.Popen(command + ['--role', 'listener'], env=env,
+                                    stdout=listener_log, stderr=subprocess.STDOUT)
+        emitter = subprocess.Popen(command + ['--role', 'emitter'], env=env,
+                                   stdout=emitter_log, stderr=subprocess.STDOUT)
+        codes = (emitter.wait(), listener.wait())
+
+    if codes == (0, 0):
+        print(f"OK: an emit in one process reached the other over the {args.message_queue} queue")
+    else:
+        print(f"FAILED: emitter exited {codes[0]}, listener exited {codes[1]}, logs in {workdir}")
+        return 1
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
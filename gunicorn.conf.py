@@ -0,0 +1,11 @@
+# Gunicorn settings for StreamHib V2, read automatically from the working directory
+import os
+
+worker_class = 'eventlet'
+workers = int(os.environ.get('STREAMHIB_WORKERS', 1))
+bind = os.environ.get('STREAMHIB_BIND', '0.0.0.0:5000')
+
+def post_worker_init(worker):
+    """Start the scheduler, event bus and leader election in every worker"""
+    from app import start_background_services
+    start_background_services()
@@ -59,6 +59,12 @@ fi
 
 print_status "Memulai instalasi StreamHib V2..."
 
+# Jumlah worker gunicorn (bisa diubah: STREAMHIB_WORKERS=4 bash install_streamhib.sh).
+# Dengan lebih dari 1 worker, event Socket.IO antar worker lewat message queue
+# di database state, atau isi STREAMHIB_MESSAGE_QUEUE=redis://... untuk redis.
+STREAMHIB_WORKERS=${STREAMHIB_WORKERS:-1}
+STREAMHIB_MESSAGE_QUEUE=${STREAMHIB_MESSAGE_QUEUE:-}
+
 # 1. Update sistem
 print_status "Mengupdate sistem..."
 apt update && apt upgrade -y && apt dist-upgrade -y
@@ -133,13 +139,15 @@ check_command "Konfigurasi firewall"
 
 # 12. Buat systemd service
 print_status "Membuat systemd service..."
-cat > /etc/systemd/system/StreamHibV2.service << 'EOF'
+cat > /etc/systemd/system/StreamHibV2.service << EOF
 [Unit]
 Description=StreamHib Flask Service with Gunicorn
 After=network.target
 
 [Service]
-ExecStart=/root/StreamHibV2/venv/bin/gunicorn --worker-class eventlet -w 1 -b 0.0.0.0:5000 app:app
+Environment=STREAMHIB_WORKERS=${STREAMHIB_WORKERS}
+Environment=STREAMHIB_MESSAGE_QUEUE=${STREAMHIB_MESSAGE_QUEUE}
+ExecStart=/root/StreamHibV2/venv/bin/gunicorn app:app
 WorkingDirectory=/root/StreamHibV2
 Restart=always
 User=root
@@ -204,8 +212,8 @@ echo "  Stop service: systemctl stop StreamHibV2.service"
 echo "  Start service: systemctl start StreamHibV2.service"
 echo "  Restart service: systemctl restart StreamHibV2.service"
 echo "  Lihat log: journalctl -u StreamHibV2.service -f"
-echo "  Lihat log recovery: journalctl -u StreamHibV2.service -f | grep RECOVERY"
-echo "  Lihat log domain: journalctl -u StreamHibV2.service -f | grep DOMAIN"
+echo "  Lihat log recovery: journalctl -u StreamHibV2.service -f | grep '\"component\": \"recovery\"'"
+echo "  Lihat log domain: journalctl -u StreamHibV2.service -f | grep '\"component\": \"domain\"'"
 echo ""
 print_status "Direktori instalasi: /root/StreamHibV2"
 echo ""
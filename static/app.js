@@ -26,6 +26,7 @@ document.addEventListener('alpine:init', () => {
         liveSessions: [], // Array of session objects from backend
         scheduledSessions: [], // Array of schedule objects from backend
         inactiveSessions: [], // Array of inactive session objects from backend
+        inactiveSessionsCursor: null, // Cursor halaman berikutnya dari /inactive-sessions, null jika sudah habis
         diskUsage: { status: "Normal", total: 0, used: 0, free: 0, percent_used: 0 },
         toast: { show: false, message: '', type: 'success' }, // type: success, error, info, warning
         confirmation: { 
@@ -51,7 +52,7 @@ document.addEventListener('alpine:init', () => {
 
         // --- Form Data ---
         forms: {
-            downloadVideo: { gdriveUrl: '', progress: 0, status: 'Idle', isDownloading: false },
+            downloadVideo: { gdriveUrl: '', progress: 0, status: 'Idle', isDownloading: false, jobId: null },
             renameVideo: { id: null, oldName: '', newNameBase: '' }, // id adalah nama file lama
             manualLive: { sessionName: '', videoFile: '', streamKey: '', platform: 'YouTube' },
             scheduleLive: {
@@ -155,6 +156,7 @@ document.addEventListener('alpine:init', () => {
             deleteAllInactiveSessionsConfirmation: { id: 'Anda yakin ingin menghapus semua sesi tidak aktif?', en: 'Are you sure you want to delete all inactive sessions?' },
             noInactiveSessionsMessage: { id: 'Tidak ada sesi tidak aktif.', en: 'No inactive sessions.' },
             loadingInactiveSessionsMessage: { id: 'Memuat sesi tidak aktif...', en: 'Loading inactive sessions...' },
+            loadMoreButton: { id: 'Muat lebih banyak', en: 'Load more' },
             lastStopTimeLabel: { id: 'Waktu Berhenti Terakhir', en: 'Last Stop Time' },
             optionsButton: { id: 'Opsi', en: 'Options' },
             deleteInactiveSessionConfirmation: { id: "Anda yakin ingin menghapus sesi tidak aktif '{sessionName}'?", en: "Are you sure you want to delete inactive session '{sessionName}'?" },
@@ -605,6 +607,7 @@ document.addEventListener('alpine:init', () => {
             try { 
                 const data = await this.callApi('/inactive-sessions');
                 this.inactiveSessions = data.inactive_sessions || [];
+                this.inactiveSessionsCursor = data.next_cursor || null;
                 console.log("[Alpine] fetchInactiveSessions: Sesi tidak aktif dimuat:", this.inactiveSessions);
             } catch (error) { 
                 this.inactiveSessions = []; 
@@ -614,25 +617,49 @@ document.addEventListener('alpine:init', () => {
                 console.log("[Alpine] fetchInactiveSessions: Loading state disetel ke false. Jumlah sesi:", this.inactiveSessions.length);
             }
         },
+        async fetchMoreInactiveSessions() {
+            if (!this.inactiveSessionsCursor) return;
+            try {
+                const data = await this.callApi('/inactive-sessions?cursor=' + encodeURIComponent(this.inactiveSessionsCursor));
+                this.inactiveSessions = this.inactiveSessions.concat(data.inactive_sessions || []);
+                this.inactiveSessionsCursor = data.next_cursor || null;
+            } catch (error) {
+                console.error("Gagal mengambil halaman sesi tidak aktif berikutnya:", error);
+            }
+        },
         async handleDownloadVideo() {
             if (!this.forms.downloadVideo.gdriveUrl) { this.showToast(this.t('gdriveUrlRequired'), 'error'); return; }
             this.forms.downloadVideo.isDownloading = true;
             this.forms.downloadVideo.status = this.t('downloadStarting');
             this.forms.downloadVideo.progress = 0;
-            let progressInterval = setInterval(() => { if (this.forms.downloadVideo.progress < 90) this.forms.downloadVideo.progress += 5; }, 200);
             try {
                 const result = await this.callApi('/download', 'POST', { file_id: this.forms.downloadVideo.gdriveUrl });
+                if (!result.success) throw new Error(result.message);
+                // Progress selanjutnya datang lewat event WebSocket 'download_progress'
+                this.forms.downloadVideo.jobId = result.job_id;
                 this.showToast(result.message || this.t('videoDownloadScheduled'), 'success');
-                this.forms.downloadVideo.status = this.t('downloadComplete');
-                this.forms.downloadVideo.progress = 100;
                 this.forms.downloadVideo.gdriveUrl = ''; // Reset field
             } catch (error) {
                 this.forms.downloadVideo.status = error.message || this.t('downloadFailedGeneric');
-            } finally {
-                clearInterval(progressInterval);
                 setTimeout(() => { this.forms.downloadVideo.isDownloading = false; this.forms.downloadVideo.progress = 0;}, 2000);
             }
         },
+        handleDownloadProgress(job) {
+            const form = this.forms.downloadVideo;
+            if (!job || job.id !== form.jobId) return;
+            if (job.progress !== null && job.progress !== undefined) form.progress = job.progress;
+            if (job.status === 'done') {
+                form.status = this.t('downloadComplete');
+                form.progress = 100;
+            } else if (job.status === 'failed' || job.status === 'cancelled') {
+                form.status = job.error || this.t('downloadFailedGeneric');
+            } else {
+                form.status = `${job.status} ${job.progress !== null && job.progress !== undefined ? job.progress + '%' : ''}`.trim();
+                return;
+            }
+            form.jobId = null;
+            setTimeout(() => { form.isDownloading = false; form.progress = 0; }, 2000);
+        },
         async handleRenameVideo() {
             if (!this.forms.renameVideo.newNameBase.trim()) { this.showToast(this.t('newNameRequired'), 'error'); return; }
             try {
@@ -820,7 +847,7 @@ document.addEventListener('alpine:init', () => {
         setupSocketIO() {
             console.log("[Alpine] setupSocketIO: Mencoba menghubungkan ke", SOCKET_URL);
             if (this.socket) { this.socket.disconnect(); } // Disconnect dulu jika sudah ada
-            this.socket = io(SOCKET_URL, { withCredentials: true, transports: ['websocket', 'polling'] });
+            this.socket = io(SOCKET_URL, { withCredentials: true, transports: ['websocket'] });
             
             this.socket.on('connect', () => { this.showToast(this.t('connectedToSocket'), 'success'); console.log("[Alpine] Socket.IO Terhubung!"); });
             this.socket.on('disconnect', (reason) => { this.showToast(this.t('disconnectedFromSocket') + ` (${reason})`, 'warning'); console.log("[Alpine] Socket.IO Terputus:", reason);});
@@ -831,6 +858,26 @@ document.addEventListener('alpine:init', () => {
                 this.videos = Array.isArray(data_filenames) ? data_filenames.map(filename => ({ id: filename, name: filename, url: `${CURRENT_ORIGIN}/videos/${encodeURIComponent(filename)}` })) : [];
                 this.showToast(this.t('videosUpdated'), 'info');
             });
+            this.socket.on('videos_delta', (delta) => {
+                console.log("[Alpine] Socket.IO 'videos_delta' diterima:", delta);
+                const removed = new Set(delta.removed || []);
+                const upserted = Object.keys(delta.upserted || {});
+                const kept = this.videos.filter(video => !removed.has(video.name) && !upserted.includes(video.name));
+                upserted.forEach(filename => kept.push({ id: filename, name: filename, url: `${CURRENT_ORIGIN}/videos/${encodeURIComponent(filename)}` }));
+                this.videos = kept.sort((a, b) => a.name.localeCompare(b.name));
+            });
+            this.socket.on('download_progress', (delta) => {
+                Object.values(delta.upserted || {}).forEach(job => this.handleDownloadProgress(job));
+            });
+            this.socket.on('sessions_delta', (delta) => {
+                console.log("[Alpine] Socket.IO 'sessions_delta' diterima:", delta);
+                const listName = { active_sessions: 'liveSessions', scheduled_sessions: 'scheduledSessions', inactive_sessions: 'inactiveSessions' }[delta.bucket];
+                if (!listName) return;
+                const removed = new Set([...(delta.removed || []), ...Object.keys(delta.upserted || {})]);
+                const kept = this[listName].filter(item => !removed.has(item.id));
+                Object.entries(delta.upserted || {}).forEach(([id, info]) => kept.push({ ...info, id }));
+                this[listName] = kept;
+            });
             this.socket.on('sessions_update', (data_sessions) => { console.log("[Alpine] Socket.IO 'sessions_update' diterima:", data_sessions); this.liveSessions = Array.isArray(data_sessions) ? data_sessions : []; this.showToast(this.t('liveSessionsUpdated'), 'info'); });
             this.socket.on('schedules_update', (data_schedules) => { console.log("[Alpine] Socket.IO 'schedules_update' diterima:", data_schedules); this.scheduledSessions = Array.isArray(data_schedules) ? data_schedules : []; this.showToast(this.t('scheduledSessionsUpdated'), 'info'); });
             this.socket.on('inactive_sessions_update', (data_wrapper) => { 